@@ -45,11 +45,227 @@ from transformers.generation_utils import (
 )
 from transformers.utils import logging
 from utils import is_sent_complete
+from profiler import PROFILER
+from decoding_vocab import DecodingVocab, get_decoding_vocab
+from detokenizer import IncrementalDetokenizer
+from kv_cache import StaticKVCache, truncate_past_key_values
+from speculative import verify_beam_drafts, advance_beam_drafts
 
 
 
 logger = logging.get_logger(__name__)
 
+def _profile_step(new_tokens, pad_token_id):
+    # SentBS: lanes that only append pad after their sentence ended still pay for a full decoder step
+    num_lanes = new_tokens.size(0)
+    num_padded = (new_tokens == pad_token_id).sum().item()
+    PROFILER.count("decoder_steps")
+    PROFILER.count("lane_steps", num_lanes)
+    PROFILER.count("padded_lane_steps", num_padded)
+    PROFILER.count("tokens_generated", num_lanes - num_padded)
+
+def _get_decoding_vocab(model) -> DecodingVocab:
+    # SentBS: the decoding scripts attach `model.decoding_vocab` next to `model.tokenizer`
+    vocab = getattr(model, "decoding_vocab", None)
+    return vocab if vocab is not None else get_decoding_vocab(model.tokenizer)
+
+def _get_lane_texts(decoding_vocab: DecodingVocab, input_ids: torch.LongTensor) -> List[IncrementalDetokenizer]:
+    # SentBS: per-lane text of input_ids, as self.tokenizer.decode(input_ids[i]) would give it
+    # NOTE: do not remove special tokens for the tokenizer here
+    return [IncrementalDetokenizer(decoding_vocab, ids, skip_special_tokens=False) for ids in input_ids.tolist()]
+
+def _advance_beam_texts(beam_texts: List[IncrementalDetokenizer], beam_idx: torch.LongTensor, beam_next_tokens: torch.LongTensor) -> List[IncrementalDetokenizer]:
+    # follow `input_ids = torch.cat([input_ids[beam_idx, :], beam_next_tokens.unsqueeze(-1)], dim=-1)`
+    new_beam_texts = []
+    for prev_beam, next_token in zip(beam_idx.tolist(), beam_next_tokens.tolist()):
+        beam_text = beam_texts[prev_beam].fork()
+        beam_text.append(next_token)
+        new_beam_texts.append(beam_text)
+    return new_beam_texts
+
+def _get_beam_sent_complete(beam_texts: List[IncrementalDetokenizer], decoding_vocab: DecodingVocab, input_ids: torch.LongTensor, pad_token_id: int) -> List[bool]:
+    """
+    whether the sentence of each beam in input_ids has ended; several candidates extend the same beam, so every beam
+    is checked at most once per step, and only if its last token can end a sentence
+    """
+    beam_sent_complete = []
+    for beam_idx, last_token in enumerate(input_ids[:, -1].tolist()):
+        if last_token == pad_token_id:
+            beam_sent_complete.append(True)
+        elif decoding_vocab.may_end_sentence(last_token):
+            text = beam_texts[beam_idx].text
+            with PROFILER.timed("is_sent_complete"):
+                beam_sent_complete.append(is_sent_complete(text))
+        else:
+            beam_sent_complete.append(False)
+    return beam_sent_complete
+
+def _get_forced_pad(
+    input_ids: torch.LongTensor,
+    lane_texts: List[IncrementalDetokenizer],
+    unfinished_sequences: torch.LongTensor,
+    decoding_vocab: DecodingVocab,
+    pad_token_id: int,
+    check_sent: bool,
+) -> torch.BoolTensor:
+    """
+    SentBS: the lanes whose next token `sample` turns into pad_token_id: finished by eos, or, except for the first
+    token of the call (check_sent False), after a pad or a complete sentence
+    """
+    forced = (unfinished_sequences == 0).tolist()
+    if check_sent:
+        for lane_idx, prev_token in enumerate(input_ids[:, -1].tolist()):
+            if forced[lane_idx]:
+                continue
+            if prev_token == pad_token_id:
+                forced[lane_idx] = True
+            elif decoding_vocab.may_end_sentence(prev_token):
+                with PROFILER.timed("is_sent_complete"):
+                    forced[lane_idx] = is_sent_complete(lane_texts[lane_idx].text)
+    return torch.tensor(forced, dtype=torch.bool, device=input_ids.device)
+
+def _speculative_sample(
+    self,
+    drafter,
+    input_ids: torch.LongTensor,
+    logits_processor: LogitsProcessorList,
+    stopping_criteria: StoppingCriteriaList,
+    logits_warper: LogitsProcessorList,
+    pad_token_id: int,
+    eos_token_id: Optional[int],
+    scores: Optional[Tuple[torch.FloatTensor]],
+    model_kwargs: Dict[str, Any],
+) -> Tuple[torch.LongTensor, Optional[Tuple[torch.FloatTensor]]]:
+    """
+    SentBS: the loop of `sample` with speculative decoding (see speculative.SpeculativeDrafter). Every round the
+    drafter samples up to num_draft_tokens tokens per lane, the generator scores all of them in one forward, and the
+    longest prefix accepted by every lane (token x kept with probability min(1, p(x) / q(x))) is committed, followed
+    by one token per lane: its accepted draft token, a sample of the residual max(0, p - q), or after a fully
+    accepted round a sample of the generator. Positions `sample` would force to pad (see _get_forced_pad) are
+    forced in the drafts too and always accepted, so the committed tokens, scores and stopping follow the
+    distribution of the plain loop, token by token.
+    """
+    decoding_vocab = _get_decoding_vocab(self)
+    num_lanes, start_len = input_ids.shape
+    unfinished_sequences = input_ids.new(num_lanes).fill_(1)
+    lane_texts = _get_lane_texts(decoding_vocab, input_ids)
+    max_length = stopping_criteria.max_length
+    cached_len = 0 # decoder positions in the generator cache
+    drafter.reset()
+
+    while True:
+        cur_len = input_ids.size(1)
+        num_draft = drafter.num_draft_tokens
+        if max_length is not None:
+            num_draft = min(num_draft, max_length - cur_len - 1)
+        if isinstance(model_kwargs.get("past"), StaticKVCache):
+            num_draft = min(num_draft, model_kwargs["past"].max_length - cur_len)
+        num_draft = max(num_draft, 0)
+
+        # draft, with the forced pads of every position up to the one after the last draft token
+        draft_ids = input_ids
+        draft_texts = [lane_text.fork() for lane_text in lane_texts]
+        draft_unfinished = unfinished_sequences
+        forced, draft_probs = [], []
+        with PROFILER.timed("draft"):
+            for draft_idx in range(num_draft + 1):
+                forced.append(_get_forced_pad(draft_ids, draft_texts, draft_unfinished, decoding_vocab, pad_token_id, draft_ids.size(1) > start_len))
+                if draft_idx == num_draft:
+                    break
+                draft_logits = drafter.next_logits(draft_ids)
+                draft_scores = logits_warper(draft_ids, logits_processor(draft_ids, draft_logits))
+                draft_probs.append(nn.functional.softmax(draft_scores, dim=-1))
+                draft_tokens = torch.multinomial(draft_probs[-1], num_samples=1).squeeze(1)
+                draft_tokens = draft_tokens.masked_fill(forced[-1], pad_token_id)
+                if eos_token_id is not None:
+                    draft_unfinished = draft_unfinished.mul((draft_tokens != eos_token_id).long())
+                draft_ids = torch.cat([draft_ids, draft_tokens[:, None]], dim=-1)
+                for draft_text, draft_token in zip(draft_texts, draft_tokens.tolist()):
+                    draft_text.append(draft_token)
+
+        # verify: one generator forward over the uncached tokens and the drafts
+        model_inputs = self.prepare_inputs_for_generation(draft_ids, **model_kwargs)
+        model_inputs["decoder_input_ids"] = draft_ids[:, cached_len:]
+        with PROFILER.timed("decoder_step"):
+            outputs = self(**model_inputs, return_dict=True)
+        logits = outputs.logits[:, -(num_draft + 1):, :]
+        model_kwargs.update(self._update_model_kwargs_for_generation(
+            outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
+        ))
+
+        # accept the longest draft prefix accepted by every lane
+        target_scores, target_probs = [], []
+        num_accepted, next_tokens = num_draft, None
+        for draft_idx in range(num_draft + 1):
+            prefix_ids = draft_ids[:, : cur_len + draft_idx]
+            next_token_scores = logits_processor(prefix_ids, logits[:, draft_idx, :])
+            target_scores.append(next_token_scores)
+            target_probs.append(nn.functional.softmax(logits_warper(prefix_ids, next_token_scores), dim=-1))
+            if draft_idx == num_draft:
+                break
+            draft_tokens = draft_ids[:, cur_len + draft_idx]
+            p = target_probs[-1].gather(1, draft_tokens[:, None]).squeeze(1)
+            q = draft_probs[draft_idx].gather(1, draft_tokens[:, None]).squeeze(1)
+            accepted = forced[draft_idx] | (torch.rand_like(q) * q < p)
+            if not accepted.all():
+                residual = (target_probs[-1] - draft_probs[draft_idx]).clamp(min=0)
+                residual_sum = residual.sum(dim=-1, keepdim=True)
+                residual = torch.where(residual_sum > 0, residual / residual_sum.clamp(min=1e-12), target_probs[-1])
+                next_tokens = torch.where(accepted, draft_tokens, torch.multinomial(residual, num_samples=1).squeeze(1))
+                num_accepted = draft_idx
+                break
+        if next_tokens is None: # every draft token accepted
+            next_tokens = torch.multinomial(target_probs[-1], num_samples=1).squeeze(1)
+            next_tokens = next_tokens.masked_fill(forced[num_draft], pad_token_id)
+        new_tokens = [draft_ids[:, cur_len + draft_idx] for draft_idx in range(num_accepted)] + [next_tokens]
+        drafter.record_round(num_draft, num_accepted, len(new_tokens))
+
+        # commit token by token, as `sample` does
+        for draft_idx, tokens in enumerate(new_tokens):
+            if scores is not None:
+                scores += (target_scores[draft_idx],)
+            input_ids = torch.cat([input_ids, tokens[:, None]], dim=-1)
+            for lane_text, token in zip(lane_texts, tokens.tolist()):
+                lane_text.append(token)
+            if PROFILER.enabled:
+                _profile_step(tokens, pad_token_id)
+            if eos_token_id is not None:
+                # `sample` draws a token before forcing pad after a sentence end, and an eos drawn there finishes the lane
+                sampled_tokens = torch.where(
+                    forced[draft_idx] & unfinished_sequences.bool(),
+                    torch.multinomial(target_probs[draft_idx], num_samples=1).squeeze(1),
+                    tokens,
+                )
+                unfinished_sequences = unfinished_sequences.mul((sampled_tokens != eos_token_id).long())
+            if unfinished_sequences.max() == 0 or stopping_criteria(input_ids, scores):
+                return input_ids, scores
+
+        # roll the caches back to the positions whose tokens every lane accepted
+        cached_len = cur_len + num_accepted
+        model_kwargs["past"] = truncate_past_key_values(model_kwargs["past"], cached_len)
+        drafter.truncate(cached_len)
+
+def _get_draft_forced_pad(
+    decoding_vocab: DecodingVocab,
+    lane_texts: List[IncrementalDetokenizer],
+    pad_token_id: int,
+    check_sent: bool,
+) -> Callable[[int, torch.LongTensor], torch.BoolTensor]:
+    """
+    SentBS: the pads the beam steps force after a sentence end (except on the first step of the call, check_sent
+    False), for the paths the drafter extends the beams with (see speculative.verify_beam_drafts)
+    """
+    draft_texts = [lane_text.fork() for lane_text in lane_texts]
+
+    def draft_forced_pad(draft_idx: int, draft_ids: torch.LongTensor) -> torch.BoolTensor:
+        if draft_idx > 0:
+            for draft_text, draft_token in zip(draft_texts, draft_ids[:, -1].tolist()):
+                draft_text.append(draft_token)
+        unfinished_lanes = draft_ids.new(draft_ids.size(0)).fill_(1) # eos ends a hypothesis in the beam scorer, not a lane
+        return _get_forced_pad(draft_ids, draft_texts, unfinished_lanes, decoding_vocab, pad_token_id, check_sent or draft_idx > 0)
+
+    return draft_forced_pad
+
 # can return multiple sequences
 def sample(
         self,
@@ -80,6 +296,7 @@ def sample(
     pad_token_id = pad_token_id if pad_token_id is not None else self.config.pad_token_id
     eos_token_id = eos_token_id if eos_token_id is not None else self.config.eos_token_id
     output_scores = output_scores if output_scores is not None else self.config.output_scores
+    decoding_vocab = _get_decoding_vocab(self)
     output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
     output_hidden_states = (
         output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
@@ -109,8 +326,17 @@ def sample(
     # auto-regressive generation
 
     prev_sent_end = True # avoid take previous sentence as new generated sentence
+    lane_texts = _get_lane_texts(decoding_vocab, input_ids) # kept in sync with input_ids
+
+    # SentBS: speculative decoding with a draft model attached as `self.drafter`, in place of the loop below
+    drafter = getattr(self, "drafter", None)
+    use_drafter = drafter is not None and not synced_gpus and not output_attentions and not output_hidden_states
+    if use_drafter:
+        input_ids, scores = _speculative_sample(
+            self, drafter, input_ids, logits_processor, stopping_criteria, logits_warper, pad_token_id, eos_token_id, scores, model_kwargs
+        )
 
-    while True:
+    while not use_drafter:
 
         if synced_gpus:
             # Under synced_gpus the `forward` call must continue until all gpus complete their sequence.
@@ -126,12 +352,13 @@ def sample(
         model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
 
         # forward pass to get next token
-        outputs = self(
-            **model_inputs,
-            return_dict=True,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-        )
+        with PROFILER.timed("decoder_step"):
+            outputs = self(
+                **model_inputs,
+                return_dict=True,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+            )
 
         if synced_gpus and this_peer_finished:
             cur_len = cur_len + 1
@@ -181,11 +408,26 @@ def sample(
         else:
             # SentBS: if previously sentence has ended, change new token to pad_token_id
             assert input_ids.dim() == 2 # size [num_return_sequences, gen_len]
-            for batch_idx in range(input_ids.size(0)):
-                if len(input_ids[batch_idx])>1 and input_ids[batch_idx][-2] == pad_token_id:
-                    input_ids[batch_idx][-1] = pad_token_id
-                if is_sent_complete(self.tokenizer.decode(input_ids[batch_idx][:-1])):
-                    input_ids[batch_idx][-1] = pad_token_id
+            with PROFILER.timed("sent_check"):
+                if input_ids.size(1) > 1:
+                    prev_tokens = input_ids[:, -2].tolist() # one host copy for all lanes
+                    last_tokens = input_ids[:, -1].tolist()
+                    for batch_idx, prev_token in enumerate(prev_tokens):
+                        if prev_token == pad_token_id:
+                            last_tokens[batch_idx] = pad_token_id
+                        elif decoding_vocab.may_end_sentence(prev_token): # otherwise the text can not be a complete sentence
+                            text = lane_texts[batch_idx].text # the text of input_ids[batch_idx][:-1]
+                            with PROFILER.timed("is_sent_complete"):
+                                sent_complete = is_sent_complete(text)
+                            if sent_complete:
+                                last_tokens[batch_idx] = pad_token_id
+                    input_ids[:, -1] = torch.tensor(last_tokens, device=input_ids.device)
+
+        for lane_text, last_token in zip(lane_texts, input_ids[:, -1].tolist()):
+            lane_text.append(last_token)
+
+        if PROFILER.enabled:
+            _profile_step(input_ids[:, -1], pad_token_id)
 
         model_kwargs = self._update_model_kwargs_for_generation(
             outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
@@ -258,6 +500,7 @@ def beam_search(
     pad_token_id = pad_token_id if pad_token_id is not None else self.config.pad_token_id
     eos_token_id = eos_token_id if eos_token_id is not None else self.config.eos_token_id
     output_scores = output_scores if output_scores is not None else self.config.output_scores
+    decoding_vocab = _get_decoding_vocab(self)
     output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
     output_hidden_states = (
         output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
@@ -300,6 +543,14 @@ def beam_search(
 
     # SentBS: flag to detect if a new sentence is produced
     prev_sent_end = True # avoid take previous sentence as new generated sentence
+    lane_texts = _get_lane_texts(decoding_vocab, input_ids) # kept in sync with input_ids
+
+    # SentBS: speculative decoding with a draft model attached as `self.drafter`, see speculative.verify_beam_drafts
+    drafter = getattr(self, "drafter", None)
+    use_drafter = drafter is not None and not synced_gpus and not output_attentions and not output_hidden_states
+    drafts = None # the current speculative round
+    if use_drafter:
+        drafter.reset()
 
     while True:
 
@@ -313,20 +564,28 @@ def beam_search(
             if this_peer_finished_flag.item() == 0.0:
                 break
 
-        model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
-
-        outputs = self(
-            **model_inputs,
-            return_dict=True,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-        )
+        if use_drafter:
+            # SentBS: the generator logits of the drafted paths, verified for the whole round in one forward
+            if drafts is None:
+                draft_forced_pad = _get_draft_forced_pad(decoding_vocab, lane_texts, pad_token_id, not prev_sent_end)
+                drafts = verify_beam_drafts(self, drafter, input_ids, logits_processor, stopping_criteria, model_kwargs, draft_forced_pad)
+            next_token_logits = drafts.next_token_logits()
+        else:
+            model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
+
+            with PROFILER.timed("decoder_step"):
+                outputs = self(
+                    **model_inputs,
+                    return_dict=True,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                )
 
-        if synced_gpus and this_peer_finished:
-            cur_len = cur_len + 1
-            continue  # don't waste resources running the code we don't need
+            if synced_gpus and this_peer_finished:
+                cur_len = cur_len + 1
+                continue  # don't waste resources running the code we don't need
 
-        next_token_logits = outputs.logits[:, -1, :]
+            next_token_logits = outputs.logits[:, -1, :]
         # hack: adjust tokens for Marian. For Marian we have to make sure that the `pad_token_id`
         # cannot be generated both before and after the `nn.functional.log_softmax` operation.
         next_token_logits = self.adjust_logits_during_generation(next_token_logits, cur_len=cur_len)
@@ -377,16 +636,19 @@ def beam_search(
             prev_sent_end = False
         else:
             # next_indices: 1d torch.LongTensor of size [batch_size, 2*num_beams]
-            for batch_id in range(next_indices.size(0)): # for each batch
-                for i, next_index in enumerate(next_indices[batch_id]): # check the input_ids
-                    # pos = (batch_id - 1) * num_beams + next_index
-                    pos = batch_id * num_beams + next_index
-                    prev_seq = input_ids[pos] # input_ids of shape [batch_size*num_beams, cur_len]
-                    if prev_seq[-1].item() == pad_token_id or is_sent_complete(self.tokenizer.decode(prev_seq)):
-                        # NOTE: do not remove special tokens for the tokenizer here
-                        # add more eos tokens and modify the score
-                        next_tokens[batch_id, i] = pad_token_id
-                        # next_token_scores[batch_id, i] = next_pad_scores[batch_id, next_index]
+            with PROFILER.timed("sent_check"):
+                beam_sent_complete = _get_beam_sent_complete(lane_texts, decoding_vocab, input_ids, pad_token_id)
+                next_tokens_list = next_tokens.tolist()
+                for batch_id, batch_next_indices in enumerate(next_indices.tolist()): # for each batch
+                    for i, next_index in enumerate(batch_next_indices): # check the input_ids
+                        # pos = (batch_id - 1) * num_beams + next_index
+                        pos = batch_id * num_beams + next_index
+                        if beam_sent_complete[pos]:
+                            # NOTE: do not remove special tokens for the tokenizer here
+                            # add more eos tokens and modify the score
+                            next_tokens_list[batch_id][i] = pad_token_id
+                            # next_token_scores[batch_id, i] = next_pad_scores[batch_id, next_index]
+                next_tokens = torch.tensor(next_tokens_list, dtype=next_tokens.dtype, device=next_tokens.device)
             # # rerank the items according to new scores
             # next_token_scores, rearranged_pos = torch.topk(
             #     next_token_scores, 2 * num_beams, dim=1, largest=True, sorted=True
@@ -410,12 +672,18 @@ def beam_search(
         beam_idx = beam_outputs["next_beam_indices"]
         # append next tokens to corresponding selected beams
         input_ids = torch.cat([input_ids[beam_idx, :], beam_next_tokens.unsqueeze(-1)], dim=-1)
+        lane_texts = _advance_beam_texts(lane_texts, beam_idx, beam_next_tokens)
+        if PROFILER.enabled:
+            _profile_step(beam_next_tokens, pad_token_id)
 
-        model_kwargs = self._update_model_kwargs_for_generation(
-            outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
-        )
-        if model_kwargs["past"] is not None:
-            model_kwargs["past"] = self._reorder_cache(model_kwargs["past"], beam_idx)
+        if use_drafter:
+            drafts = advance_beam_drafts(self, drafter, drafts, beam_idx, beam_next_tokens, cur_len, model_kwargs)
+        else:
+            model_kwargs = self._update_model_kwargs_for_generation(
+                outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
+            )
+            if model_kwargs["past"] is not None:
+                model_kwargs["past"] = self._reorder_cache(model_kwargs["past"], beam_idx)
 
         if return_dict_in_generate and output_scores:
             beam_indices = tuple((beam_indices[beam_idx[i]] + (beam_idx[i],) for i in range(len(beam_indices))))
@@ -485,10 +753,12 @@ def prepare_inputs_for_generation(
     cross_attn_head_mask=None,
     use_cache=None,
     encoder_outputs=None,
+    cross_attn_key_values=None,
+    decoder_static_cache_length=None,
     **kwargs
 ):
     # SentBS: NOTE: get this mask before decoder input ids is cut till last item
-    decoder_attention_mask = (decoder_input_ids!=self.tokenizer.pad_token_id).to(decoder_input_ids.device)
+    decoder_attention_mask = (decoder_input_ids!=_get_decoding_vocab(self).pad_token_id).to(decoder_input_ids.device)
     # print("decoder_attention_mask: ", decoder_attention_mask)
 
     # cut decoder_input_ids if past is used
@@ -506,6 +776,8 @@ def prepare_inputs_for_generation(
         "cross_attn_head_mask": cross_attn_head_mask,
         "use_cache": use_cache,  # change this to avoid caching (presumably for debugging)
         "decoder_attention_mask": decoder_attention_mask, # SentBS: added
+        "cross_attn_key_values": cross_attn_key_values, # SentBS: precomputed per source, only used when past is None
+        "decoder_static_cache_length": decoder_static_cache_length, # SentBS: preallocated cache, see kv_cache.StaticKVCache
     }
 
 
@@ -539,6 +811,7 @@ def beam_sample(
     pad_token_id = pad_token_id if pad_token_id is not None else self.config.pad_token_id
     eos_token_id = eos_token_id if eos_token_id is not None else self.config.eos_token_id
     output_scores = output_scores if output_scores is not None else self.config.output_scores
+    decoding_vocab = _get_decoding_vocab(self)
     output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
     output_hidden_states = (
         output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
@@ -575,6 +848,14 @@ def beam_sample(
 
     # SentBS: flag to detect if a new sentence is produced
     prev_sent_end = True # avoid take previous sentence as new generated sentence
+    lane_texts = _get_lane_texts(decoding_vocab, input_ids) # kept in sync with input_ids
+
+    # SentBS: speculative decoding with a draft model attached as `self.drafter`, see speculative.verify_beam_drafts
+    drafter = getattr(self, "drafter", None)
+    use_drafter = drafter is not None and not synced_gpus and not output_attentions and not output_hidden_states
+    drafts = None # the current speculative round
+    if use_drafter:
+        drafter.reset()
 
     while True:
 
@@ -588,20 +869,28 @@ def beam_sample(
             if this_peer_finished_flag.item() == 0.0:
                 break
 
-        model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
-
-        outputs = self(
-            **model_inputs,
-            return_dict=True,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-        )
+        if use_drafter:
+            # SentBS: the generator logits of the drafted paths, verified for the whole round in one forward
+            if drafts is None:
+                draft_forced_pad = _get_draft_forced_pad(decoding_vocab, lane_texts, pad_token_id, not prev_sent_end)
+                drafts = verify_beam_drafts(self, drafter, input_ids, logits_processor, stopping_criteria, model_kwargs, draft_forced_pad)
+            next_token_logits = drafts.next_token_logits()
+        else:
+            model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
+
+            with PROFILER.timed("decoder_step"):
+                outputs = self(
+                    **model_inputs,
+                    return_dict=True,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                )
 
-        if synced_gpus and this_peer_finished:
-            cur_len = cur_len + 1
-            continue  # don't waste resources running the code we don't need
+            if synced_gpus and this_peer_finished:
+                cur_len = cur_len + 1
+                continue  # don't waste resources running the code we don't need
 
-        next_token_logits = outputs.logits[:, -1, :]
+            next_token_logits = outputs.logits[:, -1, :]
 
         # hack: adjust tokens for Marian. For Marian we have to make sure that the `pad_token_id`
         # cannot be generated both before and after the `nn.functional.log_softmax` operation.
@@ -655,16 +944,17 @@ def beam_sample(
             prev_sent_end = False
         else:
             # next_indices: 1d torch.LongTensor of size [batch_size, 2*num_beams]
-            for batch_id in range(next_indices.size(0)): # for each batch
-                for i, next_index in enumerate(next_indices[batch_id]): # check the input_ids
-                    pos = batch_id * num_beams + next_index # TODO: DEBUG
-                    prev_seq = input_ids[pos]
-                    # NOTE: do not remove special tokens for the tokenizer here
-                    text = self.tokenizer.decode(prev_seq)
-                    if prev_seq[-1].item() == pad_token_id or is_sent_complete(text):
-                        # add more pad tokens and modify the score
-                        next_tokens[batch_id, i] = pad_token_id
-                        # next_token_scores[batch_id, i] = next_pad_scores[batch_id, next_index]
+            with PROFILER.timed("sent_check"):
+                beam_sent_complete = _get_beam_sent_complete(lane_texts, decoding_vocab, input_ids, pad_token_id)
+                next_tokens_list = next_tokens.tolist()
+                for batch_id, batch_next_indices in enumerate(next_indices.tolist()): # for each batch
+                    for i, next_index in enumerate(batch_next_indices): # check the input_ids
+                        pos = batch_id * num_beams + next_index # TODO: DEBUG
+                        if beam_sent_complete[pos]:
+                            # add more pad tokens and modify the score
+                            next_tokens_list[batch_id][i] = pad_token_id
+                            # next_token_scores[batch_id, i] = next_pad_scores[batch_id, next_index]
+                next_tokens = torch.tensor(next_tokens_list, dtype=next_tokens.dtype, device=next_tokens.device)
             # # rerank the items according to new scores
             # next_token_scores, rearranged_pos = torch.topk(
             #     next_token_scores, 2 * num_beams, dim=1, largest=True, sorted=True
@@ -687,12 +977,18 @@ def beam_sample(
         beam_idx = beam_outputs["next_beam_indices"]
 
         input_ids = torch.cat([input_ids[beam_idx, :], beam_next_tokens.unsqueeze(-1)], dim=-1)
+        lane_texts = _advance_beam_texts(lane_texts, beam_idx, beam_next_tokens)
+        if PROFILER.enabled:
+            _profile_step(beam_next_tokens, pad_token_id)
 
-        model_kwargs = self._update_model_kwargs_for_generation(
-            outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
-        )
-        if model_kwargs["past"] is not None:
-            model_kwargs["past"] = self._reorder_cache(model_kwargs["past"], beam_idx)
+        if use_drafter:
+            drafts = advance_beam_drafts(self, drafter, drafts, beam_idx, beam_next_tokens, cur_len, model_kwargs)
+        else:
+            model_kwargs = self._update_model_kwargs_for_generation(
+                outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
+            )
+            if model_kwargs["past"] is not None:
+                model_kwargs["past"] = self._reorder_cache(model_kwargs["past"], beam_idx)
 
         if return_dict_in_generate and output_scores:
             beam_indices = tuple((beam_indices[beam_idx[i]] + (beam_idx[i],) for i in range(len(beam_indices))))
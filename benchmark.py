@@ -0,0 +1,451 @@
+"""
+Reproducible benchmarks for the SentBS decoding paths, runnable without any downloads.
+
+The macro suite builds a tiny randomly initialised BART generator and RoBERTa classifier from config (with a
+byte-level BPE tokenizer trained on a synthetic corpus), writes a synthetic test csv, and runs
+beam_search_sent.py / segctrl_sentbs.py once per --gen_mode and GEN_SIZE/BEAM_SIZE setting with --profile.
+Each run reports examples/sec, tokens/sec and the peak RSS of the decoding process.
+The micro suite times is_sent_complete, remove_prompts and the candidate sorting functions in-process.
+
+Example:
+    python benchmark.py --suite all --work_dir benchmark_runs --output benchmark_runs/current.json
+    python benchmark.py --suite all --work_dir benchmark_runs --baseline benchmark_runs/baseline.json --fail_on_regression
+
+Numbers are only comparable between runs on the same machine with the same --num_threads.
+"""
+import os
+import sys
+import json
+import time
+import random
+import timeit
+import argparse
+import platform
+import statistics
+import subprocess
+from termcolor import colored
+
+
+MODE_SCRIPTS = {
+    "beam_search_sent": "beam_search_sent.py",
+    "beam_sample": "beam_search_sent.py",
+    "sample": "beam_search_sent.py",
+    "greedy_search": "beam_search_sent.py",
+    "beam_search": "beam_search_sent.py",
+    "beam_search_span": "segctrl_sentbs.py",
+}
+GRID_MODES = ["beam_search_sent", "beam_sample", "sample", "beam_search_span"] # modes that depend on GEN_SIZE/BEAM_SIZE
+LABELS = ["abstract", "strength", "weakness", "suggestion", "ac_disagreement", "rebuttal_process", "rating_summary", "decision", "misc"]
+SPECIAL_TOKENS = ["<s>", "<pad>", "</s>", "<unk>", "<mask>"] # same ids as bart/roberta: bos 0, pad 1, eos 2, unk 3
+WORDS = ["the", "paper", "reviewers", "method", "results", "authors", "proposed", "experiments", "novel", "clear",
+    "however", "baseline", "model", "dataset", "limited", "strong", "analysis", "rebuttal", "accept", "reject",
+    "writing", "evaluation", "contribution", "significant", "comparison", "et al.", "e.g.", "Figure", "Table", "score"]
+HIGHER_IS_BETTER = {"examples_per_second", "output_tokens_per_second", "decoded_tokens_per_second"}
+LOWER_IS_BETTER = {"peak_rss_mb", "us_per_call"}
+
+
+def parse_arguments(parser):
+    parser.add_argument('--suite', type=str, default="all", choices=['all', 'micro', 'macro'], help="which benchmarks to run")
+    parser.add_argument('--work_dir', type=str, default="benchmark_runs", help="directory for the tiny models, synthetic data and run outputs")
+    parser.add_argument('--output', type=str, default="", help="where to write the benchmark json, defaults to <work_dir>/benchmark.json")
+    parser.add_argument('--baseline', type=str, default="", help="a previous benchmark json to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="relative change against the baseline that is reported as a regression")
+    parser.add_argument('--fail_on_regression', action="store_true", default=False, help="Whether to exit with code 1 if any regression is found")
+    parser.add_argument('--gen_modes', type=str, default=",".join(MODE_SCRIPTS.keys()), help="comma separated gen modes to run in the macro suite")
+    parser.add_argument('--gen_sizes', type=str, default="4,8", help="comma separated GEN_SIZE values for the macro grid")
+    parser.add_argument('--beam_sizes', type=str, default="2,4", help="comma separated BEAM_SIZE values for the macro grid")
+    parser.add_argument('--num_examples', type=int, default=4, help="number of synthetic test examples decoded per macro run")
+    parser.add_argument('--gen_target_max', type=int, default=64, help="maximum number of target tokens per example in the macro runs")
+    parser.add_argument('--max_source_length', type=int, default=256, help="maximum source length, also the position embedding size of the tiny bart")
+    parser.add_argument('--num_threads', type=int, default=1, help="torch.set_num_threads for the macro runs, pinned for reproducibility")
+    parser.add_argument('--micro_repeat', type=int, default=5, help="number of timeit repeats per micro benchmark, the median is reported")
+    parser.add_argument('--seed', type=int, default=0, help="seed for the synthetic data, model init and decoding")
+    parser.add_argument('--rebuild', action="store_true", default=False, help="Whether to rebuild the tiny models and synthetic data even if they exist")
+
+    args = parser.parse_args()
+    for k in args.__dict__:
+        print(k + ": " + str(args.__dict__[k]))
+    return args
+
+
+# --------- Synthetic Data ---------
+def make_sentence(rng, min_words=4, max_words=12):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))]
+    return " ".join(words).capitalize() + rng.choice([".", ".", ".", "?", "!", ";"])
+
+def make_example(rng, num_sents):
+    labels = [rng.choice(LABELS) for _ in range(num_sents)]
+    source = " ".join(make_sentence(rng) for _ in range(rng.randint(10, 20)))
+    text = " | ".join(labels) + " ==> " + source
+    summary = " ".join(make_sentence(rng) for _ in range(num_sents))
+    return text, summary
+
+def write_test_file(path, num_examples, seed):
+    import pandas as pd
+    rng = random.Random(seed)
+    rows = [make_example(rng, rng.randint(2, 3)) for _ in range(num_examples)]
+    pd.DataFrame(rows, columns=["text", "summary"]).to_csv(path, index=False)
+
+
+# --------- Tiny Models ---------
+def build_tokenizer(tokenizer_dir, seed):
+    from tokenizers import ByteLevelBPETokenizer
+    from transformers import BartTokenizerFast
+
+    rng = random.Random(seed)
+    corpus = [make_example(rng, 3)[0] for _ in range(200)] + [" ".join(LABELS)]
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(corpus, vocab_size=1000, min_frequency=1, special_tokens=SPECIAL_TOKENS)
+    os.makedirs(tokenizer_dir, exist_ok=True)
+    bpe.save_model(tokenizer_dir)
+    tokenizer = BartTokenizerFast(
+        vocab_file=os.path.join(tokenizer_dir, "vocab.json"),
+        merges_file=os.path.join(tokenizer_dir, "merges.txt"),
+    )
+    return tokenizer
+
+def build_tiny_models(work_dir, max_source_length, seed):
+    """
+    returns (generation_model_path, classification_model_path), both loadable with from_pretrained
+    """
+    from transformers import (
+        set_seed,
+        BartConfig,
+        BartForConditionalGeneration,
+        RobertaConfig,
+        RobertaForSequenceClassification,
+        RobertaTokenizerFast,
+    )
+
+    set_seed(seed)
+    generation_model_path = os.path.join(work_dir, "tiny_bart")
+    classification_model_path = os.path.join(work_dir, "tiny_roberta")
+    tokenizer = build_tokenizer(os.path.join(work_dir, "tokenizer"), seed)
+
+    bart_config = BartConfig(
+        vocab_size=len(tokenizer),
+        max_position_embeddings=max_source_length,
+        d_model=32,
+        encoder_layers=2,
+        decoder_layers=2,
+        encoder_attention_heads=2,
+        decoder_attention_heads=2,
+        encoder_ffn_dim=64,
+        decoder_ffn_dim=64,
+        pad_token_id=tokenizer.pad_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        decoder_start_token_id=tokenizer.eos_token_id,
+        forced_bos_token_id=tokenizer.bos_token_id,
+        forced_eos_token_id=tokenizer.eos_token_id,
+    )
+    BartForConditionalGeneration(bart_config).save_pretrained(generation_model_path)
+    tokenizer.save_pretrained(generation_model_path)
+
+    roberta_config = RobertaConfig(
+        vocab_size=len(tokenizer),
+        max_position_embeddings=514, # the decoding scripts truncate classifier inputs to 512 tokens
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        type_vocab_size=1,
+        num_labels=len(LABELS),
+        pad_token_id=tokenizer.pad_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    RobertaForSequenceClassification(roberta_config).save_pretrained(classification_model_path)
+    RobertaTokenizerFast.from_pretrained(generation_model_path).save_pretrained(classification_model_path)
+    return generation_model_path, classification_model_path
+
+
+# --------- Macro Benchmarks ---------
+def get_macro_configs(gen_modes, gen_sizes, beam_sizes):
+    configs = []
+    for gen_mode in gen_modes:
+        if gen_mode in GRID_MODES:
+            for gen_size in gen_sizes:
+                for beam_size in beam_sizes:
+                    configs.append((gen_mode, gen_size, beam_size))
+        else:
+            configs.append((gen_mode, gen_sizes[0], beam_sizes[0]))
+    return configs
+
+def get_run_name(gen_mode, gen_size, beam_size):
+    if gen_mode in GRID_MODES:
+        return f"{gen_mode}-gen_size_{gen_size}-beam_size_{beam_size}"
+    return gen_mode
+
+def run_and_measure(cmd, log_file_path, env):
+    """
+    run cmd to completion, returning (return code, wall seconds, peak rss in MB of the child process)
+    """
+    start_time = time.perf_counter()
+    with open(log_file_path, "w", encoding="utf-8") as log_fw:
+        # run from the repo root so the scripts pick up the local rouge metric and modules
+        worker = subprocess.Popen(cmd, stdout=log_fw, stderr=subprocess.STDOUT, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+        _, status, rusage = os.wait4(worker.pid, 0)
+    worker.returncode = os.waitstatus_to_exitcode(status)
+    wall_time = time.perf_counter() - start_time
+    peak_rss_mb = rusage.ru_maxrss / 1024 if sys.platform != "darwin" else rusage.ru_maxrss / (1024 * 1024) # KB on linux, bytes on macos
+    return worker.returncode, wall_time, peak_rss_mb
+
+def count_output_tokens(tokenizer, result_file_path):
+    with open(result_file_path, "r", encoding="utf-8") as fr:
+        lines = [line.rstrip("\n") for line in fr]
+    return sum(len(ids) for ids in tokenizer(lines, add_special_tokens=False).input_ids) if lines else 0
+
+def run_macro(args, generation_model_path, classification_model_path, test_file):
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(generation_model_path, use_fast=True)
+
+    gen_modes = [x.strip() for x in args.gen_modes.split(",") if x.strip()]
+    gen_sizes = [int(x) for x in args.gen_sizes.split(",")]
+    beam_sizes = [int(x) for x in args.beam_sizes.split(",")]
+    res_dir = os.path.join(args.work_dir, "runs")
+    os.makedirs(res_dir, exist_ok=True)
+
+    env = dict(os.environ)
+    env["OMP_NUM_THREADS"] = str(args.num_threads)
+    env["MKL_NUM_THREADS"] = str(args.num_threads)
+    env["TOKENIZERS_PARALLELISM"] = "false"
+    env["CUDA_VISIBLE_DEVICES"] = "" # cpu only, so numbers are comparable across machines with and without gpus
+
+    results = {}
+    for gen_mode, gen_size, beam_size in get_macro_configs(gen_modes, gen_sizes, beam_sizes):
+        run_name = get_run_name(gen_mode, gen_size, beam_size)
+        result_file_path = os.path.join(res_dir, run_name + ".txt")
+        for path in [result_file_path, result_file_path.replace(".txt", ".journal"), result_file_path.replace(".txt", ".profile.json")]:
+            if os.path.exists(path):
+                os.remove(path)
+        cmd = [sys.executable, MODE_SCRIPTS[gen_mode],
+            "--gen_mode", gen_mode,
+            "--gen_size", str(gen_size),
+            "--beam_size", str(beam_size),
+            "--generation_model_path", generation_model_path,
+            "--load_classifier",
+            "--classification_model_path", classification_model_path,
+            "--classifier_device", "cpu",
+            "--test_file", test_file,
+            "--test_end_idx", str(args.num_examples),
+            "--gen_target_max", str(args.gen_target_max),
+            "--max_source_length", str(args.max_source_length),
+            "--res_dir", res_dir,
+            "--res_file_name", run_name + ".txt",
+            "--run_num", str(args.seed),
+            "--num_threads", str(args.num_threads),
+            "--per_example_seed",
+            "--no_resume",
+            "--write",
+            "--profile",
+        ]
+        print(colored(f"running {run_name}", 'green'))
+        return_code, wall_time, peak_rss_mb = run_and_measure(cmd, result_file_path.replace(".txt", ".log"), env)
+        if return_code != 0:
+            print(colored(f"{run_name} exited with code {return_code}, see {result_file_path.replace('.txt', '.log')}", 'red'))
+            results[run_name] = {"return_code": return_code}
+            continue
+
+        with open(result_file_path.replace(".txt", ".profile.json"), "r", encoding="utf-8") as fr:
+            profile = json.load(fr)["summary"]
+        decode_time = profile["time"] # excludes model loading
+        output_tokens = count_output_tokens(tokenizer, result_file_path)
+        results[run_name] = {
+            "return_code": return_code,
+            "wall_time": wall_time,
+            "decode_time": decode_time,
+            "num_examples": profile["num_examples"],
+            "examples_per_second": profile["num_examples"] / decode_time if decode_time > 0 else 0.0,
+            "output_tokens_per_second": output_tokens / decode_time if decode_time > 0 else 0.0,
+            # every token decoded on any lane; only counted by the SentBS generation loops
+            "decoded_tokens_per_second": profile["tokens_per_second"],
+            "peak_rss_mb": peak_rss_mb,
+            "stages": {stage: value["share"] for stage, value in profile["stages"].items()},
+        }
+        print(" | ".join(f"{k}: {v:.3f}" for k, v in results[run_name].items() if isinstance(v, float)))
+    return results
+
+
+# --------- Micro Benchmarks ---------
+def time_call(fn, repeat):
+    """
+    median seconds per call of fn, with the number of calls per repeat calibrated by timeit to take at least 0.2s
+    """
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return statistics.median(timer.repeat(repeat=repeat, number=number)) / number
+
+def get_sent_complete_cases(rng):
+    cases = [make_sentence(rng) for _ in range(50)]
+    cases += [sent[:-1] for sent in cases] # incomplete
+    cases += [sent[:-1] + " e.g." for sent in cases[:20]] + [sent[:-1] + " et al." for sent in cases[:20]]
+    cases += ["the final meta score: 7", "see https://arxiv.org/pdf/123.0003", "Pro: <sep> - the idea"]
+    return cases
+
+def get_remove_prompts_cases(rng):
+    cases = {}
+    sents = [(rng.choice(LABELS), make_sentence(rng)) for _ in range(6)]
+    cases["extra_tokens"] = " ".join(f"<label-sep>{label}<sent-sep> {sent}" for label, sent in sents)
+    cases["special_sep"] = " ".join(f"¥ {label} þ {sent}" for label, sent in sents)
+    cases["label_arrow"] = " ".join(f"| {label} ==> {sent}" for label, sent in sents)
+    return cases
+
+def get_sort_cases(rng, sizes):
+    import torch
+    from proto import GenerationItem
+    cases = {}
+    for size in sizes:
+        items = []
+        for _ in range(size):
+            num_tokens = rng.randint(5, 60)
+            items.append(GenerationItem(
+                torch.zeros(1, num_tokens, dtype=torch.long),
+                -rng.random() * num_tokens,
+                classification_score=-rng.random(),
+                num_tokens_generated=num_tokens,
+                classification_rank=rng.randint(0, len(LABELS) - 1),
+                seq_score=-rng.random(),
+            ))
+        cases[size] = items
+    return cases
+
+def run_micro(args):
+    from utils import is_sent_complete, remove_prompts, remove_prompts_fast, batch_remove_prompts
+    from proto import (
+        sort_filter_gen_history,
+        sort_filter_gen_history_with_length_penalty,
+        sort_filter_gen_histrory_by_rank,
+        sort_filter_gen_history_with_classification_rank,
+    )
+    rng = random.Random(args.seed)
+    results = {}
+
+    sent_cases = get_sent_complete_cases(rng)
+    seconds = time_call(lambda: [is_sent_complete(text) for text in sent_cases], args.micro_repeat)
+    results["is_sent_complete"] = {"us_per_call": seconds / len(sent_cases) * 1e6}
+
+    for rm_type, text in get_remove_prompts_cases(rng).items():
+        assert remove_prompts_fast(text, rm_type=rm_type) == remove_prompts(text, rm_type=rm_type), f"remove_prompts_fast differs for {rm_type}"
+        seconds = time_call(lambda: remove_prompts(text, rm_type=rm_type), args.micro_repeat)
+        results[f"remove_prompts[{rm_type}]"] = {"us_per_call": seconds * 1e6}
+        seconds = time_call(lambda: remove_prompts_fast(text, rm_type=rm_type), args.micro_repeat)
+        results[f"remove_prompts_fast[{rm_type}]"] = {"us_per_call": seconds * 1e6}
+        texts = [text] * 100
+        seconds = time_call(lambda: batch_remove_prompts(texts, rm_type=rm_type), args.micro_repeat)
+        results[f"batch_remove_prompts[{rm_type}]"] = {"us_per_call": seconds / len(texts) * 1e6}
+
+    # detokenisation of generated spans, with the tiny tokenizer of the macro suite
+    from decoding_vocab import get_decoding_vocab
+    from detokenizer import IncrementalDetokenizer, fast_decode
+    tokenizer = build_tokenizer(os.path.join(args.work_dir, "tokenizer"), args.seed)
+    decoding_vocab = get_decoding_vocab(tokenizer)
+    span_ids = tokenizer(" ".join(sent_cases[:10]), add_special_tokens=True).input_ids
+    for skip_special_tokens in [True, False]:
+        assert fast_decode(decoding_vocab, span_ids, skip_special_tokens=skip_special_tokens) == tokenizer.decode(span_ids, skip_special_tokens=skip_special_tokens), "fast_decode differs from tokenizer.decode"
+    seconds = time_call(lambda: tokenizer.decode(span_ids, skip_special_tokens=True), args.micro_repeat)
+    results["tokenizer.decode"] = {"us_per_call": seconds * 1e6}
+    seconds = time_call(lambda: fast_decode(decoding_vocab, span_ids), args.micro_repeat)
+    results["fast_decode"] = {"us_per_call": seconds * 1e6}
+    # per-step cost of keeping a lane's text up to date: decode the prefix each step vs. append one token
+    seconds = time_call(lambda: [tokenizer.decode(span_ids[:i]) for i in range(1, len(span_ids) + 1)], args.micro_repeat)
+    results["tokenizer.decode[per_step]"] = {"us_per_call": seconds / len(span_ids) * 1e6}
+    def incremental_texts():
+        detok = IncrementalDetokenizer(decoding_vocab, skip_special_tokens=False)
+        for token_id in span_ids:
+            detok.append(token_id)
+            detok.text
+    seconds = time_call(incremental_texts, args.micro_repeat)
+    results["IncrementalDetokenizer[per_step]"] = {"us_per_call": seconds / len(span_ids) * 1e6}
+
+    # candidate pool sizes seen in decoding: GEN_SIZE * BEAM_SIZE options per sentence
+    gen_sizes = [int(x) for x in args.gen_sizes.split(",")]
+    beam_sizes = [int(x) for x in args.beam_sizes.split(",")]
+    sizes = sorted(set(g * b for g in gen_sizes for b in beam_sizes))
+    sort_fns = {
+        "sort_filter_gen_history": sort_filter_gen_history,
+        "sort_filter_gen_history_with_length_penalty": sort_filter_gen_history_with_length_penalty,
+        "sort_filter_gen_histrory_by_rank": sort_filter_gen_histrory_by_rank,
+        "sort_filter_gen_history_with_classification_rank": sort_filter_gen_history_with_classification_rank,
+    }
+    for size, items in get_sort_cases(rng, sizes).items():
+        for name, fn in sort_fns.items():
+            seconds = time_call(lambda: fn(items, max(beam_sizes)), args.micro_repeat)
+            results[f"{name}[{size}]"] = {"us_per_call": seconds * 1e6}
+
+    for name, value in results.items():
+        print(f"{name}: {value['us_per_call']:.2f} us/call")
+    return results
+
+
+# --------- Baseline Comparison ---------
+def compare_to_baseline(current, baseline, tolerance):
+    """
+    returns a list of (suite, name, metric, baseline value, current value, relative change) for every regression
+    """
+    regressions = []
+    for suite in ["micro", "macro"]:
+        for name, values in current.get(suite, {}).items():
+            base_values = baseline.get(suite, {}).get(name)
+            if base_values is None:
+                continue
+            for metric, value in values.items():
+                base_value = base_values.get(metric)
+                if not isinstance(value, (int, float)) or not isinstance(base_value, (int, float)) or base_value == 0:
+                    continue
+                change = (value - base_value) / abs(base_value)
+                if (metric in HIGHER_IS_BETTER and change < -tolerance) or (metric in LOWER_IS_BETTER and change > tolerance):
+                    regressions.append((suite, name, metric, base_value, value, change))
+    return regressions
+
+def get_environment():
+    import torch
+    import transformers
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+    args.work_dir = os.path.abspath(args.work_dir)
+    os.makedirs(args.work_dir, exist_ok=True)
+    output_path = args.output if args.output else os.path.join(args.work_dir, "benchmark.json")
+
+    report = {"environment": get_environment(), "args": vars(args)}
+    if args.suite in ["all", "micro"]:
+        print(colored("--------- micro benchmarks ---------", 'green'))
+        report["micro"] = run_micro(args)
+
+    if args.suite in ["all", "macro"]:
+        print(colored("--------- macro benchmarks ---------", 'green'))
+        test_file = os.path.join(args.work_dir, "test.csv")
+        generation_model_path = os.path.join(args.work_dir, "tiny_bart")
+        classification_model_path = os.path.join(args.work_dir, "tiny_roberta")
+        if args.rebuild or not os.path.exists(generation_model_path) or not os.path.exists(classification_model_path):
+            generation_model_path, classification_model_path = build_tiny_models(args.work_dir, args.max_source_length, args.seed)
+        if args.rebuild or not os.path.exists(test_file):
+            write_test_file(test_file, args.num_examples, args.seed)
+        report["macro"] = run_macro(args, generation_model_path, classification_model_path, test_file)
+
+    with open(output_path, "w", encoding="utf-8") as fw:
+        json.dump(report, fw, indent=2)
+    print("benchmark written to:", output_path)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as fr:
+            baseline = json.load(fr)
+        regressions = compare_to_baseline(report, baseline, args.tolerance)
+        for suite, name, metric, base_value, value, change in regressions:
+            print(colored(f"regression [{suite}] {name} {metric}: {base_value:.3f} -> {value:.3f} ({change*100:+.1f}%)", 'red'))
+        if not regressions:
+            print(colored(f"no regressions beyond {args.tolerance*100:.0f}% against {args.baseline}", 'green'))
+        elif args.fail_on_regression:
+            exit(1)
@@ -1,7 +1,7 @@
 import json
 import random
 from pathlib import Path
-from typing import Tuple, List
+from typing import Tuple, List, Optional
 import argparse
 from tqdm import tqdm
 
@@ -55,6 +55,11 @@ from utils import (
 )
 
 import run_summarization
+from decoding_vocab import get_decoding_vocab
+from modeling_bart import BartForConditionalGeneration
+from inference_precision import PRECISIONS, apply_inference_precision
+from output_vocab import load_output_vocab
+from decode_step import DECODE_STEP_MODES, enable_decode_step
 from datasets import load_metric
 import nltk  # Here to have a nice missing dependency error message early on
 import numpy as np
@@ -65,6 +70,31 @@ os.environ["WANDB_DISABLED"] = "true"
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
+def check_itsp_tokens(tokenizer: PreTrainedTokenizerFast):
+    """
+    ITSP prompts need <label-sep> and <sent-sep> as added tokens; otherwise they are split into plain BPE pieces, and
+    decoding only fails deep inside utils.beam_search_sent
+    """
+    missing = [token for token in ["<label-sep>", "<sent-sep>"] if token not in tokenizer.get_added_vocab()]
+    if missing:
+        raise ValueError(f"--itsp needs the tokens {missing} in the tokenizer, load the tokenizer of a generation model trained with label prompts or run without --itsp")
+
+
+def get_itsp_prompts(text: str, tokenizer: PreTrainedTokenizerFast):
+    """
+    label prompts for inference-time structure prompting (ITSP), from the "label1 | label2 ==> source" input format:
+    returns (token ids of the first prompt, used as decoder prefix; [(token ids, prompt)] of the remaining prompts)
+    """
+    labels = [x.strip() for x in text.split(" ==> ")[0].split(" | ")]
+    prompts = ["<label-sep>"+label+"<sent-sep>" for label in labels]
+    label_prompt_ids = get_decoding_vocab(tokenizer).label_prompt_ids
+    prompt_ids = [
+        (list(label_prompt_ids[label]) if label in label_prompt_ids else tokenizer(prompt, add_special_tokens=False).input_ids, prompt)
+        for label, prompt in zip(labels, prompts)
+    ]
+    return prompt_ids[0][0], prompt_ids[1:]
+
+
 def generate_beam_search(
         text: str,
         model: PreTrainedModel,
@@ -75,22 +105,57 @@ def generate_beam_search(
         max_source_length: int = 2048,
         gen_target_min: int = 20,
         gen_target_max: int = 400,
+        itsp: bool = False,
 ):
+    return generate_beam_search_batch([text], model, tokenizer, num_beams=num_beams, max_source_length=max_source_length, gen_target_min=gen_target_min, gen_target_max=gen_target_max, itsp=itsp)[0]
+
+
+def generate_beam_search_batch(
+        texts: List[str],
+        model: PreTrainedModel,
+        tokenizer: PreTrainedTokenizerFast,
+        num_beams: int = 4,
+        max_source_length: int = 2048,
+        gen_target_min: int = 20,
+        gen_target_max: int = 400,
+        itsp: bool = False,
+        output_vocab: Optional[Tensor] = None,
+        static_kv_cache: bool = False,
+) -> List[str]:
+    """
+    beam search for a batch of sources, returns one text per source in the same order
+    with itsp, all texts must have first prompts of the same token length, as the first prompt is the decoder prefix
+    with output_vocab (see output_vocab.py), only those tokens and the source tokens of the batch can be generated
+    with static_kv_cache, the decoder caches into buffers preallocated for gen_target_max positions (see kv_cache.py)
+    """
     device = model.device
     # switch to evaluation mode
     model.eval()
-    # prepare source
-    encoder_input_ids = tokenizer(text,max_length=max_source_length,padding=False,truncation=True,return_tensors="pt").input_ids.to(device)
-    encoder_outputs = model.get_encoder()(encoder_input_ids, return_dict=True)
-    expanded_return_idx = (torch.arange(encoder_input_ids.shape[0]).view(-1, 1).repeat(1, num_beams).view(-1))
-    # instead of copy all states, only copy the hidden_states to save gpu space
-    encoder_outputs["last_hidden_state"] = encoder_outputs.last_hidden_state.index_select(0, expanded_return_idx.to(device))
-
-    model_kwargs = {"encoder_outputs": encoder_outputs,}
-    eos, bos = tokenizer.eos_token_id, tokenizer.bos_token_id
+    batch_size = len(texts)
+    # prepare source, padded to the longest in the batch
+    encoder_inputs = tokenizer(texts,max_length=max_source_length,padding=True,truncation=True,return_tensors="pt").to(device)
+    encoder_input_ids = encoder_inputs.input_ids
+    if output_vocab is not None:
+        model.set_output_vocab(torch.cat([output_vocab, encoder_input_ids.flatten()]))
+    encoder_outputs = model.get_encoder()(encoder_input_ids, attention_mask=encoder_inputs.attention_mask, return_dict=True)
+    expanded_return_idx = (torch.arange(batch_size).view(-1, 1).repeat(1, num_beams).view(-1)).to(device)
+    # SentBS: the encoder outputs are not copied per beam, the cross-attention of modeling_bart shares each source's
+    # states across its num_beams consecutive beams
+    model_kwargs = {"encoder_outputs": encoder_outputs, "attention_mask": encoder_inputs.attention_mask}
+    if static_kv_cache:
+        model_kwargs["decoder_static_cache_length"] = gen_target_max
+    decoding_vocab = get_decoding_vocab(tokenizer)
+    eos, bos = decoding_vocab.eos_token_id, decoding_vocab.bos_token_id
 
     assert model.config.model_type == "bart"
-    decoder_input_ids_base = torch.LongTensor([[model.config.decoder_start_token_id]]).to(device)
+    if itsp:
+        # SentBS: decoder starts with the first label prompt, the rest are inserted as sentences complete
+        itsp_prompts = [get_itsp_prompts(text, tokenizer) for text in texts]
+        assert len(set(len(prefix) for prefix, _ in itsp_prompts)) == 1, "first prompts of a batch must have the same length"
+        decoder_input_ids_base = torch.LongTensor([[model.config.decoder_start_token_id, bos] + prefix for prefix, _ in itsp_prompts]).to(device)
+        batch_prompt_ids = [prompt_ids for _, prompt_ids in itsp_prompts]
+    else:
+        decoder_input_ids_base = torch.LongTensor([[model.config.decoder_start_token_id]] * batch_size).to(device)
 
     # for original
     min_length = gen_target_min
@@ -99,32 +164,69 @@ def generate_beam_search(
     length_penalty = model.config.length_penalty # default is 2
     early_stopping = model.config.early_stopping # true
     num_return_sequences = model.config.num_return_sequences
-    beam_scorer = BeamSearchScorer(batch_size=1,num_beams=num_beams,device=device,length_penalty=length_penalty,do_early_stopping=early_stopping,num_beam_hyps_to_keep=num_return_sequences,)
+    beam_scorer = BeamSearchScorer(batch_size=batch_size,num_beams=num_beams,device=device,length_penalty=length_penalty,do_early_stopping=early_stopping,num_beam_hyps_to_keep=num_return_sequences,)
     stopping_criteria = StoppingCriteriaList()
     stopping_criteria.append(MaxLengthCriteria(max_length=max_length))
+    pad_token_id = model.config.pad_token_id if model.config.pad_token_id is not None else eos
 
     with torch.no_grad():
-        decoder_input_ids = decoder_input_ids_base.index_select(0, expanded_return_idx.to(device))
+        decoder_input_ids = decoder_input_ids_base.index_select(0, expanded_return_idx)
 
         # model.debug_count = 0 # DEBUG
-        outputs = beam_search(
-            model,
-            decoder_input_ids,
-            beam_scorer,
-            logits_processor=logits_processor,
-            stopping_criteria=stopping_criteria,
-            pad_token_id=model.config.pad_token_id if model.config.pad_token_id is not None else eos,
-            eos_token_id=eos,
-            return_dict_in_generate=model.config.return_dict_in_generate,
-            **model_kwargs,
-        )
+        if itsp:
+            outputs = beam_search_sent(
+                model,
+                tokenizer,
+                decoder_input_ids,
+                batch_prompt_ids,
+                beam_scorer,
+                logits_processor=logits_processor,
+                stopping_criteria=stopping_criteria,
+                pad_token_id=pad_token_id,
+                eos_token_id=eos,
+                return_dict_in_generate=model.config.return_dict_in_generate,
+                decoding_vocab=decoding_vocab,
+                **model_kwargs,
+            )
+        else:
+            outputs = beam_search(
+                model,
+                decoder_input_ids,
+                beam_scorer,
+                logits_processor=logits_processor,
+                stopping_criteria=stopping_criteria,
+                pad_token_id=pad_token_id,
+                eos_token_id=eos,
+                return_dict_in_generate=model.config.return_dict_in_generate,
+                **model_kwargs,
+            )
         if isinstance(outputs, BeamSearchEncoderDecoderOutput) or isinstance(outputs, BeamSearchDecoderOnlyOutput):
             outputs = outputs.sequences
-        assert outputs.dim() == 2 and outputs.size(0) == 1
+        assert outputs.dim() == 2 and outputs.size(0) == batch_size * num_return_sequences
+
+    # keep the top hypothesis of every example
+    texts = tokenizer.batch_decode(outputs[::num_return_sequences], skip_special_tokens=True, clean_up_tokenization_spaces=True)
+    return [text.strip() for text in texts]
+
+
+def get_predict_batches(text_list: List[str], tokenizer: PreTrainedTokenizerFast, batch_size: int, max_source_length: int, itsp: bool = False):
+    """
+    group example indices into batches of similar source length, so little compute is spent on padding
+    with itsp, examples are also grouped by the token length of their first prompt
+    """
+    source_lengths = [len(ids) for ids in tokenizer(text_list, max_length=max_source_length, truncation=True).input_ids]
+    prefix_lengths = [len(get_itsp_prompts(text, tokenizer)[0]) if itsp else 0 for text in text_list]
+    order = sorted(range(len(text_list)), key=lambda i: (prefix_lengths[i], -source_lengths[i]))
+    batches, batch = [], []
+    for i in order:
+        if len(batch) == batch_size or (len(batch) > 0 and prefix_lengths[batch[0]] != prefix_lengths[i]):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
 
-    text = tokenizer.batch_decode(outputs, skip_special_tokens=True, clean_up_tokenization_spaces=True)[0].strip()
-    loss = None
-    return text
 
 class DynamicModel(BaseModel):
     class Config:
@@ -151,6 +253,13 @@ class SummarizationModel(DynamicModel):
     eval_with_generate: bool = False
     eval_steps:int=500
     save_steps:int=500
+    group_by_length: bool = False
+    max_tokens_per_batch: int = 0
+    preprocessing_num_workers: int = 1
+    overwrite_cache: bool = False
+    streaming_eval: bool = False
+    proxy_eval: bool = False
+    metric_for_best_model: str = "eval_loss"
     # resume_from_checkpoint: str
 
     def run(self, *args, **kwargs):
@@ -183,10 +292,11 @@ class SummarizationModel(DynamicModel):
             eval_steps=self.eval_steps,
             save_steps=self.save_steps,
             load_best_model_at_end=True,
-            metric_for_best_model="eval_loss", 
-            greater_is_better=False,  # Set to true if using Rouge, False if using loss
+            metric_for_best_model=self.metric_for_best_model,
+            greater_is_better="loss" not in self.metric_for_best_model,  # Set to true if using Rouge, False if using loss
             learning_rate=self.learning_rate,
             num_train_epochs=self.get_epochs(),
+            group_by_length=self.group_by_length, # SCH: batches of similar source lengths, less padding
             # predict_with_generate=self.predict_with_generate, # Enable this to enable the calculation of rouge during validation
             predict_with_generate=self.eval_with_generate, # Enable this to enable the calculation of rouge during validation
             # resume_from_checkpoint=self.resume_from_checkpoint,
@@ -202,9 +312,13 @@ class SummarizationModel(DynamicModel):
         data_args = train_script.DataTrainingArguments(
             train_file=train_file,
             validation_file=validation_file,
-            overwrite_cache=True,
-            # max_target_length=self.gen_target_max,
+            overwrite_cache=self.overwrite_cache,
+            streaming_eval=self.streaming_eval,
+            proxy_eval=self.proxy_eval,
+            preprocessing_num_workers=self.preprocessing_num_workers if self.preprocessing_num_workers > 1 else None,
+            max_target_length=self.gen_target_max,
             max_source_length=self.max_source_length,
+            max_tokens_per_batch=self.max_tokens_per_batch if self.max_tokens_per_batch > 0 else None,
             max_train_samples=args.max_train_samples,
             max_eval_samples=args.max_eval_samples,
             text_column="text",
@@ -243,6 +357,13 @@ def main(args):
             eval_with_generate=args.eval_with_generate,
             eval_steps=args.eval_steps,
             save_steps=args.eval_steps,
+            group_by_length=args.group_by_length,
+            max_tokens_per_batch=args.max_tokens_per_batch,
+            preprocessing_num_workers=args.preprocessing_num_workers,
+            overwrite_cache=args.overwrite_cache,
+            streaming_eval=args.streaming_eval,
+            proxy_eval=args.proxy_eval,
+            metric_for_best_model=args.metric_for_best_model,
             # resume_from_checkpoint=args.resume_from_checkpoint,
         )
         model.fit(args.train_file, args.validation_file)
@@ -261,9 +382,10 @@ def main(args):
         if args.max_source_length > 1024:
             print("setting max position embedding:", args.max_source_length)
             config.max_position_embeddings = args.max_source_length
+        config.encoder_attention_window = args.encoder_attention_window # SentBS: see modeling_bart.BartAttention.local_global_attention
 
         print("using configuration:\n", config)
-        lm = AutoModelForSeq2SeqLM.from_pretrained(
+        lm = BartForConditionalGeneration.from_pretrained(
             args.output_dir if args.do_train else args.model_name_or_path, 
             # return_dict_in_generate=args.return_dict_in_generate, 
             config=config,
@@ -272,7 +394,13 @@ def main(args):
             args.output_dir if args.do_train else args.model_name_or_path, 
             use_fast=True, # use fast tokenizer
         ) 
+        if args.itsp:
+            check_itsp_tokens(tokenizer)
         lm.resize_token_embeddings(len(tokenizer))
+        lm.config.encoder_global_separator_ids = tokenizer(" ==>", add_special_tokens=False).input_ids
+        apply_inference_precision(lm.eval(), args.precision)
+        enable_decode_step(lm, args.decode_step)
+        output_vocab = load_output_vocab(args.output_vocab_file, device) if args.output_vocab_file else None
         
         df_test = pd.read_csv(args.test_file)
         df_test = df_test[['text', 'summary']]
@@ -289,12 +417,19 @@ def main(args):
         num_prediction_examples = len(text_list) if args.num_predict == -1 else min(args.num_predict, len(text_list))
         
         
-        for i in tqdm(range(num_prediction_examples)):
-            x, y = text_list[i], target_list[i]
-            output = generate_beam_search(x, lm, tokenizer, max_source_length=args.max_source_length, num_beams=args.num_beams, gen_target_min=args.gen_target_min, gen_target_max=args.gen_target_max)
-            raw_prediction_file.write(output.strip()+'\n')
-            raw_preds.append(output)
-            raw_golds.append(y)
+        predictions = [None] * num_prediction_examples
+        batches = get_predict_batches(text_list[:num_prediction_examples], tokenizer, args.predict_batch_size, args.max_source_length, itsp=args.itsp)
+        for batch in tqdm(batches):
+            outputs = generate_beam_search_batch([text_list[i] for i in batch], lm, tokenizer, max_source_length=args.max_source_length, num_beams=args.num_beams, gen_target_min=args.gen_target_min, gen_target_max=args.gen_target_max, itsp=args.itsp, output_vocab=output_vocab, static_kv_cache=args.static_kv_cache)
+            for i, output in zip(batch, outputs):
+                predictions[i] = output
+
+        # batches are length sorted, write back in the original order
+        for i in range(num_prediction_examples):
+            raw_prediction_file.write(predictions[i].strip()+'\n')
+            raw_preds.append(predictions[i])
+            raw_golds.append(target_list[i])
+        raw_prediction_file.close()
             
                 
 def parse_arguments(parser):
@@ -327,6 +462,10 @@ def parse_arguments(parser):
 
     parser.add_argument('--max_train_samples', type=int, default=None, help="deviec batch size for training")
     parser.add_argument('--max_eval_samples', type=int, default=None, help="deviec batch size for validation")
+    parser.add_argument('--preprocessing_num_workers', type=int, default=1, help="number of processes used to tokenize the train/validation files")
+    parser.add_argument('--overwrite_cache', action="store_true", default=False, help="Whether to re-tokenize the train/validation files instead of loading them from the tokenized cache")
+    parser.add_argument('--group_by_length', action="store_true", default=False, help="Whether to sample train batches of similar source lengths to reduce padding")
+    parser.add_argument('--max_tokens_per_batch', type=int, default=0, help="if > 0, train batches hold at most this many padded source + target tokens (overrides per_device_train_batch_size)")
 
     parser.add_argument('--gen_target_min', type=int, default=20, help="model minimun number of tokens for target")
     parser.add_argument('--gen_target_max', type=int, default=400, help="model maximum number of tokens for target")
@@ -339,6 +478,13 @@ def parse_arguments(parser):
     parser.add_argument('--num_beams', type=int, default=4, help="number of beams used for beam search")
     
     parser.add_argument('--num_predict', type=int, default=-1, help="number of test examples to run for prediction")
+    parser.add_argument('--predict_batch_size', type=int, default=1, help="number of test examples decoded together during prediction, batched by source length")
+    parser.add_argument('--itsp', action="store_true", default=False, help="Whether to insert the label prompts during prediction (inference-time structure prompting)")
+    parser.add_argument('--encoder_attention_window', type=int, default=0, help="if > 0, during prediction encoder tokens only attend to tokens at most this many positions away and to the label prompt (Longformer-style local + global attention); 0 for dense attention")
+    parser.add_argument('--precision', type=str, default="fp32", choices=PRECISIONS, help="inference precision of the generator: fp32, bf16 autocast, or dynamic int8 quantisation of the decoder and lm_head (CPU only)")
+    parser.add_argument('--output_vocab_file', type=str, default="", help="output vocabulary mined by output_vocab.py; if given, only its tokens and the source tokens can be generated, which shrinks the lm_head projection")
+    parser.add_argument('--static_kv_cache', action="store_true", default=False, help="Whether to cache decoder keys/values in buffers preallocated for gen_target_max positions instead of growing them every step")
+    parser.add_argument('--decode_step', type=str, default="none", choices=DECODE_STEP_MODES, help="how cached decoding steps run (needs --static_kv_cache): none for the full model forward, or the lean decode_step as is (eager), through torch.compile (compile), or traced with torch.jit.trace (trace)")
 
     parser.add_argument('--eval_steps', type=int, default=500, help="number of training steps to run evaluation")
 
@@ -347,6 +493,9 @@ def parse_arguments(parser):
     # deprecated, use eval_with_generate instead
     parser.add_argument('--predict_with_generate', action="store_true", default=False, help="Whether to use generate to calculate generative metrics (ROUGE, BLEU).")
     
+    parser.add_argument('--streaming_eval', action="store_true", default=False, help="With --eval_with_generate, score validation predictions batch by batch in a background thread instead of keeping them all in memory")
+    parser.add_argument('--proxy_eval', action="store_true", default=False, help="Without --eval_with_generate, also report the teacher-forced label prompt accuracy (prompt_acc, prompt_token_acc, token_acc) during evaluation")
+    parser.add_argument('--metric_for_best_model', type=str, default="eval_loss", help="metric used to select the best checkpoint, e.g. eval_loss, eval_rougeSum (--eval_with_generate) or eval_prompt_acc (--proxy_eval)")
     parser.add_argument('--eval_with_generate', action="store_true", default=False, help="Whether to use generate to calculate generative metrics (ROUGE, BLEU).")
 
     parser.add_argument('--return_dict_in_generate', type=bool, default=False, help="whether to return additional informations during genration")
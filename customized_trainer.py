@@ -170,7 +170,85 @@ logger = logging.get_logger(__name__)
 # deduct loss
 DEDUCT_LOSS = False # TODO: change the hard code of this var
 
+class TokenBudgetBatchSampler:
+    """
+    Batches of examples with similar lengths, each costing at most max_tokens padded tokens
+    (batch size * (longest source + longest target)); an example over the budget gets a batch of its own.
+    Batches are built once over the length-sorted dataset, so the number of batches is the same every epoch,
+    and their order is reshuffled on every iteration (seeded by seed + epoch).
+    In distributed training, each process takes every num_replicas-th batch.
+    """
+    def __init__(self, source_lengths: List[int], target_lengths: List[int], max_tokens: int, seed: int = 42, shuffle: bool = True, num_replicas: int = 1, rank: int = 0):
+        self.max_tokens = max_tokens
+        self.seed = seed
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        order = sorted(range(len(source_lengths)), key=lambda i: (source_lengths[i], target_lengths[i]))
+        self.batches = []
+        batch, max_source, max_target = [], 0, 0
+        for idx in order:
+            new_max_source, new_max_target = max(max_source, source_lengths[idx]), max(max_target, target_lengths[idx])
+            if len(batch) > 0 and (len(batch) + 1) * (new_max_source + new_max_target) > max_tokens:
+                self.batches.append(batch)
+                batch, new_max_source, new_max_target = [], source_lengths[idx], target_lengths[idx]
+            batch.append(idx)
+            max_source, max_target = new_max_source, new_max_target
+        if len(batch) > 0:
+            self.batches.append(batch)
+
+    def __iter__(self):
+        batches = self.batches
+        if self.shuffle:
+            rng = random.Random(self.seed + self.epoch)
+            batches = batches[:]
+            rng.shuffle(batches)
+        self.epoch += 1
+        # every process needs the same number of batches
+        num_batches = len(self) * self.num_replicas
+        return iter(batches[self.rank:num_batches:self.num_replicas])
+
+    def __len__(self):
+        return len(self.batches) // self.num_replicas
+
+
 class MyTrainer(Seq2SeqTrainer):
+    def __init__(self, *args, max_tokens_per_batch: Optional[int] = None, streaming_metrics_fn: Optional[Callable] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_tokens_per_batch = max_tokens_per_batch # SCH: token budget batching of the train set, None to use per_device_train_batch_size
+        # SCH: returns a fresh metric with add_batch(preds, labels) / compute() for each evaluation; if set, predictions are
+        # scored batch by batch instead of being kept for compute_metrics. Metrics with `teacher_forced = True` get the
+        # argmax of the loss forward logits instead of generated ids (see streaming_eval.py)
+        self.streaming_metrics_fn = streaming_metrics_fn
+
+    def get_train_dataloader(self) -> DataLoader:
+        if not self.max_tokens_per_batch:
+            return super().get_train_dataloader()
+        if self.train_dataset is None:
+            raise ValueError("Trainer: training requires a train_dataset.")
+
+        train_dataset = self.train_dataset
+        if is_datasets_available() and isinstance(train_dataset, datasets.Dataset):
+            train_dataset = self._remove_unused_columns(train_dataset, description="training")
+        batch_sampler = TokenBudgetBatchSampler(
+            [len(ids) for ids in train_dataset["input_ids"]],
+            [len(ids) for ids in train_dataset["labels"]],
+            self.max_tokens_per_batch,
+            seed=self.args.seed,
+            num_replicas=self.args.world_size,
+            rank=self.args.process_index,
+        )
+        print("token budget batching: {} train examples in {} batches per process".format(len(train_dataset), len(batch_sampler)))
+        return DataLoader(
+            train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
     # This debugs issue of sometimes deleting newest stored model
     def _sorted_checkpoints(
         self, output_dir=None, checkpoint_prefix=PREFIX_CHECKPOINT_DIR, use_mtime=False
@@ -267,6 +345,17 @@ class MyTrainer(Seq2SeqTrainer):
             if self.args.past_index >= 0:
                 self._past = None
 
+            # SCH: streaming metrics, predictions and labels are scored and dropped batch by batch
+            streaming_metrics = self.streaming_metrics_fn() if self.streaming_metrics_fn is not None else None
+            teacher_forced = getattr(streaming_metrics, "teacher_forced", False)
+            if teacher_forced:
+                prediction_loss_only = False # the logits of the loss forward are needed
+            elif prediction_loss_only:
+                streaming_metrics = None
+            # padded examples of distributed samplers are dropped as in the non-streaming truncation below
+            num_streaming_samples = len(eval_dataset) if not isinstance(eval_dataset, IterableDataset) else None
+            num_streamed = 0
+
             # Initialize containers
             # losses/preds/labels on GPU/TPU (accumulated for eval_accumulation_steps)
             losses_host = None
@@ -294,6 +383,18 @@ class MyTrainer(Seq2SeqTrainer):
                 if loss is not None:
                     losses = self._nested_gather(loss.repeat(batch_size))
                     losses_host = losses if losses_host is None else torch.cat((losses_host, losses), dim=0)
+                if streaming_metrics is not None and logits is not None and labels is not None:
+                    if teacher_forced:
+                        # only the argmax ids of the teacher-forced logits are kept, [batch, tgt_len] like labels
+                        logits = (logits[0] if isinstance(logits, (tuple, list)) else logits).argmax(dim=-1)
+                    logits = nested_numpify(self._nested_gather(self._pad_across_processes(logits)))
+                    labels = nested_numpify(self._nested_gather(self._pad_across_processes(labels)))
+                    if num_streaming_samples is not None:
+                        logits, labels = logits[:num_streaming_samples - num_streamed], labels[:num_streaming_samples - num_streamed]
+                    num_streamed += len(logits)
+                    if len(logits) > 0:
+                        streaming_metrics.add_batch(logits, labels)
+                    logits, labels = None, None
                 if logits is not None:
                     logits = self._pad_across_processes(logits)
                     logits = self._nested_gather(logits)
@@ -354,7 +455,9 @@ class MyTrainer(Seq2SeqTrainer):
                 all_labels = nested_truncate(all_labels, num_samples)
 
             # Metrics!
-            if self.compute_metrics is not None and all_preds is not None and all_labels is not None:
+            if streaming_metrics is not None:
+                metrics = streaming_metrics.compute()
+            elif self.compute_metrics is not None and all_preds is not None and all_labels is not None:
                 metrics = self.compute_metrics(EvalPrediction(predictions=all_preds, label_ids=all_labels))
             else:
                 metrics = {}
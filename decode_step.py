@@ -0,0 +1,70 @@
+from typing import Dict, Tuple
+
+import torch
+from torch import nn
+
+
+# none: every step runs the full BartForConditionalGeneration.forward; eager / compile / trace: the cached steps of a
+# StaticKVCache run BartForConditionalGeneration.decode_step, with the decoder part as is, through torch.compile, or
+# traced with torch.jit.trace
+DECODE_STEP_MODES = ["none", "eager", "compile", "trace"]
+
+
+class _DecoderStep(nn.Module):
+    """
+    BartDecoder.decode_step as the forward of a module, for torch.jit.trace
+    """
+    def __init__(self, decoder: nn.Module):
+        super().__init__()
+        self.decoder = decoder
+
+    def forward(self, input_ids, positions, self_attn_key_values, cross_attn_key_values, self_attn_key_mask, encoder_attention_bias):
+        return self.decoder.decode_step(input_ids, positions, self_attn_key_values, cross_attn_key_values, self_attn_key_mask, encoder_attention_bias)
+
+
+class TracedDecoderStep:
+    """
+    BartDecoder.decode_step traced with torch.jit.trace on its first call for every new combination of input shapes
+    (batch size, number of new tokens, cache length, number of sources and source length), so a decoding call of
+    fixed beam size is traced once for its prompt and once for its single token steps.
+    Traces are recorded under torch.no_grad and in the autocast state of their first call.
+    """
+    def __init__(self, decoder: nn.Module, max_traces: int = 16):
+        self.module = _DecoderStep(decoder)
+        self.max_traces = max_traces
+        self.traces: Dict[Tuple, torch.jit.ScriptModule] = {}
+
+    def __call__(self, *inputs):
+        shapes = tuple(tuple(x.shape) for x in [inputs[0], inputs[2][0][0], inputs[3][0][0]])
+        trace = self.traces.get(shapes)
+        if trace is None:
+            if len(self.traces) >= self.max_traces: # e.g. one source length per example, keep the latest traces
+                self.traces.pop(next(iter(self.traces)))
+            with torch.no_grad():
+                trace = torch.jit.trace(self.module, inputs, check_trace=False)
+            self.traces[shapes] = trace
+        return trace(*inputs)
+
+
+def enable_decode_step(model: nn.Module, mode: str) -> nn.Module:
+    """
+    let a (local modeling_bart) BartForConditionalGeneration run its cached decoding steps through decode_step, in
+    place. Only steps on a StaticKVCache (decoder_static_cache_length / --static_kv_cache) take this path.
+    Call after apply_inference_precision.
+    """
+    if mode not in DECODE_STEP_MODES:
+        raise ValueError(f"decode step mode should be one of {DECODE_STEP_MODES}, got {mode}")
+    decoder = model.get_decoder()
+    if mode == "none":
+        model.decoder_step_fn = None
+    elif mode == "eager":
+        model.decoder_step_fn = decoder.decode_step
+    elif mode == "compile":
+        if not hasattr(torch, "compile"):
+            raise ValueError("torch.compile needs torch>=2.0, use --decode_step trace instead")
+        # static shapes: the cache buffers keep their size, so one graph per beam size / source length
+        model.decoder_step_fn = torch.compile(decoder.decode_step, dynamic=False)
+    else:
+        model.decoder_step_fn = TracedDecoderStep(decoder)
+    print("decode step:", mode)
+    return model
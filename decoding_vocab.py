@@ -0,0 +1,124 @@
+import weakref
+from dataclasses import dataclass
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, FrozenSet, List, Mapping, Optional, Tuple
+
+import torch
+from transformers import PreTrainedTokenizerBase
+
+
+# labels used as control prompts for MReD, see labels2idx in the decoding scripts
+MRED_LABELS = ["abstract", "strength", "weakness", "suggestion", "ac_disagreement", "rebuttal_process", "rating_summary", "decision", "misc"]
+
+# last characters that can end a text for which is_sent_complete returns True: ";", "." (optionally followed by '"', a space
+# or ")"), '?"', '!"', "meta score: [0-9]" and "Dear authors,"
+TERMINATOR_CHARS = frozenset(';."?!),0123456789')
+
+
+@lru_cache(maxsize=None)
+def bytes_to_unicode() -> Dict[int, str]:
+    """
+    the byte <-> printable unicode character mapping of byte-level BPE (GPT-2, RoBERTa, BART)
+    """
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(2**8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2**8 + n)
+            n += 1
+    return dict(zip(bs, [chr(c) for c in cs]))
+
+
+@dataclass(frozen=True, eq=False)
+class DecodingVocab:
+    """
+    Read-only token id tables of a tokenizer, built once (see `get_decoding_vocab`) and shared by all decoding paths
+    so that hot loops do not go through tokenizer attribute lookups or `convert_tokens_to_ids`.
+    `terminator_ids` / `terminator_mask` hold every token after which `is_sent_complete` can possibly be True
+    (conservatively: tokens whose text ends with a terminator character or whitespace, special and added tokens, and
+    partial utf-8 tokens), so the decode + regex check can be skipped for all other tokens.
+    """
+    pad_token_id: int
+    eos_token_id: int
+    bos_token_id: Optional[int]
+    label_sep_id: Optional[int] # <label-sep>, None if the tokenizer has no such token
+    sent_sep_id: Optional[int] # <sent-sep>
+    special_ids: FrozenSet[int] # ids removed by skip_special_tokens=True
+    added_ids: FrozenSet[int] # special and added tokens, which are not byte-level encoded
+    id_to_token: Tuple[str, ...]
+    id_to_bytes: Tuple[bytes, ...] # the utf-8 bytes each id contributes to the decoded text
+    terminator_ids: FrozenSet[int]
+    terminator_mask: torch.BoolTensor # [vocab_size], True for terminator_ids
+    label_prompt_ids: Mapping[str, Tuple[int, ...]] # label -> ids of "<label-sep>label<sent-sep>"
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer: PreTrainedTokenizerBase, labels: Optional[List[str]] = None):
+        vocab_size = len(tokenizer)
+        id_to_token = tuple(tokenizer.convert_ids_to_tokens(list(range(vocab_size))))
+        added_ids = frozenset(tokenizer.all_special_ids) | frozenset(tokenizer.get_added_vocab().values())
+
+        byte_decoder = {c: b for b, c in bytes_to_unicode().items()}
+        id_to_bytes = []
+        for token_id, token in enumerate(id_to_token):
+            if token is None:
+                id_to_bytes.append(b"")
+            elif token_id in added_ids or any(c not in byte_decoder for c in token):
+                id_to_bytes.append(token.encode("utf-8"))
+            else:
+                id_to_bytes.append(bytes(byte_decoder[c] for c in token))
+
+        terminator_ids = set(added_ids)
+        for token_id, token_bytes in enumerate(id_to_bytes):
+            text = token_bytes.decode("utf-8", errors="replace")
+            if text == "" or "\ufffd" in text or text[-1] in TERMINATOR_CHARS or text[-1].isspace():
+                terminator_ids.add(token_id)
+        terminator_mask = torch.zeros(vocab_size, dtype=torch.bool)
+        terminator_mask[list(terminator_ids)] = True
+
+        def get_token_id(token):
+            token_id = tokenizer.convert_tokens_to_ids(token)
+            return token_id if token_id != tokenizer.unk_token_id else None
+
+        label_sep_id, sent_sep_id = get_token_id("<label-sep>"), get_token_id("<sent-sep>")
+        label_prompt_ids = {}
+        if label_sep_id is not None and sent_sep_id is not None:
+            for label in (labels if labels is not None else MRED_LABELS):
+                label_prompt_ids[label] = tuple(tokenizer("<label-sep>"+label+"<sent-sep>", add_special_tokens=False).input_ids)
+
+        return cls(
+            pad_token_id=tokenizer.pad_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            bos_token_id=tokenizer.bos_token_id,
+            label_sep_id=label_sep_id,
+            sent_sep_id=sent_sep_id,
+            special_ids=frozenset(tokenizer.all_special_ids),
+            added_ids=added_ids,
+            id_to_token=id_to_token,
+            id_to_bytes=tuple(id_to_bytes),
+            terminator_ids=frozenset(terminator_ids),
+            terminator_mask=terminator_mask,
+            label_prompt_ids=MappingProxyType(label_prompt_ids),
+        )
+
+    def may_end_sentence(self, token_id: int) -> bool:
+        """
+        False if a text ending with token_id can not be a complete sentence for is_sent_complete
+        """
+        return token_id in self.terminator_ids
+
+
+_DECODING_VOCABS = weakref.WeakKeyDictionary()
+
+def get_decoding_vocab(tokenizer: PreTrainedTokenizerBase) -> DecodingVocab:
+    """
+    the DecodingVocab of tokenizer, built on first use and cached for the lifetime of the tokenizer
+    NOTE: tokens added to the tokenizer afterwards are not reflected
+    """
+    vocab = _DECODING_VOCABS.get(tokenizer)
+    if vocab is None:
+        vocab = DecodingVocab.from_tokenizer(tokenizer)
+        _DECODING_VOCABS[tokenizer] = vocab
+    return vocab
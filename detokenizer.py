@@ -0,0 +1,106 @@
+import codecs
+from typing import Iterable, Optional
+
+from decoding_vocab import DecodingVocab
+
+
+# PreTrainedTokenizerBase.clean_up_tokenization, applied in this order
+CLEAN_UP_REPLACEMENTS = [(" .", "."), (" ?", "?"), (" !", "!"), (" ,", ","), (" ' ", "'"), (" n't", "n't"), (" 'm", "'m"), (" 's", "'s"), (" 've", "'ve"), (" 're", "'re")]
+
+# every clean up match only spans characters from this set, and only removes spaces
+CLEAN_UP_CHARS = frozenset("".join(pattern for pattern, _ in CLEAN_UP_REPLACEMENTS))
+
+
+def clean_up_tokenization(text: str) -> str:
+    for pattern, replacement in CLEAN_UP_REPLACEMENTS:
+        text = text.replace(pattern, replacement)
+    return text
+
+
+class IncrementalDetokenizer:
+    """
+    Keeps the text of a growing byte-level BPE (BART) token sequence up to date, one token at a time.
+    `text` equals `tokenizer.decode(token_ids, skip_special_tokens=..., clean_up_tokenization_spaces=...)`:
+    the bytes of each id are looked up in `DecodingVocab.id_to_bytes` and fed to an incremental utf-8 decoder (a
+    character split over several tokens is held back until it is complete, and shown as U+FFFD meanwhile, as decode
+    does), and the clean up is only re-run on the text after the last position no clean up pattern can cross.
+    Beams share history through `fork`, which is cheap since the decoded text is an immutable string.
+    """
+    __slots__ = ("vocab", "skip_special_tokens", "clean_up_tokenization_spaces", "num_tokens", "_decoder", "_raw", "_clean_prefix", "_clean_pos")
+
+    def __init__(self, vocab: DecodingVocab, token_ids: Optional[Iterable[int]] = None, skip_special_tokens: bool = True, clean_up_tokenization_spaces: bool = True):
+        self.vocab = vocab
+        self.skip_special_tokens = skip_special_tokens
+        self.clean_up_tokenization_spaces = clean_up_tokenization_spaces
+        self.num_tokens = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._raw = "" # decoded text before clean up, without the pending bytes of an incomplete character
+        self._clean_prefix = "" # clean up of self._raw[:self._clean_pos]
+        self._clean_pos = 0
+        if token_ids is not None:
+            self.extend(token_ids)
+
+    def append(self, token_id: int):
+        self.num_tokens += 1
+        if self.skip_special_tokens and token_id in self.vocab.special_ids:
+            return
+        chunk = self._decoder.decode(self.vocab.id_to_bytes[token_id])
+        if chunk:
+            self._raw += chunk
+            if self.clean_up_tokenization_spaces:
+                self._advance_clean_prefix()
+
+    def extend(self, token_ids: Iterable[int]):
+        if hasattr(token_ids, "tolist"): # torch.Tensor
+            token_ids = token_ids.tolist()
+        special_ids = self.vocab.special_ids if self.skip_special_tokens else ()
+        id_to_bytes = self.vocab.id_to_bytes
+        token_ids = list(token_ids)
+        self.num_tokens += len(token_ids)
+        chunk = self._decoder.decode(b"".join(id_to_bytes[token_id] for token_id in token_ids if token_id not in special_ids))
+        if chunk:
+            self._raw += chunk
+            if self.clean_up_tokenization_spaces:
+                self._advance_clean_prefix()
+
+    def _advance_clean_prefix(self):
+        # a clean up match covers two adjacent non-space characters only if both are in CLEAN_UP_CHARS, and spaces are the
+        # only characters it removes; so the clean up of the text splits between any such pair with one character outside
+        raw = self._raw
+        for pos in range(len(raw) - 1, self._clean_pos, -1):
+            prev_char, char = raw[pos - 1], raw[pos]
+            if prev_char != " " and char != " " and (prev_char not in CLEAN_UP_CHARS or char not in CLEAN_UP_CHARS):
+                self._clean_prefix += clean_up_tokenization(raw[self._clean_pos:pos])
+                self._clean_pos = pos
+                return
+
+    @property
+    def text(self) -> str:
+        pending, _ = self._decoder.getstate()
+        pending_text = pending.decode("utf-8", errors="replace") if pending else ""
+        if not self.clean_up_tokenization_spaces:
+            return self._raw + pending_text
+        return self._clean_prefix + clean_up_tokenization(self._raw[self._clean_pos:] + pending_text)
+
+    def fork(self) -> "IncrementalDetokenizer":
+        other = IncrementalDetokenizer.__new__(IncrementalDetokenizer)
+        other.vocab = self.vocab
+        other.skip_special_tokens = self.skip_special_tokens
+        other.clean_up_tokenization_spaces = self.clean_up_tokenization_spaces
+        other.num_tokens = self.num_tokens
+        other._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        other._decoder.setstate(self._decoder.getstate())
+        other._raw = self._raw
+        other._clean_prefix = self._clean_prefix
+        other._clean_pos = self._clean_pos
+        return other
+
+    def __len__(self):
+        return self.num_tokens
+
+
+def fast_decode(vocab: DecodingVocab, token_ids: Iterable[int], skip_special_tokens: bool = True, clean_up_tokenization_spaces: bool = True) -> str:
+    """
+    drop-in for `tokenizer.decode(token_ids, skip_special_tokens, clean_up_tokenization_spaces)` using the byte tables of vocab
+    """
+    return IncrementalDetokenizer(vocab, token_ids, skip_special_tokens=skip_special_tokens, clean_up_tokenization_spaces=clean_up_tokenization_spaces).text
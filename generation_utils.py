@@ -49,6 +49,8 @@ from transformers.generation_stopping_criteria import (
     validate_stopping_criteria,
 )
 from transformers.utils import logging
+from profiler import PROFILER
+from speculative import verify_beam_drafts, advance_beam_drafts
 
 
 logger = logging.get_logger(__name__)
@@ -571,15 +573,20 @@ class GenerationMixin:
             token_type_ids = model_kwargs["token_type_ids"]
             model_kwargs["token_type_ids"] = token_type_ids.index_select(0, expanded_return_idx)
 
+        # SentBS: with `cross_attn_broadcast=True`, the encoder outputs and mask keep one row per source, which the
+        # cross-attention of modeling_bart.BartAttention shares across the expand_size lanes of that source
+        cross_attn_broadcast = model_kwargs.pop("cross_attn_broadcast", False) and is_encoder_decoder
+
         if attention_mask is not None:
-            model_kwargs["attention_mask"] = attention_mask.index_select(0, expanded_return_idx)
+            model_kwargs["attention_mask"] = attention_mask if cross_attn_broadcast else attention_mask.index_select(0, expanded_return_idx)
 
         if is_encoder_decoder:
             if encoder_outputs is None:
                 raise ValueError("If `is_encoder_decoder` is True, make sure that `encoder_outputs` is defined.")
-            encoder_outputs["last_hidden_state"] = encoder_outputs.last_hidden_state.index_select(
-                0, expanded_return_idx.to(encoder_outputs.last_hidden_state.device)
-            )
+            if not cross_attn_broadcast:
+                encoder_outputs["last_hidden_state"] = encoder_outputs.last_hidden_state.index_select(
+                    0, expanded_return_idx.to(encoder_outputs.last_hidden_state.device)
+                )
             model_kwargs["encoder_outputs"] = encoder_outputs
         return input_ids, model_kwargs
 
@@ -1088,9 +1095,10 @@ class GenerationMixin:
         if self.config.is_encoder_decoder and "encoder_outputs" not in model_kwargs:
             # if model is encoder decoder encoder_outputs are created
             # and added to `model_kwargs`
-            model_kwargs = self._prepare_encoder_decoder_kwargs_for_generation(
-                inputs_tensor, model_kwargs, model_input_name
-            )
+            with PROFILER.timed("encoder"): # SentBS: profiling
+                model_kwargs = self._prepare_encoder_decoder_kwargs_for_generation(
+                    inputs_tensor, model_kwargs, model_input_name
+                )
 
         # 4. Prepare `input_ids` which will be used for auto-regressive generation
         if self.config.is_encoder_decoder:
@@ -1975,6 +1983,13 @@ class GenerationMixin:
         gen_mode = model_kwargs.pop("gen_mode") if "gen_mode" in model_kwargs else None
         init_beam_scores = model_kwargs.pop("init_beam_scores") if "init_beam_scores" in model_kwargs else None
 
+        # SentBS: speculative decoding with a draft model attached as `self.drafter`, see speculative.verify_beam_drafts
+        drafter = getattr(self, "drafter", None)
+        use_drafter = drafter is not None and not synced_gpus and not output_attentions and not output_hidden_states
+        drafts = None # the current speculative round
+        if use_drafter:
+            drafter.reset()
+
         while True:
 
             if synced_gpus:
@@ -1987,21 +2002,27 @@ class GenerationMixin:
                 if this_peer_finished_flag.item() == 0.0:
                     break
 
-            model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
-            # if past is used, only take the last input token for model_inputs["input_ids"]
-            
-            outputs = self(
-                **model_inputs,
-                return_dict=True,
-                output_attentions=output_attentions,
-                output_hidden_states=output_hidden_states,
-            )
+            if use_drafter:
+                # SentBS: the generator logits of the drafted paths, verified for the whole round in one forward
+                if drafts is None:
+                    drafts = verify_beam_drafts(self, drafter, input_ids, logits_processor, stopping_criteria, model_kwargs)
+                next_token_logits = drafts.next_token_logits()
+            else:
+                model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
+                # if past is used, only take the last input token for model_inputs["input_ids"]
+                
+                outputs = self(
+                    **model_inputs,
+                    return_dict=True,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                )
 
-            if synced_gpus and this_peer_finished:
-                cur_len = cur_len + 1
-                continue  # don't waste resources running the code we don't need
+                if synced_gpus and this_peer_finished:
+                    cur_len = cur_len + 1
+                    continue  # don't waste resources running the code we don't need
 
-            next_token_logits = outputs.logits[:, -1, :] # outputs.logits (batch_size, seq, vocab_size)
+                next_token_logits = outputs.logits[:, -1, :] # outputs.logits (batch_size, seq, vocab_size)
             # hack: adjust tokens for Marian. For Marian we have to make sure that the `pad_token_id`
             # cannot be generated both before and after the `nn.functional.log_softmax` operation.
             next_token_logits = self.adjust_logits_during_generation(next_token_logits, cur_len=cur_len)
@@ -2058,11 +2079,14 @@ class GenerationMixin:
             input_ids = torch.cat([input_ids[beam_idx, :], beam_next_tokens.unsqueeze(-1)], dim=-1)
 
 
-            model_kwargs = self._update_model_kwargs_for_generation(
-                outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
-            )
-            if model_kwargs["past"] is not None:
-                model_kwargs["past"] = self._reorder_cache(model_kwargs["past"], beam_idx)
+            if use_drafter:
+                drafts = advance_beam_drafts(self, drafter, drafts, beam_idx, beam_next_tokens, cur_len, model_kwargs)
+            else:
+                model_kwargs = self._update_model_kwargs_for_generation(
+                    outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
+                )
+                if model_kwargs["past"] is not None:
+                    model_kwargs["past"] = self._reorder_cache(model_kwargs["past"], beam_idx)
 
             if return_dict_in_generate and output_scores:
                 beam_indices = tuple((beam_indices[beam_idx[i]] + (beam_idx[i],) for i in range(len(beam_indices)))) # add the new beam_index to chains of beam_index for each sequence
@@ -0,0 +1,72 @@
+import functools
+from contextlib import nullcontext
+
+import torch
+from torch import nn
+
+
+# fp32: unchanged; bf16: bfloat16 autocast of the forward passes; int8: dynamic int8 quantisation of the decoder
+# Linear layers and the lm_head (CPU only, the encoder runs once per source and stays in fp32)
+PRECISIONS = ["fp32", "bf16", "int8"]
+
+
+def cpu_supports_bf16() -> bool:
+    """
+    whether the CPU has native bf16 instructions (AVX512-BF16 / AMX); without them bf16 autocast still works
+    through oneDNN but is usually slower than fp32
+    """
+    is_supported = getattr(torch.cpu, "_is_avx512_bf16_supported", None)
+    if is_supported is not None:
+        return is_supported()
+    try:
+        with open("/proc/cpuinfo") as fr:
+            flags = fr.read()
+        return "avx512_bf16" in flags or "amx_bf16" in flags
+    except OSError:
+        return False
+
+
+def get_autocast_context(precision: str, device: torch.device):
+    if precision != "bf16":
+        return nullcontext()
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+
+
+def _autocast_forward(forward, device: torch.device):
+    @functools.wraps(forward)
+    def wrapped_forward(*args, **kwargs):
+        with get_autocast_context("bf16", device):
+            outputs = forward(*args, **kwargs)
+        # SentBS: logits processors / warpers (top-p, repetition penalty, ...) and the log-prob sums stay in fp32, and
+        # encoder outputs can be fed to fp32 modules outside autocast (e.g. precompute_cross_attention_kv)
+        for key in ["logits", "last_hidden_state"]:
+            if getattr(outputs, key, None) is not None:
+                outputs[key] = outputs[key].float()
+        return outputs
+    return wrapped_forward
+
+
+def apply_inference_precision(model: nn.Module, precision: str) -> nn.Module:
+    """
+    set up a (local modeling_bart) BartForConditionalGeneration in eval mode for inference in precision, in place.
+    Call after `resize_token_embeddings`: int8 replaces the lm_head by a quantised copy, untied from the embeddings.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision should be one of {PRECISIONS}, got {precision}")
+    device = model.device
+    if precision == "int8":
+        if device.type != "cpu":
+            raise ValueError("int8 dynamic quantisation is only supported on CPU, got device " + str(device))
+        qconfig = torch.quantization.default_dynamic_qconfig
+        torch.quantization.quantize_dynamic(model, {"model.decoder": qconfig, "lm_head": qconfig}, dtype=torch.qint8, inplace=True)
+    elif precision == "bf16":
+        if device.type == "cpu" and not cpu_supports_bf16():
+            print("WARNING: this CPU has no native bf16 support, bf16 autocast may be slower than fp32")
+        elif device.type == "cuda" and not torch.cuda.is_bf16_supported():
+            raise ValueError("bf16 is not supported on this GPU")
+        # the scripts call the model and its encoder directly, so both forwards run under autocast
+        model.forward = _autocast_forward(model.forward, device)
+        encoder = model.get_encoder()
+        encoder.forward = _autocast_forward(encoder.forward, device)
+    print("inference precision:", precision)
+    return model
@@ -0,0 +1,137 @@
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import torch
+
+
+class StaticKVCache:
+    """
+    Preallocated decoder cache, passed around as `past_key_values` / `past` in place of the tuple of per layer
+    (self K, self V, cross K, cross V). Self-attention K/V of every layer live in [batch, num_heads, max_length,
+    head_dim] buffers that new positions are written into, instead of being concatenated on every step; beam
+    reordering gathers into a second set of buffers and swaps, so no step allocates cache memory. Cross-attention K/V
+    are computed once and never reordered, as in `BartForConditionalGeneration._reorder_cache`.
+    Taken from the decoder's StaticKVCachePool on the first step of a decoding call given
+    `decoder_static_cache_length`, so the buffers are reused by the following calls of the same shape.
+    """
+    def __init__(self, num_layers: int, batch_size: int, num_heads: int, max_length: int, head_dim: int, dtype: torch.dtype, device: torch.device):
+        shape = (batch_size, num_heads, max_length, head_dim)
+        # zero-filled once per StaticKVCachePool entry: BartDecoder.decode_step attends over the whole buffers with
+        # the unwritten positions masked out, which still needs them finite (uninitialised memory may hold nan / inf)
+        self.keys = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.values = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.spare_keys: Optional[List[torch.Tensor]] = None # allocated on the first reorder
+        self.spare_values: Optional[List[torch.Tensor]] = None
+        self.cross_attn_key_values: List[Optional[Tuple[torch.Tensor, torch.Tensor]]] = [None] * num_layers
+        self.layers = [StaticKVCacheLayer(self, layer_idx) for layer_idx in range(num_layers)]
+        self.max_length = max_length
+        self.length = 0 # number of cached positions, the same for every lane
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __getitem__(self, layer_idx: int) -> "StaticKVCacheLayer":
+        return self.layers[layer_idx]
+
+    def update(self, layer_idx: int, key_states: torch.Tensor, value_states: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        write the K/V of the new positions [batch, num_heads, num_new, head_dim] after the cached ones, and return
+        views of all K/V so far; the positions only count as cached after `advance`
+        """
+        start, end = self.length, self.length + key_states.size(2)
+        if end > self.max_length:
+            raise ValueError(f"static kv cache of length {self.max_length} is full, decoding reached length {end}")
+        self.keys[layer_idx][:, :, start:end].copy_(key_states)
+        self.values[layer_idx][:, :, start:end].copy_(value_states)
+        return self.keys[layer_idx][:, :, :end], self.values[layer_idx][:, :, :end]
+
+    def reset(self) -> "StaticKVCache":
+        # empty the cache for a new decoding call, keeping its buffers
+        self.length = 0
+        self.cross_attn_key_values = [None] * len(self.layers)
+        return self
+
+    def advance(self, num_positions: int):
+        self.length += num_positions
+
+    def truncate(self, length: int) -> "StaticKVCache":
+        """
+        drop the cached positions from length on (e.g. rejected speculative tokens); they are overwritten by the next
+        positions written
+        """
+        self.length = min(self.length, length)
+        return self
+
+    def reorder(self, beam_idx: torch.LongTensor) -> "StaticKVCache":
+        if torch.equal(beam_idx, torch.arange(beam_idx.size(0), device=beam_idx.device)):
+            return self
+        if self.spare_keys is None:
+            self.spare_keys = [torch.zeros_like(buffer) for buffer in self.keys]
+            self.spare_values = [torch.zeros_like(buffer) for buffer in self.values]
+        # only the cached positions, the rest of the buffers is masked until written
+        for buffers, spare_buffers in [(self.keys, self.spare_keys), (self.values, self.spare_values)]:
+            for buffer, spare_buffer in zip(buffers, spare_buffers):
+                torch.index_select(buffer[:, :, :self.length], 0, beam_idx, out=spare_buffer[:, :, :self.length])
+        self.keys, self.spare_keys = self.spare_keys, self.keys
+        self.values, self.spare_values = self.spare_values, self.values
+        return self
+
+
+class StaticKVCachePool:
+    """
+    the StaticKVCaches of one decoder, kept across decoding calls: SentBS runs many short `generate` calls per
+    example, which would otherwise allocate new buffers for every call. Keyed by everything that shapes the buffers
+    (number of lanes, length, dtype, device); the least recently used caches beyond max_caches are dropped.
+    """
+    def __init__(self, max_caches: int = 4):
+        self.max_caches = max_caches
+        self.caches: "OrderedDict[Tuple, StaticKVCache]" = OrderedDict()
+
+    def get(self, num_layers: int, batch_size: int, num_heads: int, max_length: int, head_dim: int, dtype: torch.dtype, device: torch.device) -> StaticKVCache:
+        """
+        an empty StaticKVCache for a new decoding call; the one returned by the previous call of the same shape must
+        not be in use anymore
+        """
+        key = (num_layers, batch_size, num_heads, max_length, head_dim, dtype, torch.device(device))
+        cache = self.caches.pop(key, None)
+        if cache is None:
+            while len(self.caches) >= self.max_caches: # free the buffers before allocating new ones
+                self.caches.popitem(last=False)
+            cache = StaticKVCache(num_layers, batch_size, num_heads, max_length, head_dim, dtype, device)
+        self.caches[key] = cache
+        return cache.reset()
+
+    def clear(self):
+        self.caches.clear()
+
+
+class StaticKVCacheLayer:
+    """
+    the view of one decoder layer on a StaticKVCache, passed to the layer as its past_key_value
+    """
+    __slots__ = ("cache", "layer_idx")
+
+    def __init__(self, cache: StaticKVCache, layer_idx: int):
+        self.cache = cache
+        self.layer_idx = layer_idx
+
+    def update(self, key_states: torch.Tensor, value_states: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.cache.update(self.layer_idx, key_states, value_states)
+
+    @property
+    def cross_attn_key_value(self) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        return self.cache.cross_attn_key_values[self.layer_idx]
+
+    @cross_attn_key_value.setter
+    def cross_attn_key_value(self, key_value: Tuple[torch.Tensor, torch.Tensor]):
+        self.cache.cross_attn_key_values[self.layer_idx] = key_value
+
+
+def truncate_past_key_values(past, length: int):
+    """
+    past_key_values (a StaticKVCache or the tuple of per layer (self K, self V, cross K, cross V)) with only the first
+    length decoder positions kept; cross-attention states are unchanged
+    """
+    if isinstance(past, StaticKVCache):
+        return past.truncate(length)
+    return tuple((layer_past[0][:, :, :length], layer_past[1][:, :, :length]) + tuple(layer_past[2:]) for layer_past in past)
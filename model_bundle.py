@@ -0,0 +1,249 @@
+"""
+Single-file model bundle, so decode workers start without `from_pretrained`: the generator as loaded by the decoding
+scripts (position embeddings extended to --max_source_length, token embeddings resized to the tokenizer, label prompt
+separator ids set), optionally the sentence classifier, and both fast tokenizers, in one safetensors file. Weights are
+stored once per shared tensor (tied embeddings / lm_head); configs and tokenizers go in the safetensors metadata.
+Build it once per checkpoint and pass it as --bundle_path to beam_search_sent.py / segctrl_sentbs.py.
+With --mmap_weights (CPU only), the weights are not copied into the models but memory-mapped from the bundle, so
+decode processes on one host share a single page cache copy of them.
+NOTE: the randomly initialised part of extended position embeddings is frozen into the bundle, so it no longer
+changes with the seed of the decoding run.
+
+Example:
+    python model_bundle.py --generation_model_path results/sentctrl_reproduced --classification_model_path results/classifier \
+        --max_source_length 2048 --output results/sentctrl_reproduced/bundle.safetensors
+"""
+import json
+import mmap
+import struct
+import argparse
+import warnings
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import torch
+from torch import nn
+
+
+BUNDLE_FORMAT = "sentbs-bundle-1"
+# config entries that change weight shapes, so can not be overridden when loading a bundle
+SHAPE_CONFIG_KEYS = ["max_position_embeddings", "vocab_size", "d_model", "encoder_layers", "decoder_layers"]
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+
+@dataclass
+class ModelBundle:
+    generator: nn.Module
+    tokenizer: "PreTrainedTokenizerFast"
+    classifier: Optional[nn.Module] = None
+    classifier_tokenizer: Optional["PreTrainedTokenizerFast"] = None
+
+
+def _dedupe_state_dict(state_dict: Dict[str, torch.Tensor], prefix: str) -> Tuple[Dict[str, torch.Tensor], Dict[str, str]]:
+    """
+    the prefixed tensors of state_dict with shared storage stored once (safetensors refuses shared tensors), and the
+    names of the dropped ones mapped to the name of the stored one
+    """
+    tensors, aliases, stored_names = {}, {}, {}
+    for name, tensor in state_dict.items():
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+        if key in stored_names:
+            aliases[prefix + name] = stored_names[key]
+            continue
+        stored_names[key] = prefix + name
+        tensors[prefix + name] = tensor.detach().cpu().contiguous()
+    return tensors, aliases
+
+
+def _serialize_tokenizer(tokenizer) -> str:
+    if not getattr(tokenizer, "is_fast", False):
+        raise ValueError("only fast tokenizers can be bundled, got " + type(tokenizer).__name__)
+    return json.dumps({
+        "class": type(tokenizer).__name__,
+        "tokenizer": tokenizer.backend_tokenizer.to_str(),
+        "init_kwargs": {**tokenizer.special_tokens_map, "model_max_length": tokenizer.model_max_length, "padding_side": tokenizer.padding_side},
+    })
+
+
+def _deserialize_tokenizer(serialized: str):
+    import transformers
+    from tokenizers import Tokenizer
+
+    serialized = json.loads(serialized)
+    tokenizer_class = getattr(transformers, serialized["class"], transformers.PreTrainedTokenizerFast)
+    return tokenizer_class(tokenizer_object=Tokenizer.from_str(serialized["tokenizer"]), **serialized["init_kwargs"])
+
+
+def save_bundle(path: str, generator: nn.Module, tokenizer, classifier: Optional[nn.Module] = None, classifier_tokenizer=None):
+    from safetensors.torch import save_file
+
+    tensors, aliases = _dedupe_state_dict(generator.state_dict(), "generator.")
+    metadata = {
+        "format": BUNDLE_FORMAT,
+        "generator_config": generator.config.to_json_string(),
+        "generator_tokenizer": _serialize_tokenizer(tokenizer),
+    }
+    if classifier is not None:
+        classifier_tensors, classifier_aliases = _dedupe_state_dict(classifier.state_dict(), "classifier.")
+        tensors.update(classifier_tensors)
+        aliases.update(classifier_aliases)
+        metadata["classifier_config"] = classifier.config.to_json_string()
+        metadata["classifier_tokenizer"] = _serialize_tokenizer(classifier_tokenizer)
+    metadata["aliases"] = json.dumps(aliases)
+    save_file(tensors, path, metadata=metadata)
+
+
+def _get_state_dict(tensors: Dict[str, torch.Tensor], aliases: Dict[str, str], prefix: str) -> Dict[str, torch.Tensor]:
+    state_dict = {name[len(prefix):]: tensor for name, tensor in tensors.items() if name.startswith(prefix)}
+    for alias, name in aliases.items():
+        if alias.startswith(prefix):
+            state_dict[alias[len(prefix):]] = tensors[name]
+    return state_dict
+
+
+def _mmap_tensors(path: str) -> Dict[str, torch.Tensor]:
+    """
+    the tensors of a safetensors file as CPU views of one copy-on-write memory map of it: pages stay shared with the
+    page cache (and every other process mapping the file) unless written to, and the file itself is never modified
+    """
+    with open(path, "rb") as fr:
+        buffer = mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_COPY)
+    header_size = struct.unpack("<Q", buffer[:8])[0]
+    header = json.loads(buffer[8 : 8 + header_size])
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        if end == start:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore") # torch.frombuffer warns that the tensor shares the buffer memory
+            tensor = torch.frombuffer(buffer, dtype=dtype, count=(end - start) // torch.empty((), dtype=dtype).element_size(), offset=data_start + start)
+        tensors[name] = tensor.view(info["shape"])
+    return tensors
+
+
+def _assign_weights(model: nn.Module, state_dict: Dict[str, torch.Tensor]):
+    """
+    point the parameters and buffers of model at the state_dict tensors instead of copying them into its own
+    """
+    expected_keys, loaded_keys = set(model.state_dict().keys()), set(state_dict.keys())
+    if expected_keys != loaded_keys:
+        raise ValueError(f"bundle does not match the model, missing: {sorted(expected_keys - loaded_keys)}, unexpected: {sorted(loaded_keys - expected_keys)}")
+    for name, tensor in state_dict.items():
+        module_name, _, attr_name = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if attr_name in module._parameters:
+            module._parameters[attr_name].requires_grad_(False)
+            module._parameters[attr_name].data = tensor # tied parameters are one Parameter, re-pointed once per alias
+        else:
+            module._buffers[attr_name] = tensor
+
+
+def _load_weights(model: nn.Module, state_dict: Dict[str, torch.Tensor], mmap_weights: bool = False) -> nn.Module:
+    if mmap_weights:
+        _assign_weights(model, state_dict)
+    else:
+        model.load_state_dict(state_dict, strict=True)
+    model.tie_weights()
+    return model.eval()
+
+
+def load_bundle(
+    path: str,
+    device: torch.device,
+    config_overrides: Optional[Dict] = None,
+    load_classifier: bool = True,
+    mmap_weights: bool = False,
+) -> ModelBundle:
+    """
+    load a bundle written by save_bundle onto device. config_overrides are set on the generator config before the
+    model is built (e.g. gen_target_max, encoder_attention_window); overriding a SHAPE_CONFIG_KEYS entry with a
+    different value raises a ValueError, as the bundle has to be rebuilt for it.
+    With mmap_weights, the model weights are memory-mapped views of the bundle file (see _mmap_tensors) instead of
+    private copies; CPU only. Anything replacing the weights afterwards (e.g. int8 quantisation) holds its own copy.
+    """
+    from safetensors import safe_open
+    from safetensors.torch import load_file
+    from transformers import BartConfig
+
+    from modeling_utils import no_init_weights
+    from modeling_bart import BartForConditionalGeneration
+
+    with safe_open(path, framework="pt") as f:
+        metadata = f.metadata()
+    if metadata is None or metadata.get("format") != BUNDLE_FORMAT:
+        raise ValueError(f"{path} is not a model bundle of format {BUNDLE_FORMAT}, rebuild it with model_bundle.py")
+    if load_classifier and "classifier_config" not in metadata:
+        raise ValueError(f"{path} has no classifier, rebuild it with --classification_model_path")
+    if mmap_weights and torch.device(device).type != "cpu":
+        raise ValueError("memory-mapped weights are only supported on CPU, got device " + str(device))
+    tensors = _mmap_tensors(path) if mmap_weights else load_file(path)
+    aliases = json.loads(metadata["aliases"])
+
+    config = BartConfig.from_dict(json.loads(metadata["generator_config"]))
+    for key, value in (config_overrides or {}).items():
+        if key in SHAPE_CONFIG_KEYS and getattr(config, key, None) != value:
+            raise ValueError(f"the bundle was built with {key}={getattr(config, key, None)}, got {value}; rebuild it with model_bundle.py")
+        setattr(config, key, value)
+    with no_init_weights(): # the weights all come from the bundle
+        generator = BartForConditionalGeneration(config)
+    generator = _load_weights(generator, _get_state_dict(tensors, aliases, "generator."), mmap_weights).to(device)
+    bundle = ModelBundle(generator, _deserialize_tokenizer(metadata["generator_tokenizer"]))
+
+    if load_classifier:
+        from transformers import AutoConfig, AutoModelForSequenceClassification
+        from transformers.modeling_utils import no_init_weights as no_classifier_init_weights
+
+        classifier_config = json.loads(metadata["classifier_config"])
+        classifier_config = AutoConfig.for_model(classifier_config.pop("model_type"), **classifier_config)
+        with no_classifier_init_weights():
+            classifier = AutoModelForSequenceClassification.from_config(classifier_config)
+        bundle.classifier = _load_weights(classifier, _get_state_dict(tensors, aliases, "classifier."), mmap_weights).to(device)
+        bundle.classifier_tokenizer = _deserialize_tokenizer(metadata["classifier_tokenizer"])
+    print("loaded model bundle:", path, "(memory-mapped weights)" if mmap_weights else "")
+    return bundle
+
+
+def parse_arguments(parser):
+    parser.add_argument('--generation_model_path', type=str, default="", help="the path of the generation model to be bundled")
+    parser.add_argument('--classification_model_path', type=str, default="", help="the path of the classification model to be bundled, empty for none")
+    parser.add_argument('--num_labels', type=int, default=9, help="number of labels of the classification model")
+    parser.add_argument('--max_source_length', type=int, default=2048, help="maximum number of source token ids, which the position embeddings are extended to")
+    parser.add_argument('--output', type=str, default="bundle.safetensors", help="safetensors file the bundle is written to")
+
+    args = parser.parse_args()
+    for k in args.__dict__:
+        print(k + ": " + str(args.__dict__[k]))
+    return args
+
+
+if __name__ == "__main__":
+    from transformers import AutoConfig, AutoTokenizer, AutoModelForSequenceClassification
+    from modeling_bart import BartForConditionalGeneration
+
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+
+    # the generator exactly as the decoding scripts load it
+    config = AutoConfig.from_pretrained(args.generation_model_path)
+    config.max_position_embeddings = args.max_source_length
+    generator = BartForConditionalGeneration.from_pretrained(args.generation_model_path, config=config)
+    tokenizer = AutoTokenizer.from_pretrained(args.generation_model_path, use_fast=True)
+    generator.resize_token_embeddings(len(tokenizer))
+    generator.config.encoder_global_separator_ids = tokenizer(" ==>", add_special_tokens=False).input_ids
+
+    classifier, classifier_tokenizer = None, None
+    if args.classification_model_path:
+        classifier = AutoModelForSequenceClassification.from_pretrained(args.classification_model_path, num_labels=args.num_labels)
+        classifier_tokenizer = AutoTokenizer.from_pretrained(args.classification_model_path, use_fast=True)
+
+    save_bundle(args.output, generator.eval(), tokenizer, classifier, classifier_tokenizer)
+    print("model bundle written to:", args.output)
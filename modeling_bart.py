@@ -42,6 +42,7 @@ from transformers.modeling_outputs import (
     Seq2SeqSequenceClassifierOutput,
 )
 from modeling_utils import PreTrainedModel
+from kv_cache import StaticKVCache, StaticKVCacheLayer, StaticKVCachePool
 from transformers.utils import logging
 from transformers.models.bart.configuration_bart import BartConfig
 
@@ -157,6 +158,38 @@ class BartAttention(nn.Module):
     def _shape(self, tensor: torch.Tensor, seq_len: int, bsz: int):
         return tensor.view(bsz, seq_len, self.num_heads, self.head_dim).transpose(1, 2).contiguous()
 
+    def project_key_value_states(self, key_value_states: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """SentBS: cross-attention key/value states [batch, num_heads, src_len, head_dim] of encoder states [batch, src_len, embed_dim]"""
+        kv_bsz = key_value_states.size(0)
+        key_states = self._shape(self.k_proj(key_value_states), -1, kv_bsz)
+        value_states = self._shape(self.v_proj(key_value_states), -1, kv_bsz)
+        return key_states, value_states
+
+    def decode_step_attention(
+        self,
+        hidden_states: torch.Tensor,
+        positions: torch.LongTensor,
+        key_buffer: torch.Tensor,
+        value_buffer: torch.Tensor,
+        attention_bias: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        SentBS: decoder self-attention of `BartDecoder.decode_step`. Writes the key/value states of hidden_states [bsz,
+        tgt_len, embed_dim] into the [bsz, num_heads, max_length, head_dim] buffers at positions [tgt_len], then
+        attends over the whole buffers with attention_bias [bsz, 1, tgt_len, max_length]; so the shapes do not change
+        from step to step.
+        """
+        bsz, tgt_len, _ = hidden_states.size()
+        query_states = self._shape(self.q_proj(hidden_states) * self.scaling, tgt_len, bsz)
+        key_buffer.index_copy_(2, positions, self._shape(self.k_proj(hidden_states), tgt_len, bsz).to(key_buffer.dtype))
+        value_buffer.index_copy_(2, positions, self._shape(self.v_proj(hidden_states), tgt_len, bsz).to(value_buffer.dtype))
+
+        attn_weights = torch.matmul(query_states, key_buffer.transpose(2, 3).to(query_states.dtype)) + attention_bias
+        attn_weights = nn.functional.softmax(attn_weights, dim=-1)
+        attn_output = torch.matmul(attn_weights, value_buffer.to(attn_weights.dtype))
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, tgt_len, self.embed_dim)
+        return self.out_proj(attn_output)
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -183,8 +216,13 @@ class BartAttention(nn.Module):
             value_states = past_key_value[1]
         elif is_cross_attention:
             # cross_attentions
-            key_states = self._shape(self.k_proj(key_value_states), -1, bsz)
-            value_states = self._shape(self.v_proj(key_value_states), -1, bsz)
+            # SentBS: key_value_states may hold one row per source, shared by groups of consecutive decoder lanes
+            key_states, value_states = self.project_key_value_states(key_value_states)
+        elif isinstance(past_key_value, StaticKVCacheLayer):
+            # SentBS: write into the preallocated cache instead of concatenating
+            key_states, value_states = past_key_value.update(
+                self._shape(self.k_proj(hidden_states), -1, bsz), self._shape(self.v_proj(hidden_states), -1, bsz)
+            )
         elif past_key_value is not None:
             # reuse k, v, self_attention
             key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
@@ -206,6 +244,12 @@ class BartAttention(nn.Module):
             # if encoder bi-directional self-attention `past_key_value` is always `None`
             past_key_value = (key_states, value_states)
 
+        if is_cross_attention and key_states.size(0) != bsz:
+            attn_output, attn_weights_reshaped = self._grouped_cross_attention(
+                query_states, key_states, value_states, attention_mask, layer_head_mask, output_attentions
+            )
+            return attn_output, attn_weights_reshaped, past_key_value
+
         proj_shape = (bsz * self.num_heads, -1, self.head_dim)
         query_states = self._shape(query_states, tgt_len, bsz).view(*proj_shape)
         key_states = key_states.view(*proj_shape)
@@ -267,6 +311,144 @@ class BartAttention(nn.Module):
 
         return attn_output, attn_weights_reshaped, past_key_value
 
+    def _grouped_cross_attention(
+        self,
+        query_states: torch.Tensor,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        layer_head_mask: Optional[torch.Tensor] = None,
+        output_attentions: bool = False,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """
+        SentBS: cross-attention of bsz decoder lanes over num_groups encoder states (key/value_states of shape
+        [num_groups, num_heads, src_len, head_dim]), lane i attending to group i // (bsz // num_groups); i.e. the lanes
+        of a source are consecutive, as after `_expand_inputs_for_generation`. The key/value states are broadcast
+        instead of being copied once per lane. attention_mask is the expanded encoder padding mask, with either bsz or
+        num_groups rows.
+        """
+        bsz, tgt_len, _ = query_states.size()
+        num_groups, _, src_len, _ = key_states.size()
+        if bsz % num_groups != 0:
+            raise ValueError(f"{bsz} decoder lanes can not be split evenly over {num_groups} encoder states")
+        group_size = bsz // num_groups
+
+        # [bsz, tgt_len, embed_dim] -> [num_groups, num_heads, group_size * tgt_len, head_dim]
+        query_states = query_states.view(num_groups, group_size, tgt_len, self.num_heads, self.head_dim)
+        query_states = query_states.permute(0, 3, 1, 2, 4).reshape(num_groups, self.num_heads, group_size * tgt_len, self.head_dim)
+        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3))
+
+        if attention_mask is not None:
+            if attention_mask.size(0) == bsz:
+                attention_mask = attention_mask[::group_size]
+            if attention_mask.size() != (num_groups, 1, tgt_len, src_len):
+                raise ValueError(
+                    f"Attention mask should be of size {(num_groups, 1, tgt_len, src_len)}, but is {attention_mask.size()}"
+                )
+            # an encoder padding mask is the same for every target position
+            attn_weights = attn_weights + attention_mask[:, :, :1, :]
+
+        attn_weights = nn.functional.softmax(attn_weights, dim=-1)
+
+        if layer_head_mask is not None:
+            if layer_head_mask.size() != (self.num_heads,):
+                raise ValueError(
+                    f"Head mask for a single layer should be of size {(self.num_heads,)}, but is {layer_head_mask.size()}"
+                )
+            attn_weights = layer_head_mask.view(1, -1, 1, 1) * attn_weights
+
+        if output_attentions:
+            attn_weights_reshaped = attn_weights.view(num_groups, self.num_heads, group_size, tgt_len, src_len)
+            attn_weights_reshaped = attn_weights_reshaped.transpose(1, 2).reshape(bsz, self.num_heads, tgt_len, src_len)
+        else:
+            attn_weights_reshaped = None
+
+        attn_probs = nn.functional.dropout(attn_weights, p=self.dropout, training=self.training)
+
+        # [num_groups, num_heads, group_size * tgt_len, head_dim] -> [bsz, tgt_len, embed_dim]
+        attn_output = torch.matmul(attn_probs, value_states)
+        attn_output = attn_output.view(num_groups, self.num_heads, group_size, tgt_len, self.head_dim)
+        attn_output = attn_output.permute(0, 2, 3, 1, 4).reshape(bsz, tgt_len, self.embed_dim)
+
+        attn_output = self.out_proj(attn_output)
+
+        return attn_output, attn_weights_reshaped
+
+    def local_global_attention(
+        self,
+        hidden_states: torch.Tensor,
+        key_padding_mask: torch.Tensor,
+        global_attention_mask: torch.Tensor,
+        attention_window: int,
+        layer_head_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        SentBS: Longformer-style encoder self-attention. Every token attends to the tokens at most attention_window
+        positions away and to the global tokens; global tokens attend to all tokens. Uses the same projections as the
+        dense attention, so checkpoints are unchanged; the cost is O(seq_len * (3 * attention_window + num_global)).
+        hidden_states: [bsz, seq_len, embed_dim]; key_padding_mask, global_attention_mask: bool [bsz, seq_len]
+        """
+        bsz, seq_len, _ = hidden_states.size()
+        window = attention_window
+        num_blocks = (seq_len + window - 1) // window
+        pad_len = num_blocks * window - seq_len
+
+        query_states = self._shape(self.q_proj(hidden_states) * self.scaling, seq_len, bsz)
+        key_states, value_states = self.project_key_value_states(hidden_states)
+        global_attention_mask = global_attention_mask & key_padding_mask
+        local_key_mask = key_padding_mask & ~global_attention_mask # global keys are attended separately below
+
+        def neighbour_blocks(x):
+            # [..., seq_len(, head_dim)] -> [..., num_blocks, (head_dim, )3 * window]: the previous, current and next
+            # block of every block, zero padded
+            if x.dim() == 2:
+                return nn.functional.pad(x.int(), (window, pad_len + window)).unfold(1, 3 * window, window) > 0
+            return nn.functional.pad(x, (0, 0, window, pad_len + window)).unfold(2, 3 * window, window)
+
+        # local part: query block b against key blocks b-1, b, b+1, restricted to |query pos - key pos| <= window
+        block_query_states = nn.functional.pad(query_states, (0, 0, 0, pad_len)).view(
+            bsz, self.num_heads, num_blocks, window, self.head_dim
+        )
+        local_weights = torch.matmul(block_query_states, neighbour_blocks(key_states))
+        offsets = torch.arange(3 * window, device=hidden_states.device)[None, :] - window - torch.arange(window, device=hidden_states.device)[:, None]
+        local_mask = (offsets.abs() <= window)[None, None, :, :] & neighbour_blocks(local_key_mask)[:, :, None, :]
+        min_value = torch.finfo(local_weights.dtype).min
+        local_weights = local_weights.masked_fill(~local_mask[:, None], min_value)
+
+        # global keys, gathered to the front: [bsz, num_heads, max_num_global, head_dim]
+        num_global = global_attention_mask.sum(-1)
+        max_num_global = max(int(num_global.max()), 1)
+        global_idx = global_attention_mask.int().topk(max_num_global, dim=-1).indices
+        is_global = global_attention_mask.gather(1, global_idx) # False for the filler of rows with fewer global tokens
+        global_gather_idx = global_idx[:, None, :, None].expand(-1, self.num_heads, -1, self.head_dim)
+        global_key_states = key_states.gather(2, global_gather_idx)
+        global_value_states = value_states.gather(2, global_gather_idx)
+        global_weights = torch.matmul(block_query_states, global_key_states[:, :, None].transpose(-1, -2))
+        global_weights = global_weights.masked_fill(~is_global[:, None, None, None, :], min_value)
+
+        attn_weights = nn.functional.softmax(torch.cat([local_weights, global_weights], dim=-1), dim=-1)
+        if layer_head_mask is not None:
+            attn_weights = layer_head_mask.view(1, -1, 1, 1, 1) * attn_weights
+        attn_probs = nn.functional.dropout(attn_weights, p=self.dropout, training=self.training)
+        attn_output = torch.matmul(attn_probs[..., : 3 * window], neighbour_blocks(value_states).transpose(-1, -2))
+        attn_output = attn_output + torch.matmul(attn_probs[..., 3 * window :], global_value_states[:, :, None])
+        attn_output = attn_output.view(bsz, self.num_heads, num_blocks * window, self.head_dim)[:, :, :seq_len]
+
+        # global queries attend to every (non padding) token
+        global_query_states = query_states.gather(2, global_gather_idx)
+        full_weights = torch.matmul(global_query_states, key_states.transpose(-1, -2))
+        full_weights = full_weights.masked_fill(~key_padding_mask[:, None, None, :], min_value)
+        full_weights = nn.functional.softmax(full_weights, dim=-1)
+        if layer_head_mask is not None:
+            full_weights = layer_head_mask.view(1, -1, 1, 1) * full_weights
+        full_probs = nn.functional.dropout(full_weights, p=self.dropout, training=self.training)
+        global_output = torch.matmul(full_probs, value_states)
+        global_output = torch.where(is_global[:, None, :, None], global_output, attn_output.gather(2, global_gather_idx))
+        attn_output = attn_output.scatter(2, global_gather_idx, global_output)
+
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, seq_len, self.embed_dim)
+        return self.out_proj(attn_output)
+
 
 class BartEncoderLayer(nn.Module):
     def __init__(self, config: BartConfig):
@@ -277,6 +459,7 @@ class BartEncoderLayer(nn.Module):
             num_heads=config.encoder_attention_heads,
             dropout=config.attention_dropout,
         )
+        self.attention_window = getattr(config, "encoder_attention_window", 0) # SentBS: 0 for dense self-attention
         self.self_attn_layer_norm = nn.LayerNorm(self.embed_dim)
         self.dropout = config.dropout
         self.activation_fn = ACT2FN[config.activation_function]
@@ -291,6 +474,7 @@ class BartEncoderLayer(nn.Module):
         attention_mask: torch.Tensor,
         layer_head_mask: torch.Tensor,
         output_attentions: bool = False,
+        local_attention_masks: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
     ):
         """
         Args:
@@ -302,14 +486,23 @@ class BartEncoderLayer(nn.Module):
             output_attentions (`bool`, *optional*):
                 Whether or not to return the attentions tensors of all attention layers. See `attentions` under
                 returned tensors for more detail.
+            local_attention_masks (`Tuple(torch.BoolTensor)`, *optional*): SentBS: (key padding mask, global
+                attention mask) of size *(batch, seq_len)*, to use `BartAttention.local_global_attention` with a window
+                of *config.encoder_attention_window* instead of dense attention. No attentions are returned then.
         """
         residual = hidden_states
-        hidden_states, attn_weights, _ = self.self_attn(
-            hidden_states=hidden_states,
-            attention_mask=attention_mask,
-            layer_head_mask=layer_head_mask,
-            output_attentions=output_attentions,
-        )
+        if local_attention_masks is not None:
+            hidden_states = self.self_attn.local_global_attention(
+                hidden_states, *local_attention_masks, self.attention_window, layer_head_mask=layer_head_mask
+            )
+            attn_weights = None
+        else:
+            hidden_states, attn_weights, _ = self.self_attn(
+                hidden_states=hidden_states,
+                attention_mask=attention_mask,
+                layer_head_mask=layer_head_mask,
+                output_attentions=output_attentions,
+            )
         hidden_states = nn.functional.dropout(hidden_states, p=self.dropout, training=self.training)
         hidden_states = residual + hidden_states
         hidden_states = self.self_attn_layer_norm(hidden_states)
@@ -374,6 +567,7 @@ class BartDecoderLayer(nn.Module):
         past_key_value: Optional[Tuple[torch.Tensor]] = None,
         output_attentions: Optional[bool] = False,
         use_cache: Optional[bool] = True,
+        cross_attn_past_key_value: Optional[Tuple[torch.Tensor]] = None,
     ):
         """
         Args:
@@ -392,12 +586,19 @@ class BartDecoderLayer(nn.Module):
             output_attentions (`bool`, *optional*):
                 Whether or not to return the attentions tensors of all attention layers. See `attentions` under
                 returned tensors for more detail.
+            cross_attn_past_key_value (`Tuple(torch.FloatTensor)`, *optional*): SentBS: precomputed cross-attention
+                key and value states, used when past_key_value is None (see `BartDecoder.precompute_cross_attention_kv`)
         """
         residual = hidden_states
 
         # Self Attention
         # decoder uni-directional self-attention cached key/values tuple is at positions 1,2
-        self_attn_past_key_value = past_key_value[:2] if past_key_value is not None else None
+        # SentBS: or the layer's view on a StaticKVCache, which holds both self and cross attention states
+        static_cache_layer = past_key_value if isinstance(past_key_value, StaticKVCacheLayer) else None
+        if static_cache_layer is not None:
+            self_attn_past_key_value = static_cache_layer
+        else:
+            self_attn_past_key_value = past_key_value[:2] if past_key_value is not None else None
         # add present self-attn cache to positions 1,2 of present_key_value tuple
         hidden_states, self_attn_weights, present_key_value = self.self_attn(
             hidden_states=hidden_states,
@@ -417,7 +618,10 @@ class BartDecoderLayer(nn.Module):
             residual = hidden_states
 
             # cross_attn cached key/values tuple is at positions 3,4 of present_key_value tuple
-            cross_attn_past_key_value = past_key_value[-2:] if past_key_value is not None else None
+            if static_cache_layer is not None:
+                cross_attn_past_key_value = static_cache_layer.cross_attn_key_value or cross_attn_past_key_value
+            elif past_key_value is not None:
+                cross_attn_past_key_value = past_key_value[-2:]
             hidden_states, cross_attn_weights, cross_attn_present_key_value = self.encoder_attn(
                 hidden_states=hidden_states,
                 key_value_states=encoder_hidden_states,
@@ -432,6 +636,11 @@ class BartDecoderLayer(nn.Module):
 
             # add cross-attn to positions 3,4 of present_key_value tuple
             present_key_value = present_key_value + cross_attn_present_key_value
+            if static_cache_layer is not None:
+                static_cache_layer.cross_attn_key_value = cross_attn_present_key_value
+
+        if static_cache_layer is not None:
+            present_key_value = static_cache_layer
 
         # Fully Connected
         residual = hidden_states
@@ -452,6 +661,34 @@ class BartDecoderLayer(nn.Module):
 
         return outputs
 
+    def decode_step(
+        self,
+        hidden_states: torch.Tensor,
+        positions: torch.LongTensor,
+        key_buffer: torch.Tensor,
+        value_buffer: torch.Tensor,
+        self_attn_bias: torch.Tensor,
+        cross_attn_key_value: Tuple[torch.Tensor, torch.Tensor],
+        encoder_attention_bias: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        SentBS: the inference forward of the layer for `BartDecoder.decode_step`: no dropout, head masks, attentions or
+        cache tuples. encoder_attention_bias is of size *(num_groups, 1, tgt_len, src_len)*, with num_groups the
+        number of rows of the cross-attention key/value states.
+        """
+        residual = hidden_states
+        hidden_states = self.self_attn.decode_step_attention(hidden_states, positions, key_buffer, value_buffer, self_attn_bias)
+        hidden_states = self.self_attn_layer_norm(residual + hidden_states)
+
+        residual = hidden_states
+        query_states = self.encoder_attn.q_proj(hidden_states) * self.encoder_attn.scaling
+        hidden_states, _ = self.encoder_attn._grouped_cross_attention(query_states, *cross_attn_key_value, attention_mask=encoder_attention_bias)
+        hidden_states = self.encoder_attn_layer_norm(residual + hidden_states)
+
+        residual = hidden_states
+        hidden_states = self.fc2(self.activation_fn(self.fc1(hidden_states)))
+        return self.final_layer_norm(residual + hidden_states)
+
 
 class BartClassificationHead(nn.Module):
     """Head for sentence-level classification tasks."""
@@ -700,6 +937,7 @@ class BartEncoder(BartPretrainedModel):
         )
         self.layers = nn.ModuleList([BartEncoderLayer(config) for _ in range(config.encoder_layers)])
         self.layernorm_embedding = nn.LayerNorm(embed_dim)
+        self.attention_window = getattr(config, "encoder_attention_window", 0) # SentBS: 0 for dense self-attention
 
         self.gradient_checkpointing = False
         # Initialize weights and apply final processing
@@ -711,6 +949,22 @@ class BartEncoder(BartPretrainedModel):
     def set_input_embeddings(self, value):
         self.embed_tokens = value
 
+    def get_global_attention_mask(self, input_ids: Optional[torch.LongTensor], input_shape: torch.Size, device: torch.device) -> torch.BoolTensor:
+        """
+        SentBS: global tokens for local attention: the first token, and the label prompt, i.e. every token up to and
+        including the first occurrence of *config.encoder_global_separator_ids* (the ids of " ==>")
+        """
+        global_attention_mask = torch.zeros(input_shape, dtype=torch.bool, device=device)
+        global_attention_mask[:, 0] = True
+        separator_ids = getattr(self.config, "encoder_global_separator_ids", None)
+        if input_ids is None or not separator_ids or input_shape[-1] < len(separator_ids):
+            return global_attention_mask
+        separator_ids = torch.tensor(separator_ids, dtype=input_ids.dtype, device=device)
+        matches = (input_ids.unfold(1, len(separator_ids), 1) == separator_ids).all(-1) # [bsz, seq_len - len + 1]
+        prompt_end = matches.int().argmax(-1) + len(separator_ids)
+        positions = torch.arange(input_shape[-1], device=device)
+        return global_attention_mask | (matches.any(-1)[:, None] & (positions[None, :] < prompt_end[:, None]))
+
     def forward(
         self,
         input_ids=None,
@@ -720,6 +974,7 @@ class BartEncoder(BartPretrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
+        global_attention_mask=None,
     ):
         r"""
         Args:
@@ -756,6 +1011,9 @@ class BartEncoder(BartPretrainedModel):
                 for more detail.
             return_dict (`bool`, *optional*):
                 Whether or not to return a [`~file_utils.ModelOutput`] instead of a plain tuple.
+            global_attention_mask (`torch.Tensor` of shape `(batch_size, sequence_length)`, *optional*):
+                SentBS: tokens that attend to and are attended by all tokens when *config.encoder_attention_window* > 0,
+                by default the label prompt (see `get_global_attention_mask`).
         """
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -783,8 +1041,19 @@ class BartEncoder(BartPretrainedModel):
         hidden_states = self.layernorm_embedding(hidden_states)
         hidden_states = nn.functional.dropout(hidden_states, p=self.dropout, training=self.training)
 
+        # SentBS: local + global attention, unless the window covers the whole input anyway
+        local_attention_masks = None
+        if self.attention_window > 0 and input_shape[-1] - 1 > self.attention_window:
+            key_padding_mask = (
+                attention_mask.bool() if attention_mask is not None
+                else torch.ones(input_shape, dtype=torch.bool, device=hidden_states.device)
+            )
+            if global_attention_mask is None:
+                global_attention_mask = self.get_global_attention_mask(input_ids, input_shape, hidden_states.device)
+            local_attention_masks = (key_padding_mask, global_attention_mask.bool())
+            attention_mask = None
         # expand attention_mask
-        if attention_mask is not None:
+        elif attention_mask is not None:
             # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
             attention_mask = _expand_mask(attention_mask, inputs_embeds.dtype)
 
@@ -810,7 +1079,7 @@ class BartEncoder(BartPretrainedModel):
 
                     def create_custom_forward(module):
                         def custom_forward(*inputs):
-                            return module(*inputs, output_attentions)
+                            return module(*inputs, output_attentions, local_attention_masks)
 
                         return custom_forward
 
@@ -826,6 +1095,7 @@ class BartEncoder(BartPretrainedModel):
                         attention_mask,
                         layer_head_mask=(head_mask[idx] if head_mask is not None else None),
                         output_attentions=output_attentions,
+                        local_attention_masks=local_attention_masks,
                     )
 
                 hidden_states = layer_outputs[0]
@@ -873,6 +1143,7 @@ class BartDecoder(BartPretrainedModel):
         self.layernorm_embedding = nn.LayerNorm(config.d_model)
 
         self.gradient_checkpointing = False
+        self.static_kv_cache_pool = StaticKVCachePool() # SentBS: buffers of static_cache_length, kept across calls
         # Initialize weights and apply final processing
         self.post_init()
 
@@ -900,6 +1171,52 @@ class BartDecoder(BartPretrainedModel):
 
         return combined_attention_mask
 
+    @torch.no_grad()
+    def precompute_cross_attention_kv(self, encoder_hidden_states: torch.Tensor) -> Tuple[Tuple[torch.Tensor, torch.Tensor], ...]:
+        """
+        SentBS: the cross-attention key/value states of every decoder layer for encoder_hidden_states [batch, src_len,
+        embed_dim], i.e. what the first decoding step of each `generate` call computes and caches in past_key_values[2:].
+        Pass them as `cross_attn_key_values` to reuse them across decoding calls on the same source.
+        """
+        return tuple(layer.encoder_attn.project_key_value_states(encoder_hidden_states) for layer in self.layers)
+
+    def decode_step(
+        self,
+        input_ids: torch.LongTensor,
+        positions: torch.LongTensor,
+        self_attn_key_values: Tuple[Tuple[torch.Tensor, torch.Tensor], ...],
+        cross_attn_key_values: Tuple[Tuple[torch.Tensor, torch.Tensor], ...],
+        self_attn_key_mask: torch.BoolTensor,
+        encoder_attention_bias: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        SentBS: lean inference forward of the decoder over new tokens input_ids [batch, tgt_len] at positions [tgt_len],
+        taking and returning tensors only, so it can be wrapped by `torch.compile` or traced with `torch.jit.trace`
+        (see decode_step.py). Returns the last hidden states [batch, tgt_len, embed_dim].
+
+        self_attn_key_values are the per layer (key, value) buffers of a `StaticKVCache`, written in place at
+        positions; every step attends over the whole buffers, the positions after the new ones and those with a False
+        self_attn_key_mask [batch, max_length] (decoder padding) being masked out. cross_attn_key_values are the per
+        layer cross-attention states (one row per source or per decoder row) and encoder_attention_bias [num_groups,
+        1, 1, src_len] the additive encoder padding mask for their rows.
+        """
+        max_length = self_attn_key_values[0][0].size(2)
+        hidden_states = self.embed_tokens(input_ids) * self.embed_scale
+        hidden_states = hidden_states + nn.functional.embedding(positions + self.embed_positions.offset, self.embed_positions.weight)
+        hidden_states = self.layernorm_embedding(hidden_states)
+
+        key_positions = torch.arange(max_length, device=positions.device)
+        masked = (key_positions[None, :] > positions[:, None])[None, None] | ~self_attn_key_mask[:, None, None, :]
+        self_attn_bias = torch.zeros(masked.size(), dtype=hidden_states.dtype, device=hidden_states.device)
+        self_attn_bias = self_attn_bias.masked_fill(masked, torch.finfo(hidden_states.dtype).min)
+        encoder_attention_bias = encoder_attention_bias.expand(-1, -1, input_ids.size(1), -1)
+
+        for layer, (key_buffer, value_buffer), cross_attn_key_value in zip(self.layers, self_attn_key_values, cross_attn_key_values):
+            hidden_states = layer.decode_step(
+                hidden_states, positions, key_buffer, value_buffer, self_attn_bias, cross_attn_key_value, encoder_attention_bias
+            )
+        return hidden_states
+
     def forward(
         self,
         input_ids=None,
@@ -914,6 +1231,8 @@ class BartDecoder(BartPretrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
+        cross_attn_key_values=None,
+        static_cache_length=None,
     ):
         r"""
         Args:
@@ -979,6 +1298,14 @@ class BartDecoder(BartPretrainedModel):
                 for more detail.
             return_dict (`bool`, *optional*):
                 Whether or not to return a [`~file_utils.ModelOutput`] instead of a plain tuple.
+            cross_attn_key_values (`tuple(tuple(torch.FloatTensor))`, *optional*):
+                SentBS: per layer cross-attention key and value states of `encoder_hidden_states`, as returned by
+                `precompute_cross_attention_kv`, used instead of projecting `encoder_hidden_states` when
+                `past_key_values` is None. They may have one row per source, shared by its consecutive decoder rows.
+            static_cache_length (`int`, *optional*):
+                SentBS: with `use_cache` and no `past_key_values`, cache into a `StaticKVCache` preallocated for
+                this many decoder positions, which is returned as (and can then be passed as) `past_key_values`. Its
+                buffers come from `static_kv_cache_pool` and are reused by the next decoding call of the same shape.
         """
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -998,12 +1325,23 @@ class BartDecoder(BartPretrainedModel):
         else:
             raise ValueError("You have to specify either decoder_input_ids or decoder_inputs_embeds")
 
-        # past_key_values_length
-        past_key_values_length = past_key_values[0][0].shape[2] if past_key_values is not None else 0
-
         if inputs_embeds is None:
             inputs_embeds = self.embed_tokens(input_ids) * self.embed_scale
 
+        # SentBS: preallocated cache
+        if past_key_values is None and static_cache_length is not None and use_cache:
+            past_key_values = self.static_kv_cache_pool.get(
+                len(self.layers), input_shape[0], self.config.decoder_attention_heads, static_cache_length,
+                self.config.d_model // self.config.decoder_attention_heads, inputs_embeds.dtype, inputs_embeds.device,
+            )
+        static_cache = past_key_values if isinstance(past_key_values, StaticKVCache) else None
+
+        # past_key_values_length
+        if static_cache is not None:
+            past_key_values_length = static_cache.length
+        else:
+            past_key_values_length = past_key_values[0][0].shape[2] if past_key_values is not None else 0
+
         attention_mask = self._prepare_decoder_attention_mask(
             attention_mask, input_shape, inputs_embeds, past_key_values_length
         )
@@ -1084,6 +1422,9 @@ class BartDecoder(BartPretrainedModel):
                     past_key_value=past_key_value,
                     output_attentions=output_attentions,
                     use_cache=use_cache,
+                    cross_attn_past_key_value=(
+                        cross_attn_key_values[idx] if past_key_values_length == 0 and cross_attn_key_values is not None else None
+                    ),
                 )
             hidden_states = layer_outputs[0]
 
@@ -1101,6 +1442,9 @@ class BartDecoder(BartPretrainedModel):
             all_hidden_states += (hidden_states,)
 
         next_cache = next_decoder_cache if use_cache else None
+        if static_cache is not None:
+            static_cache.advance(input_shape[-1])
+            next_cache = static_cache if use_cache else None
         if not return_dict:
             return tuple(
                 v
@@ -1171,6 +1515,8 @@ class BartModel(BartPretrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
+        cross_attn_key_values=None,
+        decoder_static_cache_length=None,
     ):
 
         # different to other models, Bart automatically creates decoder_input_ids from
@@ -1226,6 +1572,8 @@ class BartModel(BartPretrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            cross_attn_key_values=cross_attn_key_values,
+            static_cache_length=decoder_static_cache_length,
         )
 
         if not return_dict:
@@ -1255,6 +1603,12 @@ class BartForConditionalGeneration(BartPretrainedModel):
         self.model = BartModel(config)
         self.register_buffer("final_logits_bias", torch.zeros((1, self.model.shared.num_embeddings)))
         self.lm_head = nn.Linear(config.d_model, self.model.shared.num_embeddings, bias=False)
+        # SentBS: restricted output vocabulary, see set_output_vocab (plain attributes, not part of the state dict)
+        self.output_vocab_ids = None
+        self.output_vocab_weight = None
+        self.output_vocab_bias = None
+        # SentBS: decoder part of decode_step, which the forward takes over on cached steps when set (see decode_step.py)
+        self.decoder_step_fn = None
 
         # Initialize weights and apply final processing
         self.post_init()
@@ -1265,6 +1619,77 @@ class BartForConditionalGeneration(BartPretrainedModel):
     def get_decoder(self):
         return self.model.get_decoder()
 
+    @torch.no_grad()
+    def set_output_vocab(self, token_ids: Optional[torch.LongTensor] = None):
+        """
+        SentBS: restrict the output projection to token_ids (duplicates allowed), or lift the restriction with None.
+        The lm_head matmul then only runs over these rows; the other tokens get -inf logits, so the logits keep the full
+        vocabulary size and ids, and decoding loops, logits processors and scores are unaffected. Only applies without
+        labels, i.e. not to the training loss. Call after `resize_token_embeddings` (and after quantising the lm_head).
+        """
+        if token_ids is None:
+            self.output_vocab_ids = self.output_vocab_weight = self.output_vocab_bias = None
+            return
+        weight = self.lm_head.weight
+        if callable(weight): # dynamically quantised lm_head, the (much smaller) subset is projected in fp32
+            weight = weight().dequantize()
+        token_ids = torch.unique(token_ids.to(weight.device)) # sorted
+        self.output_vocab_ids = token_ids
+        self.output_vocab_weight = weight.index_select(0, token_ids)
+        self.output_vocab_bias = self.final_logits_bias.index_select(1, token_ids)
+
+    def _get_output_vocab_logits(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        # SentBS: [bsz, seq_len, len(output_vocab_ids)] logits scattered into [bsz, seq_len, vocab_size] filled with -inf
+        sub_logits = nn.functional.linear(hidden_states, self.output_vocab_weight.to(hidden_states.dtype)) + self.output_vocab_bias
+        lm_logits = sub_logits.new_full(hidden_states.shape[:-1] + (self.final_logits_bias.size(-1),), -float("inf"))
+        return lm_logits.index_copy_(-1, self.output_vocab_ids, sub_logits)
+
+    def decode_step(
+        self,
+        token_ids: torch.LongTensor,
+        positions: Optional[torch.LongTensor],
+        kv_cache: StaticKVCache,
+        encoder_kv: Optional[Tuple[Tuple[torch.Tensor, torch.Tensor], ...]] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        decoder_attention_mask: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, StaticKVCache]:
+        """
+        SentBS: lean decoding step over token_ids [batch, tgt_len], the tokens after the kv_cache.length cached ones,
+        returning only the logits and the updated kv_cache; no ModelOutput, head masks or optional outputs.
+        positions default to the next tgt_len positions of kv_cache, encoder_kv to the cross-attention states cached by
+        the first (full) forward. attention_mask is the encoder padding mask, with one row per row of encoder_kv, and
+        decoder_attention_mask the decoder padding mask of the positions so far. The decoder part runs
+        `self.decoder_step_fn` if set, e.g. a compiled or traced `BartDecoder.decode_step`.
+        """
+        num_new = token_ids.size(1)
+        if kv_cache.length + num_new > kv_cache.max_length:
+            raise ValueError(f"static kv cache of length {kv_cache.max_length} is full, decoding reached length {kv_cache.length + num_new}")
+        if positions is None:
+            positions = torch.arange(kv_cache.length, kv_cache.length + num_new, device=token_ids.device)
+        if encoder_kv is None:
+            encoder_kv = tuple(kv_cache.cross_attn_key_values)
+
+        self_attn_key_mask = token_ids.new_ones((token_ids.size(0), kv_cache.max_length), dtype=torch.bool)
+        if decoder_attention_mask is not None:
+            self_attn_key_mask[:, : decoder_attention_mask.size(1)] = decoder_attention_mask.bool()
+        dtype = self.model.shared.weight.dtype
+        encoder_key_states = encoder_kv[0][0]
+        if attention_mask is not None:
+            encoder_attention_bias = _expand_mask(attention_mask, dtype, tgt_len=1)
+        else:
+            encoder_attention_bias = torch.zeros((encoder_key_states.size(0), 1, 1, encoder_key_states.size(2)), dtype=dtype, device=encoder_key_states.device)
+
+        decoder_step_fn = self.decoder_step_fn if self.decoder_step_fn is not None else self.get_decoder().decode_step
+        hidden_states = decoder_step_fn(
+            token_ids, positions, tuple(zip(kv_cache.keys, kv_cache.values)), encoder_kv, self_attn_key_mask, encoder_attention_bias
+        )
+        kv_cache.advance(num_new)
+        if self.output_vocab_ids is not None:
+            lm_logits = self._get_output_vocab_logits(hidden_states)
+        else:
+            lm_logits = self.lm_head(hidden_states) + self.final_logits_bias
+        return lm_logits, kv_cache
+
     def resize_token_embeddings(self, new_num_tokens: int) -> nn.Embedding:
         new_embeddings = super().resize_token_embeddings(new_num_tokens)
         self._resize_final_logits_bias(new_num_tokens)
@@ -1306,17 +1731,42 @@ class BartForConditionalGeneration(BartPretrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
+        cross_attn_key_values=None,
+        decoder_static_cache_length=None,
     ):
         r"""
         labels (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
             Labels for computing the masked language modeling loss. Indices should either be in `[0, ...,
             config.vocab_size]` or -100 (see `input_ids` docstring). Tokens with indices set to `-100` are ignored
             (masked), the loss is only computed for the tokens with labels in `[0, ..., config.vocab_size]`.
+        cross_attn_key_values (`tuple(tuple(torch.FloatTensor))`, *optional*):
+            SentBS: precomputed cross-attention key/value states, see `precompute_cross_attention_kv`.
+        decoder_static_cache_length (`int`, *optional*):
+            SentBS: cache into a preallocated `StaticKVCache` of this many positions, see `BartDecoder.forward`.
 
         Returns:
         """
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
+        # SentBS: cached decoding steps skip the full forward when a decoder_step_fn is set
+        if (
+            self.decoder_step_fn is not None
+            and isinstance(past_key_values, StaticKVCache)
+            and past_key_values.length > 0
+            and labels is None
+            and decoder_inputs_embeds is None
+            and decoder_head_mask is None
+            and cross_attn_head_mask is None
+            and not output_attentions
+            and not output_hidden_states
+        ):
+            lm_logits, past_key_values = self.decode_step(
+                decoder_input_ids, None, past_key_values, attention_mask=attention_mask, decoder_attention_mask=decoder_attention_mask
+            )
+            if not return_dict:
+                return (lm_logits, past_key_values)
+            return Seq2SeqLMOutput(logits=lm_logits, past_key_values=past_key_values)
+
         if labels is not None:
             if decoder_input_ids is None and decoder_inputs_embeds is None:
                 decoder_input_ids = shift_tokens_right(
@@ -1339,8 +1789,13 @@ class BartForConditionalGeneration(BartPretrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            cross_attn_key_values=cross_attn_key_values,
+            decoder_static_cache_length=decoder_static_cache_length,
         )
-        lm_logits = self.lm_head(outputs[0]) + self.final_logits_bias
+        if self.output_vocab_ids is not None and labels is None:
+            lm_logits = self._get_output_vocab_logits(outputs[0])
+        else:
+            lm_logits = self.lm_head(outputs[0]) + self.final_logits_bias
 
         masked_lm_loss = None
         if labels is not None:
@@ -1373,6 +1828,8 @@ class BartForConditionalGeneration(BartPretrainedModel):
         cross_attn_head_mask=None,
         use_cache=None,
         encoder_outputs=None,
+        cross_attn_key_values=None,
+        decoder_static_cache_length=None,
         **kwargs
     ):
         # cut decoder_input_ids if past is used
@@ -1389,13 +1846,25 @@ class BartForConditionalGeneration(BartPretrainedModel):
             "decoder_head_mask": decoder_head_mask,
             "cross_attn_head_mask": cross_attn_head_mask,
             "use_cache": use_cache,  # change this to avoid caching (presumably for debugging)
+            "cross_attn_key_values": cross_attn_key_values, # SentBS: only used on the first step, when past is None
+            "decoder_static_cache_length": decoder_static_cache_length, # SentBS: only used on the first step
         }
 
+    def precompute_cross_attention_kv(self, encoder_hidden_states: torch.Tensor) -> Tuple[Tuple[torch.Tensor, torch.Tensor], ...]:
+        """
+        SentBS: per layer cross-attention key/value states of encoder_hidden_states (one row per source), to pass as
+        `cross_attn_key_values` (with the same `encoder_outputs`) to every later `generate` call on those sources, so
+        the decoder layers do not re-project the encoder states at the start of each call
+        """
+        return self.get_decoder().precompute_cross_attention_kv(encoder_hidden_states)
+
     def prepare_decoder_input_ids_from_labels(self, labels: torch.Tensor):
         return shift_tokens_right(labels, self.config.pad_token_id, self.config.decoder_start_token_id)
 
     @staticmethod
     def _reorder_cache(past, beam_idx):
+        if isinstance(past, StaticKVCache): # SentBS: reordered in place
+            return past.reorder(beam_idx)
         reordered_past = ()
         for layer_past in past:
             # cached cross_attention states don't have to be reordered -> they are always the same
@@ -0,0 +1,69 @@
+"""
+Mine the restricted output vocabulary used by `--output_vocab_file` (see BartForConditionalGeneration.set_output_vocab):
+every token id occurring in the tokenized training targets, plus the special, added and label prompt tokens.
+During decoding the source token ids of each example are added to it.
+
+Example:
+    python output_vocab.py --tokenizer_path results/sentctrl_reproduced --train_file data/original_clean/train_rate_concat_sent-ctrl.csv \
+        --output data/original_clean/output_vocab.json
+"""
+import json
+import argparse
+from collections import Counter
+from typing import List, Optional
+
+import torch
+from transformers import AutoTokenizer, PreTrainedTokenizerBase
+
+from decoding_vocab import get_decoding_vocab
+
+
+def mine_output_vocab(tokenizer: PreTrainedTokenizerBase, target_texts: List[str], min_count: int = 1, batch_size: int = 1000) -> List[int]:
+    counts = Counter()
+    for start in range(0, len(target_texts), batch_size):
+        for ids in tokenizer(target_texts[start : start + batch_size], add_special_tokens=False).input_ids:
+            counts.update(ids)
+    token_ids = {token_id for token_id, count in counts.items() if count >= min_count}
+    decoding_vocab = get_decoding_vocab(tokenizer)
+    token_ids |= decoding_vocab.added_ids # special tokens and <label-sep> / <sent-sep>
+    for prompt_ids in decoding_vocab.label_prompt_ids.values():
+        token_ids.update(prompt_ids)
+    return sorted(token_ids)
+
+
+def save_output_vocab(token_ids: List[int], path: str, tokenizer: Optional[PreTrainedTokenizerBase] = None):
+    with open(path, "w") as fw:
+        json.dump({"vocab_size": len(tokenizer) if tokenizer is not None else None, "token_ids": token_ids}, fw)
+
+
+def load_output_vocab(path: str, device: Optional[torch.device] = None) -> torch.LongTensor:
+    with open(path) as fr:
+        token_ids = json.load(fr)["token_ids"]
+    return torch.tensor(token_ids, dtype=torch.long, device=device)
+
+
+def parse_arguments(parser):
+    parser.add_argument('--tokenizer_path', type=str, default="", help="path of the generation model whose tokenizer is used")
+    parser.add_argument('--train_file', type=str, nargs="+", default=[], help="csv file(s) whose targets the vocabulary is mined from")
+    parser.add_argument('--column', type=str, default="summary", help="target column of the csv files")
+    parser.add_argument('--min_count', type=int, default=1, help="minimum number of occurrences of a token in the targets")
+    parser.add_argument('--output', type=str, default="output_vocab.json", help="json file the vocabulary is written to")
+
+    args = parser.parse_args()
+    for k in args.__dict__:
+        print(k + ": " + str(args.__dict__[k]))
+    return args
+
+
+if __name__ == "__main__":
+    import pandas as pd
+
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path, use_fast=True)
+    target_texts = []
+    for train_file in args.train_file:
+        target_texts += [str(text) for text in pd.read_csv(train_file)[args.column].tolist()]
+    token_ids = mine_output_vocab(tokenizer, target_texts, min_count=args.min_count)
+    save_output_vocab(token_ids, args.output, tokenizer)
+    print("output vocabulary: {} of {} tokens, written to: {}".format(len(token_ids), len(tokenizer), args.output))
@@ -0,0 +1,116 @@
+"""
+Parity report of reduced inference precisions (see inference_precision.py) against fp32, on the first test examples.
+Every precision decodes the same sources with deterministic beam search, and is compared with fp32 on
+    rouge1 / rouge2 / rougeL: against the gold summaries (label prompts removed), next to the fp32 scores
+    exact_match: fraction of outputs identical to the fp32 output
+    label_seq_agreement: fraction of outputs with the same label prompt sequence as fp32 (seg-ctrl models)
+    label_agreement: fraction of fp32 label prompts matched at the same position
+    sent_count_agreement: fraction of outputs with as many sentences as the fp32 output
+plus the decoding time per example.
+
+Example:
+    python precision_parity.py --generation_model_path results/segctrl_reproduced --test_file data/original_seg_clean/test.csv \
+        --num_examples 100 --precisions bf16 int8 --output results/precision_parity.json
+"""
+import re
+import json
+import time
+import argparse
+
+import nltk
+import pandas as pd
+import torch
+from tqdm import tqdm
+from transformers import AutoConfig, AutoTokenizer
+
+from modeling_bart import BartForConditionalGeneration
+from inference_precision import PRECISIONS, apply_inference_precision
+from utils import remove_prompts_fast, batch_remove_prompts
+from rouge.rouge import StreamingRouge
+
+
+LABEL_PROMPT_PATTERN = re.compile(r'<label-sep>([a-z_A-Z]+)<sent-sep>')
+
+
+def parse_arguments(parser):
+    parser.add_argument('--generation_model_path', type=str, default="", help="the path of the generation model to be loaded")
+    parser.add_argument('--test_file', type=str, default="", help="csv test file with text and summary columns")
+    parser.add_argument('--num_examples', type=int, default=100, help="number of test examples (from the start of the test file) to compare on")
+    parser.add_argument('--precisions', type=str, nargs="+", default=["bf16", "int8"], choices=PRECISIONS[1:], help="precisions compared against fp32")
+    parser.add_argument('--device', type=str, default="cpu", help="device to decode on, int8 needs cpu")
+    parser.add_argument('--num_beams', type=int, default=4, help="beam size of the deterministic beam search")
+    parser.add_argument('--max_source_length', type=int, default=2048, help="maximum number of token ids allowed for the source before truncation")
+    parser.add_argument('--gen_target_max', type=int, default=800, help="maximum number of generated tokens")
+    parser.add_argument('--output', type=str, default="precision_parity.json", help="json file the report is written to")
+
+    args = parser.parse_args()
+    for k in args.__dict__:
+        print(k + ": " + str(args.__dict__[k]))
+    return args
+
+
+def decode_all(args, precision, texts):
+    config = AutoConfig.from_pretrained(args.generation_model_path)
+    config.max_position_embeddings = args.max_source_length
+    model = BartForConditionalGeneration.from_pretrained(args.generation_model_path, config=config).to(args.device)
+    tokenizer = AutoTokenizer.from_pretrained(args.generation_model_path, use_fast=True)
+    model.resize_token_embeddings(len(tokenizer))
+    apply_inference_precision(model.eval(), precision)
+
+    outputs = []
+    start_time = time.time()
+    for text in tqdm(texts, desc=precision):
+        input_ids = tokenizer(text, max_length=args.max_source_length, truncation=True, return_tensors="pt").input_ids.to(args.device)
+        output_ids = model.generate(input_ids=input_ids, max_length=args.gen_target_max, num_beams=args.num_beams, do_sample=False, cross_attn_broadcast=True)
+        outputs.append(tokenizer.decode(output_ids[0], skip_special_tokens=True).strip())
+    return outputs, (time.time() - start_time) / max(1, len(texts))
+
+
+def get_labels(text):
+    return LABEL_PROMPT_PATTERN.findall(text)
+
+
+def get_num_sents(text):
+    return len(nltk.sent_tokenize(remove_prompts_fast(text).strip()))
+
+
+def compare(outputs, reference_outputs, golds):
+    rouge = StreamingRouge(use_stemmer=True)
+    exact, label_seq, label_matched, label_total, sent_count = 0, 0, 0, 0, 0
+    for output, reference_output, clean_output, clean_gold in zip(outputs, reference_outputs, batch_remove_prompts(outputs), batch_remove_prompts(golds)):
+        rouge.add(clean_output.strip(), clean_gold.strip())
+        exact += output == reference_output
+        labels, reference_labels = get_labels(output), get_labels(reference_output)
+        label_seq += labels == reference_labels
+        label_matched += sum(label == reference_label for label, reference_label in zip(labels, reference_labels))
+        label_total += len(reference_labels)
+        sent_count += get_num_sents(output) == get_num_sents(reference_output)
+    num_examples = max(1, len(outputs))
+    return {
+        **{key: round(value.mid.fmeasure * 100, 4) for key, value in rouge.aggregate().items()},
+        "exact_match": exact / num_examples,
+        "label_seq_agreement": label_seq / num_examples,
+        "label_agreement": label_matched / label_total if label_total > 0 else None,
+        "sent_count_agreement": sent_count / num_examples,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+    torch.manual_seed(0)
+
+    df_test = pd.read_csv(args.test_file)
+    texts = df_test["text"].tolist()[:args.num_examples]
+    golds = df_test["summary"].tolist()[:args.num_examples]
+
+    fp32_outputs, fp32_time = decode_all(args, "fp32", texts)
+    report = {"num_examples": len(texts), "fp32": {**compare(fp32_outputs, fp32_outputs, golds), "sec_per_example": fp32_time}}
+    for precision in args.precisions:
+        outputs, sec_per_example = decode_all(args, precision, texts)
+        report[precision] = {**compare(outputs, fp32_outputs, golds), "sec_per_example": sec_per_example, "speedup": fp32_time / max(sec_per_example, 1e-9)}
+
+    print(json.dumps(report, indent=2))
+    with open(args.output, "w") as fw:
+        json.dump(report, fw, indent=2)
+    print("parity report written to:", args.output)
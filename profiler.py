@@ -0,0 +1,124 @@
+import json
+import time
+from collections import defaultdict
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class _StageTimer:
+    __slots__ = ("profiler", "stage", "start")
+
+    def __init__(self, profiler, stage):
+        self.profiler = profiler
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add_time(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class StageProfiler:
+    """
+    Opt-in wall time and counter bookkeeping for SentBS runs.
+    When disabled (the default), `timed` hands back a shared no-op context manager and `count` returns
+    immediately, so instrumented code paths only pay for one attribute lookup per call.
+    NOTE: the decoding scripts set CUDA_LAUNCH_BLOCKING=1, so wall times of GPU stages are already synchronous.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.examples = []
+        self.total_times = defaultdict(float)
+        self.total_calls = defaultdict(int)
+        self.total_counts = defaultdict(int)
+        self._reset_example()
+
+    def _reset_example(self):
+        self.curr_idx = None
+        self.curr_start = None
+        self.curr_times = defaultdict(float)
+        self.curr_calls = defaultdict(int)
+        self.curr_counts = defaultdict(int)
+
+    def enable(self):
+        self.enabled = True
+
+    def timed(self, stage: str):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageTimer(self, stage)
+
+    def add_time(self, stage: str, seconds: float):
+        self.curr_times[stage] += seconds
+        self.curr_calls[stage] += 1
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            self.curr_counts[name] += n
+
+    def start_example(self, idx: int):
+        if not self.enabled:
+            return
+        self._reset_example()
+        self.curr_idx = idx
+        self.curr_start = time.perf_counter()
+
+    def end_example(self):
+        if not self.enabled or self.curr_start is None:
+            return None
+        record = {
+            "idx": self.curr_idx,
+            "time": time.perf_counter() - self.curr_start,
+            "stages": {stage: {"time": self.curr_times[stage], "calls": self.curr_calls[stage]} for stage in sorted(self.curr_times)},
+            "counts": dict(sorted(self.curr_counts.items())),
+        }
+        for stage, seconds in self.curr_times.items():
+            self.total_times[stage] += seconds
+            self.total_calls[stage] += self.curr_calls[stage]
+        for name, n in self.curr_counts.items():
+            self.total_counts[name] += n
+        self.examples.append(record)
+        self._reset_example()
+        return record
+
+    def summary(self):
+        num_examples = len(self.examples)
+        total_time = sum(record["time"] for record in self.examples)
+        stages = {}
+        for stage in sorted(self.total_times, key=lambda x: -self.total_times[x]):
+            stages[stage] = {
+                "time": self.total_times[stage],
+                "calls": self.total_calls[stage],
+                "time_per_call": self.total_times[stage] / max(1, self.total_calls[stage]),
+                "share": self.total_times[stage] / total_time if total_time > 0 else 0.0,
+            }
+        counts = dict(sorted(self.total_counts.items()))
+        if counts.get("lane_steps", 0) > 0:
+            counts["padded_lane_ratio"] = counts.get("padded_lane_steps", 0) / counts["lane_steps"]
+        return {
+            "num_examples": num_examples,
+            "time": total_time,
+            "time_per_example": total_time / max(1, num_examples),
+            "tokens_per_second": self.total_counts.get("tokens_generated", 0) / total_time if total_time > 0 else 0.0,
+            "stages": stages,
+            "counts": counts,
+        }
+
+    def dump(self, path: str):
+        with open(path, "w", encoding="utf-8") as fw:
+            json.dump({"summary": self.summary(), "examples": self.examples}, fw, indent=2)
+
+
+# shared by the decoding scripts and the custom generation loops
+PROFILER = StageProfiler()
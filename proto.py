@@ -1,5 +1,8 @@
 from typing import Tuple, List, Optional
 import torch 
+from termcolor import colored
+
+from profiler import PROFILER
 
 # --------- Generation Functions ---------
 class GenerationItem:
@@ -28,3 +31,37 @@ class GenerationItem:
 
     def get_avg_log(self):
         return self.logsum / self.num_tokens_generated
+
+
+# --------- Sorting Functions ---------
+def sort_filter_gen_history(sent_options:List[GenerationItem], n:int): # n is the number of top sentences to select
+    with PROFILER.timed("sort"):
+        return sorted(sent_options, key=lambda item: (item.get_avg_log()+item.classification_score), reverse=True)[:n] # sort in descending order
+
+def sort_filter_gen_history_with_length_penalty(sent_options:List[GenerationItem], n:int): # n is the number of top sentences to select
+    with PROFILER.timed("sort"):
+        return sorted(sent_options, key=lambda item: item.seq_score, reverse=True)[:n] # sort in descending order
+
+def sort_filter_gen_histrory_by_rank(sent_options:List[GenerationItem], n:int):
+    logsum_scores = [item.get_avg_log() for item in sent_options]
+    logsum_sorted = sorted(logsum_scores, reverse=True)
+    # print("sorted avg:", logsum_sorted)
+    def get_combined_rank(item):
+        avg = item.get_avg_log()
+        if avg in logsum_sorted:
+            logsum_rank = logsum_sorted.index(avg)
+        else:
+            print(colored(f"log sum avg not found in whole list: {avg} | {logsum_sorted}", 'red'))
+   
+        # logsum_rank = (logsum_sorted==item.get_avg_log()).nonzero()[0][0].item() # if multiple items have same score, take the earlier rank
+        # logsum_rank = (logsum_sorted==item.get_avg_log()).nonzero().squeeze().item()
+        comb_rank = logsum_rank + item.classification_rank
+        return (comb_rank, item.classification_rank) # specify sorting secondary key
+    sorted_items = sorted(sent_options, key=get_combined_rank, reverse=False) # the lower the score, the better the overall performance
+    # for i, item in enumerate(sorted_items):
+    #     print(i, ":", get_combined_rank(item), item.classification_rank, item.get_avg_log(), item.text)
+    return sorted_items[:n]
+
+def sort_filter_gen_history_with_classification_rank(sent_options:List[GenerationItem], n:int): # n is the number of top sentences to select
+    # classification rank: the lower the better, reverse as compared to avg logsum
+    return sorted(sent_options, key=lambda item: (item.get_avg_log()-item.classification_rank), reverse=True)[:n] # sort in descending order
@@ -0,0 +1,73 @@
+import os
+import json
+from typing import Optional
+
+
+class ResultsJournal:
+    """
+    Append-only journal of per-example decoding results, one json record per line.
+    A record is committed once its line is flushed; every `fsync_every` records (and on close) the
+    file is fsync-ed so that a pre-empted run loses at most the last few examples.
+    On open, a torn last line (from a crash mid-write) is dropped and the file is truncated back to the
+    last complete record, so the journal can always be resumed from `last_idx + 1`.
+    """
+    def __init__(self, path: str, fsync_every: int = 8, resume: bool = True):
+        self.path = path
+        self.fsync_every = max(1, fsync_every)
+        self.records = []
+        self._num_unsynced = 0
+        if resume and os.path.exists(path):
+            self._recover()
+            self.fw = open(path, "a", encoding="utf-8")
+        else:
+            self.fw = open(path, "w", encoding="utf-8")
+
+    def _recover(self):
+        valid_bytes = 0
+        with open(self.path, "rb") as fr:
+            for line in fr:
+                if not line.endswith(b"\n"):
+                    break # torn write
+                try:
+                    record = json.loads(line.decode("utf-8"))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    break
+                self.records.append(record)
+                valid_bytes += len(line)
+        if valid_bytes < os.path.getsize(self.path):
+            with open(self.path, "r+b") as fw:
+                fw.truncate(valid_bytes)
+
+    @property
+    def last_idx(self) -> Optional[int]:
+        return self.records[-1]["idx"] if len(self.records) > 0 else None
+
+    def append(self, idx: int, output: str, labels=None, elapsed=None, scores=None):
+        record = {
+            "idx": idx,
+            "output": output,
+            "labels": labels,
+            "time": elapsed,
+            "scores": scores if scores is not None else {},
+        }
+        self.fw.write(json.dumps(record, ensure_ascii=False)+"\n")
+        self.fw.flush()
+        self.records.append(record)
+        self._num_unsynced += 1
+        if self._num_unsynced >= self.fsync_every:
+            self.sync()
+        return record
+
+    def sync(self):
+        self.fw.flush()
+        os.fsync(self.fw.fileno())
+        self._num_unsynced = 0
+
+    def close(self):
+        if not self.fw.closed:
+            self.sync()
+            self.fw.close()
+
+
+def get_journal_file_path(result_file_path: str) -> str:
+    return os.path.splitext(result_file_path)[0] + ".journal"
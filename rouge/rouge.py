@@ -19,6 +19,7 @@ import absl  # Here to have a nice missing dependency error message early on
 import nltk  # Here to have a nice missing dependency error message early on
 import numpy  # Here to have a nice missing dependency error message early on
 import six  # Here to have a nice missing dependency error message early on
+import functools
 from rouge_score import rouge_scorer, scoring
 
 import datasets
@@ -106,3 +107,65 @@ class Rouge(datasets.Metric):
                 result[key] = list(score[key] for score in scores)
 
         return result
+
+
+class _CachedStemmer:
+    # porter stemming is a pure function of the token, so it can be memoised across examples
+    def __init__(self, stemmer, maxsize):
+        self.stem = functools.lru_cache(maxsize=maxsize)(stemmer.stem)
+
+
+def _cache_stemmer(scorer, maxsize):
+    # rouge_score < 0.1 keeps the stemmer on the scorer, later versions on its tokenizer
+    owner = getattr(scorer, "_tokenizer", scorer)
+    if getattr(owner, "_stemmer", None) is not None:
+        owner._stemmer = _CachedStemmer(owner._stemmer, maxsize)
+
+
+class StreamingRouge:
+    """
+    Incremental ROUGE for decoding loops that score one example at a time.
+    Unlike calling `Rouge.compute` per example, a single RougeScorer (with a memoised stemmer) is kept for the
+    whole run, the running average is kept as sums, and bootstrap resampling is done once in `aggregate`.
+    """
+    def __init__(self, rouge_types=None, use_stemmer=False, stem_cache_size=2**16):
+        self.rouge_types = rouge_types if rouge_types is not None else ["rouge1", "rouge2", "rougeL"]
+        self.scorer = rouge_scorer.RougeScorer(rouge_types=self.rouge_types, use_stemmer=use_stemmer)
+        if use_stemmer:
+            _cache_stemmer(self.scorer, stem_cache_size)
+        self.scores = []
+        self.totals = {key: 0.0 for key in self.rouge_types}
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, prediction, reference):
+        """
+        score one pair, returning its f-measures (x100) in the same format as the per-example metric.compute results
+        """
+        score = self.scorer.score(reference, prediction)
+        self.scores.append(score)
+        result = {key: score[key].fmeasure * 100 for key in self.rouge_types}
+        for key, value in result.items():
+            self.totals[key] += value
+        return result
+
+    def average(self):
+        return {key: total / max(1, len(self.scores)) for key, total in self.totals.items()}
+
+    def aggregate(self, n_samples=1000):
+        """
+        bootstrap confidence interval over all scored examples, same output as Rouge.compute with use_agregator=True
+        """
+        aggregator = scoring.BootstrapAggregator(n_samples=n_samples)
+        for score in self.scores:
+            aggregator.add_scores(score)
+        return aggregator.aggregate()
+
+    def summary(self, n_samples=1000):
+        result = self.aggregate(n_samples) if len(self.scores) > 0 else {}
+        return {
+            "num_examples": len(self.scores),
+            "average": self.average(),
+            "bootstrap": {key: {"low": value.low.fmeasure * 100, "mid": value.mid.fmeasure * 100, "high": value.high.fmeasure * 100} for key, value in result.items()},
+        }
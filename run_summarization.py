@@ -49,6 +49,9 @@ from transformers.tokenization_utils_base import BatchEncoding
 
 # SCH: self defined modules
 from customized_trainer import MyTrainer # SCH: customized trainer
+from tokenized_cache import load_or_tokenize
+from streaming_eval import StreamingSummarizationMetrics, TeacherForcedPromptAccuracy
+from decoding_vocab import get_decoding_vocab
 # from soft_tune import freeze_params_except_soft_emb, SoftEmbedding, init_emb
 
 # Will error if the minimal version of Transformers is not installed. Remove at your own risks.
@@ -167,13 +170,13 @@ class DataTrainingArguments:
             "than this will be truncated, sequences shorter will be padded."
         },
     )
-    # max_target_length: Optional[int] = field(
-    #     default=400,
-    #     metadata={
-    #         "help": "The maximum total sequence length for target text after tokenization. Sequences longer "
-    #         "than this will be truncated, sequences shorter will be padded."
-    #     },
-    # )
+    max_target_length: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "The maximum total sequence length for target text after tokenization. Sequences longer "
+            "than this will be truncated. Will default to `gen_target_max`."
+        },
+    )
     # val_max_target_length: Optional[int] = field(
     #     default=None,
     #     metadata={
@@ -228,6 +231,35 @@ class DataTrainingArguments:
     source_prefix: Optional[str] = field(
         default=None, metadata={"help": "A prefix to add before every source text (useful for T5 models)."}
     )
+    # SCH
+    tokenized_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Where to keep the tokenized train/validation files, keyed by file content, tokenizer and "
+            "preprocessing settings. Defaults to `.tokenized_cache` next to each data file."
+        },
+    )
+    streaming_eval: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to decode and score the generated predictions batch by batch during evaluation, "
+            "instead of keeping all of them in memory until the end (needs `predict_with_generate`)."
+        },
+    )
+    proxy_eval: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to report the generation-free label prompt accuracy (prompt_acc, prompt_token_acc, token_acc) "
+            "of the teacher-forced eval forward instead of generating; can be used as `metric_for_best_model`."
+        },
+    )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "If set, build train batches of similar lengths holding at most this many padded source + target "
+            "tokens, instead of `per_device_train_batch_size` random examples."
+        },
+    )
 
     def __post_init__(self):
         # SCH: silence error if only doing prediction
@@ -426,6 +458,7 @@ def main(
             )
         
     padding = "max_length" if data_args.pad_to_max_length else False
+    max_target_length = data_args.max_target_length if data_args.max_target_length is not None else model_args.gen_target_max
 
     if training_args.label_smoothing_factor > 0 and not hasattr(model, "prepare_decoder_input_ids_from_labels"):
         logger.warning(
@@ -440,9 +473,8 @@ def main(
         model_inputs = tokenizer(inputs, max_length=data_args.max_source_length, padding=padding, truncation=True)
         # Setup the tokenizer for targets
         with tokenizer.as_target_tokenizer():
-            # labels = tokenizer(targets, max_length=config.gen_target_max, padding=padding, truncation=True)
-            # SCH: NOTE: since we use filtered data, no need to train with further truncation
-            labels = tokenizer(targets, padding=padding, max_length=data_args.max_source_length, truncation=True)
+            # SCH: targets are truncated to the generation limit, the model never generates beyond it
+            labels = tokenizer(targets, max_length=max_target_length, padding=padding, truncation=True)
 
         # If we are padding here, replace all tokenizer.pad_token_id in the labels by -100 when we want to ignore
         # padding in the loss.
@@ -454,6 +486,39 @@ def main(
 
         return model_inputs  
 
+    def tokenize_split(dataset, data_file, max_samples):
+        if data_file is None: # dataset from the hub, rely on the datasets cache
+            return dataset.map(
+                preprocess_function,
+                batched=True,
+                num_proc=data_args.preprocessing_num_workers,
+                remove_columns=column_names,
+                load_from_cache_file=not data_args.overwrite_cache,
+            )
+        # SCH: everything preprocess_function depends on, apart from the file content and the tokenizer
+        settings = {
+            "text_column": text_column,
+            "summary_column": summary_column,
+            "prefix": prefix,
+            "max_source_length": data_args.max_source_length,
+            "max_target_length": max_target_length,
+            "padding": padding,
+            "ignore_pad_token_for_loss": data_args.ignore_pad_token_for_loss,
+            "max_samples": max_samples,
+        }
+        return load_or_tokenize(
+            dataset,
+            data_file,
+            tokenizer,
+            preprocess_function,
+            settings,
+            cache_dir=data_args.tokenized_cache_dir,
+            num_proc=data_args.preprocessing_num_workers,
+            remove_columns=column_names,
+            # SCH: only the process writing the cache rebuilds it, the others load what it wrote (see main_process_first below)
+            overwrite_cache=data_args.overwrite_cache and training_args.local_process_index == 0,
+        )
+
     if training_args.do_train:
         print("loading train dataset...")
         train_dataset = datasets["train"]
@@ -461,14 +526,8 @@ def main(
             raise ValueError("--do_train requires a train dataset")
         if data_args.max_train_samples is not None:
             train_dataset = train_dataset.select(range(data_args.max_train_samples))
-        train_dataset = train_dataset.map(
-            preprocess_function,
-            batched=True,
-            num_proc=data_args.preprocessing_num_workers,
-            remove_columns=column_names,
-            # load_from_cache_file=not data_args.overwrite_cache,
-            load_from_cache_file=False
-        )
+        with training_args.main_process_first(desc="tokenize"): # rank 0 writes the cache, the other ranks load it
+            train_dataset = tokenize_split(train_dataset, data_args.train_file if data_args.dataset_name is None else None, data_args.max_train_samples)
     if training_args.do_eval:
         print("loading val dataset...")
         # max_target_length = config.gen_max_length
@@ -477,14 +536,8 @@ def main(
         eval_dataset = datasets["validation"]
         if data_args.max_eval_samples is not None:
             eval_dataset = eval_dataset.select(range(data_args.max_eval_samples))
-        eval_dataset = eval_dataset.map(
-            preprocess_function,
-            batched=True,
-            num_proc=data_args.preprocessing_num_workers,
-            remove_columns=column_names,
-            # load_from_cache_file=not data_args.overwrite_cache,
-            load_from_cache_file=False,
-        )
+        with training_args.main_process_first(desc="tokenize"):
+            eval_dataset = tokenize_split(eval_dataset, data_args.validation_file if data_args.dataset_name is None else None, data_args.max_eval_samples)
 
     # if training_args.do_predict: 
     #     max_target_length = data_args.val_max_target_length
@@ -559,6 +612,25 @@ def main(
 
         return result
 
+    def get_streaming_metrics():
+        return StreamingSummarizationMetrics(tokenizer, postprocess_text=postprocess_text, ignore_pad_token_for_loss=data_args.ignore_pad_token_for_loss)
+
+    def get_proxy_metrics():
+        decoding_vocab = get_decoding_vocab(tokenizer)
+        # SCH: selecting checkpoints on a prompt metric needs the prompts, rather than falling back to token_acc
+        require_prompts = "prompt" in (training_args.metric_for_best_model or "")
+        return TeacherForcedPromptAccuracy(decoding_vocab.label_sep_id, decoding_vocab.sent_sep_id, pad_token_id=decoding_vocab.pad_token_id, require_prompts=require_prompts)
+
+    if data_args.proxy_eval:
+        if training_args.predict_with_generate:
+            raise ValueError("`proxy_eval` scores the teacher-forced forward, it can not be combined with `predict_with_generate`")
+        get_proxy_metrics() # fail before training if checkpoints can not be selected on it
+        streaming_metrics_fn = get_proxy_metrics
+    elif data_args.streaming_eval and training_args.predict_with_generate:
+        streaming_metrics_fn = get_streaming_metrics
+    else:
+        streaming_metrics_fn = None
+
     # Initialize our Trainer
     # trainer = Seq2SeqTrainer(
     trainer = MyTrainer( # SCH: for trainer
@@ -569,6 +641,8 @@ def main(
         tokenizer=tokenizer,
         data_collator=data_collator,
         compute_metrics=compute_metrics if training_args.predict_with_generate else None,
+        max_tokens_per_batch=data_args.max_tokens_per_batch,
+        streaming_metrics_fn=streaming_metrics_fn,
     )
 
     # Training
@@ -8,22 +8,19 @@ import argparse
 from tqdm import tqdm
 from termcolor import colored
 import math 
+import time
+import json
 
-import pandas as pd
 import torch
 
 from transformers.tokenization_utils_base import BatchEncoding
+from transformers.modeling_outputs import BaseModelOutput
 
 from transformers import (
     set_seed,
     PreTrainedModel,
     PreTrainedTokenizerFast,
-    AutoConfig,
-    AutoModelForSeq2SeqLM,
-    AutoTokenizer,
     BeamSearchScorer,
-    AutoTokenizer,
-    AutoModelForSequenceClassification
 )
 
 from transformers.generation_stopping_criteria import (
@@ -42,9 +39,21 @@ from beam_search_sent_utils import (
     beam_sample,
 )
 
-from proto import GenerationItem
+from proto import (
+    GenerationItem,
+    sort_filter_gen_history,
+    sort_filter_gen_history_with_length_penalty,
+)
+from results_journal import ResultsJournal, get_journal_file_path
+from profiler import PROFILER
+from decoding_vocab import get_decoding_vocab
+from modeling_bart import BartForConditionalGeneration
+from inference_precision import PRECISIONS, apply_inference_precision
+from output_vocab import load_output_vocab
+from decode_step import DECODE_STEP_MODES, enable_decode_step
+from detokenizer import fast_decode
+from rouge.rouge import StreamingRouge
 
-from datasets import load_metric, load_dataset, load_from_disk
 import numpy as np
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -67,6 +76,8 @@ def parse_arguments(parser):
     parser.add_argument('--res_file_name', type=str, default="auto", help="where to store txt file, whether use auto generated name")
     
     parser.add_argument('--test_start_idx', type=int, default=0, help="the test example idx to start evaluation from")
+    parser.add_argument('--test_end_idx', type=int, default=-1, help="the test example idx to stop evaluation at (exclusive), -1 to run till the end")
+    parser.add_argument('--num_threads', type=int, default=0, help="number of intra-op threads for torch, 0 to keep the torch default")
     parser.add_argument('--top_p', type=float, default=0.9, help="the cutoff p value for neucleus sampling")
     parser.add_argument('--run_num', type=int, default=0, help="the seed to use")
     parser.add_argument('--gen_size', type=int, default=8, help="number of sentence options to generate")
@@ -82,6 +93,20 @@ def parse_arguments(parser):
     parser.add_argument('--debug', action="store_true", default=False, help="Whether in debug mode")
     parser.add_argument('--eval_rouge', action="store_true", default=False, help="Whether in evaluate rouge on the go")
     parser.add_argument('--beam_sample', action="store_true", default=False, help="Whether to use beam sampling for nucleus sampling")
+    parser.add_argument('--no_resume', action="store_true", default=False, help="Whether to ignore (and overwrite) an existing results journal instead of resuming from it")
+    parser.add_argument('--journal_fsync_every', type=int, default=8, help="number of examples between fsyncs of the results journal")
+    parser.add_argument('--profile', action="store_true", default=False, help="Whether to record per-stage timing and counters, written as json next to the rouge file")
+    parser.add_argument('--per_example_seed', action="store_true", default=False, help="Whether to re-seed before every example with a seed derived from run_num and the example idx, so results do not depend on sharding")
+    parser.add_argument('--no_cross_attn_broadcast', action="store_true", default=False, help="Whether to copy the encoder outputs once per beam/sample as in the original generate, instead of sharing them across the lanes of a source in cross-attention")
+    parser.add_argument('--encoder_attention_window', type=int, default=0, help="if > 0, encoder tokens only attend to tokens at most this many positions away and to the label prompt (Longformer-style local + global attention); 0 for dense attention")
+    parser.add_argument('--precision', type=str, default="fp32", choices=PRECISIONS, help="inference precision of the generator: fp32, bf16 autocast, or dynamic int8 quantisation of the decoder and lm_head (CPU only)")
+    parser.add_argument('--output_vocab_file', type=str, default="", help="output vocabulary mined by output_vocab.py; if given, only its tokens and the source tokens of the example can be generated, which shrinks the lm_head projection")
+    parser.add_argument('--static_kv_cache', action="store_true", default=False, help="Whether to cache decoder keys/values in buffers preallocated for the maximum target length instead of growing them every step")
+    parser.add_argument('--bundle_path', type=str, default="", help="model bundle built by model_bundle.py; if given, the generator, classifier and tokenizers are loaded from it instead of generation_model_path / classification_model_path")
+    parser.add_argument('--mmap_weights', action="store_true", default=False, help="Whether to memory-map the weights from --bundle_path instead of copying them, so decode processes on one host share them (CPU only)")
+    parser.add_argument('--draft_model_path', type=str, default="", help="small draft model (same tokenizer) for speculative decoding of the sampled and beam search candidates: it proposes tokens that the generation model verifies in one forward; empty to decode without it")
+    parser.add_argument('--num_draft_tokens', type=int, default=4, help="number of tokens the draft model proposes per verification forward")
+    parser.add_argument('--decode_step', type=str, default="none", choices=DECODE_STEP_MODES, help="how cached decoding steps run (needs --static_kv_cache): none for the full model forward, or the lean decode_step as is (eager), through torch.compile (compile), or traced with torch.jit.trace (trace)")
 
     args = parser.parse_args()
     for k in args.__dict__:
@@ -90,6 +115,8 @@ def parse_arguments(parser):
 
 parser = argparse.ArgumentParser()
 args = parse_arguments(parser)
+if args.mmap_weights and not args.bundle_path:
+    raise ValueError("--mmap_weights needs a model bundle, see --bundle_path")
 # --------- Parameters ---------
 assert args.beam_size <= (args.gen_size * args.beam_size) # if larger, we are not filtering and this makes little sense ...
 GEN_SIZE = args.gen_size # total number of sentence options to generate
@@ -100,9 +127,11 @@ TOP_P = args.top_p
 classifier_device = args.classifier_device
 model_path=args.generation_model_path
 classfication_model_path = args.classification_model_path
-config = AutoConfig.from_pretrained(model_path)
-config.gen_target_max = args.gen_target_max
-config.max_position_embeddings = args.max_source_length
+config_overrides = {
+    "gen_target_max": args.gen_target_max,
+    "max_position_embeddings": args.max_source_length,
+    "encoder_attention_window": args.encoder_attention_window, # SentBS: see modeling_bart.BartAttention.local_global_attention
+}
 test_file = args.test_file
 write_mode = args.write_mode
 test_start_idx = args.test_start_idx
@@ -119,6 +148,7 @@ if args.write:
     else:
         result_file_path =  os.path.join(args.res_dir, args.res_file_name)
     rouge_file_path = result_file_path.replace(".txt", ".rouge")
+    profile_file_path = os.path.splitext(rouge_file_path)[0] + ".profile.json"
 
     if os.path.exists(result_file_path) and write_mode == "w":
         print(colored(f"please rename result file path to avoid it being over-written: {result_file_path}", 'red'))
@@ -147,28 +177,65 @@ labels2idx={
 }
 
 set_seed(args.run_num)
+if args.profile:
+    PROFILER.enable()
+if args.num_threads > 0:
+    torch.set_num_threads(args.num_threads)
+
+def get_example_seed(run_num, idx):
+    # SentBS: fixed per-example seed, independent of where the example idx falls in a shard
+    return run_num * 1000003 + idx
 
 # --------- Read Test File --------------
+# SentBS: pandas / datasets are imported where needed, to keep worker startup short
 if test_file[-3:] == "csv":
+    import pandas as pd
     df_test = pd.read_csv(test_file)
     df_test = df_test[['text', 'summary']]
     text_list = df_test["text"].tolist()
     target_list = df_test["summary"].tolist()
     total_test_examples = len(text_list)
 else:
+    from datasets import load_from_disk
     text_list = None
     raw_datasets = load_from_disk(args.dataset_path)
     total_test_examples = len(raw_datasets)
 
 print("total test examples in test file:",total_test_examples)
+test_end_idx = total_test_examples if args.test_end_idx < 0 else min(args.test_end_idx, total_test_examples)
     
 
 # --------- Load Generation Model ---------
 
-model = AutoModelForSeq2SeqLM.from_pretrained(model_path,config=config).to(device)
-tokenizer = AutoTokenizer.from_pretrained(model_path,use_fast=True) 
-model.resize_token_embeddings(len(tokenizer))
+if args.bundle_path:
+    # SentBS: generator (already extended and resized), classifier and tokenizers from a single file, see model_bundle.py
+    from model_bundle import load_bundle
+    bundle = load_bundle(args.bundle_path, device, config_overrides=config_overrides, load_classifier=args.load_classifier, mmap_weights=args.mmap_weights)
+    model, tokenizer = bundle.generator, bundle.tokenizer
+else:
+    from transformers import AutoConfig, AutoTokenizer
+    config = AutoConfig.from_pretrained(model_path)
+    for key, value in config_overrides.items():
+        setattr(config, key, value)
+    # SentBS: local BART, whose cross-attention can share the encoder outputs across beams (see cross_attn_broadcast)
+    model = BartForConditionalGeneration.from_pretrained(model_path,config=config).to(device)
+    tokenizer = AutoTokenizer.from_pretrained(model_path,use_fast=True) 
+    model.resize_token_embeddings(len(tokenizer))
+    # SentBS: the label prompt "label1 | label2 ==>" is global for local encoder attention
+    model.config.encoder_global_separator_ids = tokenizer(" ==>", add_special_tokens=False).input_ids
 model.eval()
+apply_inference_precision(model, args.precision)
+enable_decode_step(model, args.decode_step)
+if args.draft_model_path:
+    # SentBS: speculative decoding in the sample / beam_search / beam_sample loops, see speculative.py
+    from transformers import AutoConfig
+    from speculative import SpeculativeDrafter
+    draft_config = AutoConfig.from_pretrained(args.draft_model_path)
+    draft_config.max_position_embeddings = args.max_source_length
+    draft_model = BartForConditionalGeneration.from_pretrained(args.draft_model_path, config=draft_config).to(device)
+    draft_model.resize_token_embeddings(len(tokenizer))
+    model.drafter = SpeculativeDrafter(draft_model.eval(), num_draft_tokens=args.num_draft_tokens)
+output_vocab = load_output_vocab(args.output_vocab_file, device) if args.output_vocab_file else None
 # NOTE: here using my self-defined sample function to override what is defined in generation_utils
 model.sample = sample.__get__(model)
 
@@ -178,13 +245,20 @@ if gen_mode == "beam_search_sent":
 
 model.beam_sample = beam_sample.__get__(model)
 model.tokenizer = tokenizer
+# SentBS: token id tables shared by the decoding loops, built once per tokenizer
+model.decoding_vocab = get_decoding_vocab(tokenizer)
+decoding_vocab = model.decoding_vocab
 length_penalty = model.config.length_penalty
 
 if args.load_classifier:
     # --------- Load Classifier Model ---------
     num_labels=len(labels2idx.keys())
-    classification_model = AutoModelForSequenceClassification.from_pretrained(classfication_model_path, num_labels=num_labels).to(device)
-    classification_tokenizer = AutoTokenizer.from_pretrained(classfication_model_path, use_fast=True) 
+    if args.bundle_path:
+        classification_model, classification_tokenizer = bundle.classifier, bundle.classifier_tokenizer
+    else:
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+        classification_model = AutoModelForSequenceClassification.from_pretrained(classfication_model_path, num_labels=num_labels).to(device)
+        classification_tokenizer = AutoTokenizer.from_pretrained(classfication_model_path, use_fast=True) 
     classification_model.eval()
 
     # --------- Classification Functions ---------
@@ -196,8 +270,9 @@ if args.load_classifier:
             allowed_positions: set of idx positions in the target_labels that are possible class options
         """
         # NOTE: roberta only accepts up to 512 tokens
-        input_ids = tokenizer(text).input_ids
-        logits = model(torch.LongTensor([[input_ids[0]]+input_ids[1:-1][:510]+[input_ids[-1]]]).to(device)).logits.detach()
+        with PROFILER.timed("classifier"):
+            input_ids = tokenizer(text).input_ids
+            logits = model(torch.LongTensor([[input_ids[0]]+input_ids[1:-1][:510]+[input_ids[-1]]]).to(device)).logits.detach()
         logprob = torch.nn.functional.log_softmax(logits, dim=-1)[0]
         # indices = torch.sort(logprob, descending=True).indices
         # rank = (indices ==label_idx).nonzero().squeeze().item()
@@ -228,7 +303,7 @@ def process_generation(outputs, target_labels, prev_gen: Optional[GenerationItem
     prev_gen_logsum = prev_gen.logsum if prev_gen is not None else 0
     prev_gen_text = prev_gen.text if prev_gen is not None else ""
     # -------- get classification probability ----------
-    new_sent = tokenizer.decode(outputs.sequences[0, -len(outputs.scores):], skip_special_tokens=True)
+    new_sent = fast_decode(decoding_vocab, outputs.sequences[0, -len(outputs.scores):])
     classification_score, curr_label_idx = get_classification_logprob(classification_model,classification_tokenizer, new_sent, target_labels, allowed_positions)
     # -------- get logsum of samples ------------
     # stack the logits generated at each step to a tensor and transform logits to probs
@@ -238,7 +313,7 @@ def process_generation(outputs, target_labels, prev_gen: Optional[GenerationItem
     # collect the probability of the generated token, need to add a dummy dim in the end to make gather work
     gen_probs = torch.gather(probs, 2, gen_sequence[:, :, None]).squeeze(-1)  # -> shape [num_seq, seq_len]  
     # add log probability up, ignore places where padding is used (aka. where id is 1)
-    mask = (outputs.sequences==tokenizer.pad_token_id)[:, -len(outputs.scores):] 
+    mask = (outputs.sequences==decoding_vocab.pad_token_id)[:, -len(outputs.scores):] 
     gen_probs.masked_fill_(mask, 1) # replace pad token with prob of 1, so log prob will be 0
     # NOTE: need to get average score, otherwise we are biased towards shortsequences
     logsum = torch.sum(torch.log(gen_probs),1) + prev_gen_logsum
@@ -258,8 +333,8 @@ def process_beamsearch_generation(beamsearch_outputs, target_labels, start_pos,
     # NOTE: 2 dim, with first dim of size 1 in order to work
     assert beamsearch_outputs.sequences.size(0) == 1 and beamsearch_outputs.sequences.dim() == 2
     # cut off pad ids
-    pad_mask = beamsearch_outputs.sequences==tokenizer.pad_token_id
-    eos_mask = beamsearch_outputs.sequences==tokenizer.eos_token_id
+    pad_mask = beamsearch_outputs.sequences==decoding_vocab.pad_token_id
+    eos_mask = beamsearch_outputs.sequences==decoding_vocab.eos_token_id
     comb_mask = pad_mask.logical_or(eos_mask)
     # assert comb_mask.size(0) == 1 and comb_mask.dim() == 2
     last_valid_idx = (comb_mask == False).nonzero()[-1][1].item() 
@@ -291,7 +366,7 @@ def process_beamsearch_generation(beamsearch_outputs, target_labels, start_pos,
         # print(gen_probs)
         logsum = torch.sum(torch.log(gen_probs)).item()
         # classification score
-        new_sent = tokenizer.decode(gen_ids, skip_special_tokens=True)
+        new_sent = fast_decode(decoding_vocab, gen_ids)
         classification_score, curr_label_idx = get_classification_logprob(classification_model,classification_tokenizer, new_sent, target_labels, allowed_positions)
 
         # finalize value with prev_gen
@@ -329,8 +404,8 @@ def process_beamsample_generation(beamsearch_outputs, target_labels, start_pos,
 
     for gen_idx in range(beamsearch_outputs.sequences.size(0)):
         # cut off pad ids
-        pad_mask = beamsearch_outputs.sequences[gen_idx]==tokenizer.pad_token_id
-        eos_mask = beamsearch_outputs.sequences[gen_idx]==tokenizer.eos_token_id
+        pad_mask = beamsearch_outputs.sequences[gen_idx]==decoding_vocab.pad_token_id
+        eos_mask = beamsearch_outputs.sequences[gen_idx]==decoding_vocab.eos_token_id
         comb_mask = pad_mask.logical_or(eos_mask)
         # assert comb_mask.size(0) == 1 and comb_mask.dim() == 2
         last_valid_idx = (comb_mask == False).nonzero()[-1].item() 
@@ -352,7 +427,7 @@ def process_beamsample_generation(beamsearch_outputs, target_labels, start_pos,
             gen_probs = torch.stack([probs[pos, beam_idx, vocab_idx] for pos, (beam_idx, vocab_idx) in enumerate(zip(beam_indices, gen_ids))],dim=0)
             logsum = torch.sum(torch.log(gen_probs)).item()
             # classification score
-            new_sent = tokenizer.decode(gen_ids, skip_special_tokens=True)
+            new_sent = fast_decode(decoding_vocab, gen_ids)
             classification_score, curr_label_idx = get_classification_logprob(classification_model,classification_tokenizer, new_sent, target_labels, allowed_positions)
             # finalize value with prev_gen
             prev_gen_num_tokens = prev_gen.num_tokens_generated if prev_gen is not None else 0
@@ -388,8 +463,8 @@ def process_multisample_generation(sample_outputs, target_labels, start_pos, pre
         allowed_positions = {curr_pos, next_pos}
 
     # cut off pad ids
-    pad_mask = sample_outputs.sequences==tokenizer.pad_token_id
-    eos_mask = sample_outputs.sequences==tokenizer.eos_token_id
+    pad_mask = sample_outputs.sequences==decoding_vocab.pad_token_id
+    eos_mask = sample_outputs.sequences==decoding_vocab.eos_token_id
     comb_mask = pad_mask.logical_or(eos_mask)
     probs = torch.stack(sample_outputs.scores, dim=0).softmax(-1)
 
@@ -407,7 +482,7 @@ def process_multisample_generation(sample_outputs, target_labels, start_pos, pre
         gen_probs = torch.gather(curr_probs, -1, gen_ids[:, None]).squeeze(-1)
         logsum = torch.sum(torch.log(gen_probs)).item()
         # classification score
-        new_sent = tokenizer.decode(gen_ids, skip_special_tokens=True)
+        new_sent = fast_decode(decoding_vocab, gen_ids)
         classification_score, curr_label_idx = get_classification_logprob(classification_model,classification_tokenizer, new_sent, target_labels, allowed_positions)
         # finalize value with prev_gen
         prev_gen_num_tokens = prev_gen.num_tokens_generated if prev_gen is not None else 0
@@ -423,6 +498,34 @@ def process_multisample_generation(sample_outputs, target_labels, start_pos, pre
     
     return generations
     
+SOURCE_STATE = {} # SentBS: encoder outputs and cross-attention K/V of the current source, see get_source_kwargs
+
+def get_source_kwargs(input_ids):
+    """
+    generate kwargs with the encoder outputs and the precomputed cross-attention K/V of the source in input_ids (all
+    rows are the same source), computed once per source and shared by every generate call of the example instead of
+    re-running the encoder and re-projecting its outputs in each decoder layer every call
+    """
+    if args.no_cross_attn_broadcast: # precomputed states have one row per source, which needs the broadcast path
+        return {}
+    source_ids = input_ids[:1]
+    if "source_ids" not in SOURCE_STATE or not torch.equal(SOURCE_STATE["source_ids"], source_ids):
+        with torch.no_grad(), PROFILER.timed("encoder"):
+            attention_mask = source_ids.ne(decoding_vocab.pad_token_id).long()
+            encoder_outputs = model.get_encoder()(source_ids, attention_mask=attention_mask, return_dict=True)
+            SOURCE_STATE.update(
+                source_ids=source_ids,
+                attention_mask=attention_mask,
+                last_hidden_state=encoder_outputs.last_hidden_state,
+                cross_attn_key_values=model.precompute_cross_attention_kv(encoder_outputs.last_hidden_state),
+            )
+    return {
+        # a new ModelOutput every call, as generate may replace its last_hidden_state
+        "encoder_outputs": BaseModelOutput(last_hidden_state=SOURCE_STATE["last_hidden_state"]),
+        "attention_mask": SOURCE_STATE["attention_mask"],
+        "cross_attn_key_values": SOURCE_STATE["cross_attn_key_values"],
+    }
+
 def generate_sent(
     input_ids, 
     stopping_criteria, 
@@ -437,6 +540,10 @@ def generate_sent(
     return_dict_in_generate=True,
     init_beam_scores = None,
 ):
+    with PROFILER.timed("generate_sent"):
+        return _generate_sent(input_ids, stopping_criteria, max_length, top_p, do_sample, decoder_input_ids, early_stopping, num_return_sequences, num_beams, output_scores, return_dict_in_generate, init_beam_scores)
+
+def _generate_sent(input_ids, stopping_criteria, max_length, top_p, do_sample, decoder_input_ids, early_stopping, num_return_sequences, num_beams, output_scores, return_dict_in_generate, init_beam_scores):
     if decoder_input_ids is not None:
         return model.generate(
             input_ids=input_ids, 
@@ -451,6 +558,9 @@ def generate_sent(
             stopping_criteria=stopping_criteria,
             decoder_input_ids=decoder_input_ids,
             gen_mode = args.gen_mode, # pass this to customized generation kwargs
+            cross_attn_broadcast = not args.no_cross_attn_broadcast,
+            **get_source_kwargs(input_ids),
+            decoder_static_cache_length = max_length if args.static_kv_cache else None,
             init_beam_scores = init_beam_scores,
         )
     else: 
@@ -466,6 +576,9 @@ def generate_sent(
             return_dict_in_generate=return_dict_in_generate,
             stopping_criteria=stopping_criteria,
             gen_mode = args.gen_mode, # pass this to customized generation kwargs
+            cross_attn_broadcast = not args.no_cross_attn_broadcast,
+            **get_source_kwargs(input_ids),
+            decoder_static_cache_length = max_length if args.static_kv_cache else None,
             init_beam_scores = init_beam_scores,
         )
 
@@ -491,9 +604,9 @@ def generate_sentence_options(
     generations = []
 
     stopping_criteria = StoppingCriteriaList()
-    stopping_criteria.append(EndSentenceCriteria(tokenizer=tokenizer))
+    stopping_criteria.append(EndSentenceCriteria(tokenizer=tokenizer, decoding_vocab=decoding_vocab))
     multibatch_stopping_criteria = StoppingCriteriaList()
-    multibatch_stopping_criteria.append(MultiBatchEndSentenceCriteria(tokenizer.pad_token_id))
+    multibatch_stopping_criteria.append(MultiBatchEndSentenceCriteria(decoding_vocab.pad_token_id))
     decoder_input_ids= decoder_input_ids if decoder_input_ids is not None else prev_gen.token_ids if prev_gen is not None else None
     decoder_input_id_length = decoder_input_ids.size(1) if decoder_input_ids is not None else 0
     start_pos = decoder_input_ids.size(-1) if decoder_input_ids is not None else prev_gen.token_ids.size(-1) if prev_gen is not None else 1
@@ -567,7 +680,7 @@ def generate_beamsample_options(
     """
     generations = []
     multibatch_stopping_criteria = StoppingCriteriaList()
-    multibatch_stopping_criteria.append(MultiBatchEndSentenceCriteria(tokenizer.pad_token_id))
+    multibatch_stopping_criteria.append(MultiBatchEndSentenceCriteria(decoding_vocab.pad_token_id))
     decoder_input_ids= decoder_input_ids if decoder_input_ids is not None else prev_gen.token_ids if prev_gen is not None else None
     decoder_input_id_length = decoder_input_ids.size(1) if decoder_input_ids is not None else 0
     start_pos = decoder_input_ids.size(-1) if decoder_input_ids is not None else prev_gen.token_ids.size(-1) if prev_gen is not None else 1
@@ -609,7 +722,7 @@ def generte_sample_options(
         print(colored(f"generation force stopped due to exceeding max length, you may consider use longer MAX_TARGET_LENGTH", 'red'))
 
     multibatch_stopping_criteria = StoppingCriteriaList()
-    multibatch_stopping_criteria.append(MultiBatchEndSentenceCriteria(tokenizer.pad_token_id))
+    multibatch_stopping_criteria.append(MultiBatchEndSentenceCriteria(decoding_vocab.pad_token_id))
     sample_outputs = generate_sent(
         input_ids, 
         multibatch_stopping_criteria,
@@ -621,36 +734,6 @@ def generte_sample_options(
     items = process_multisample_generation(sample_outputs, target_label, prev_gen)
     return items
 
-def sort_filter_gen_history(sent_options:List[GenerationItem], n:int): # n is the number of top sentences to select
-    return sorted(sent_options, key=lambda item: (item.get_avg_log()+item.classification_score), reverse=True)[:n] # sort in descending order
-
-def sort_filter_gen_history_with_length_penalty(sent_options:List[GenerationItem], n:int): # n is the number of top sentences to select
-    return sorted(sent_options, key=lambda item: item.seq_score, reverse=True)[:n] # sort in descending order
-
-def sort_filter_gen_histrory_by_rank(sent_options:List[GenerationItem], n:int):
-    logsum_scores = [item.get_avg_log() for item in sent_options]
-    logsum_sorted = sorted(logsum_scores, reverse=True)
-    # print("sorted avg:", logsum_sorted)
-    def get_combined_rank(item):
-        avg = item.get_avg_log()
-        if avg in logsum_sorted:
-            logsum_rank = logsum_sorted.index(avg)
-        else:
-            print(colored(f"log sum avg not found in whole list: {avg} | {logsum_sorted}", 'red'))
-   
-        # logsum_rank = (logsum_sorted==item.get_avg_log()).nonzero()[0][0].item() # if multiple items have same score, take the earlier rank
-        # logsum_rank = (logsum_sorted==item.get_avg_log()).nonzero().squeeze().item()
-        comb_rank = logsum_rank + item.classification_rank
-        return (comb_rank, item.classification_rank) # specify sorting secondary key
-    sorted_items = sorted(sent_options, key=get_combined_rank, reverse=False) # the lower the score, the better the overall performance
-    # for i, item in enumerate(sorted_items):
-    #     print(i, ":", get_combined_rank(item), item.classification_rank, item.get_avg_log(), item.text)
-    return sorted_items[:n]
-
-def sort_filter_gen_history_with_classification_rank(sent_options:List[GenerationItem], n:int): # n is the number of top sentences to select
-    # classification rank: the lower the better, reverse as compared to avg logsum
-    return sorted(sent_options, key=lambda item: (item.get_avg_log()-item.classification_rank), reverse=True)[:n] # sort in descending order
-    
 # -------- Generation per Token Span Functions --------
 def process_beam_search_span_generation(beamsearch_outputs, prev_len: Optional[int]=1):
     """
@@ -666,8 +749,8 @@ def process_beam_search_span_generation(beamsearch_outputs, prev_len: Optional[i
     prev_ids = None
     for idx in range(beamsearch_outputs.sequences.size(0)):
         start_pos = prev_len
-        eos_mask = beamsearch_outputs.sequences[idx, :]==tokenizer.eos_token_id
-        pad_mask = beamsearch_outputs.sequences[idx, :]==tokenizer.pad_token_id
+        eos_mask = beamsearch_outputs.sequences[idx, :]==decoding_vocab.eos_token_id
+        pad_mask = beamsearch_outputs.sequences[idx, :]==decoding_vocab.pad_token_id
         comb_mask = pad_mask.logical_or(eos_mask)
         end_pos = (comb_mask == True).nonzero()[1].item() # ignore the beginning eos
         # end_pos = beamsearch_outputs.sequences.size(-1)-1 # NOTE: last eos is not generated but appended by beam search algo
@@ -690,7 +773,7 @@ def process_beam_search_span_generation(beamsearch_outputs, prev_len: Optional[i
         # there no need to add logsum word by word, since it is the accumulated beam_scores throughout all operations
         logsum = beamsearch_outputs.prev_beam_scores[idx].item()
         seqscore = beamsearch_outputs.sequences_scores[idx].item()
-        text = tokenizer.decode(cumulated_gen_ids, skip_special_tokens=True) if args.debug else ""
+        text = fast_decode(decoding_vocab, cumulated_gen_ids) if args.debug else ""
         item = GenerationItem(cumulated_gen_ids, logsum, seq_score=seqscore, text=text)
 
         if not completed:
@@ -753,25 +836,60 @@ def generate_sentence_for_beam_search_span(
 
     return (generations, completions)
 
+def get_journal_scores(item: Optional[GenerationItem], rouge_result=None):
+    scores = {}
+    if item is not None:
+        scores["logsum"] = float(item.logsum)
+        scores["avg_log"] = float(item.get_avg_log()) if item.num_tokens_generated > 0 else None
+        scores["classification_score"] = float(item.classification_score) if item.classification_score is not None else None
+        scores["seq_score"] = float(item.seq_score)
+    if rouge_result is not None:
+        scores["rouge"] = rouge_result
+    return scores
+
 # --------- Generation ---------
 if args.write:
-    fw = open(result_file_path, write_mode, encoding="utf-8")
+    journal_file_path = get_journal_file_path(result_file_path)
+    journal = ResultsJournal(journal_file_path, fsync_every=args.journal_fsync_every, resume=not args.no_resume)
+    print("journal_file_path:", journal_file_path)
+    if journal.last_idx is not None:
+        # resume after the last committed example, rebuilding the result file from the journal so no line is lost or duplicated
+        test_start_idx = max(test_start_idx, journal.last_idx + 1)
+        print(colored(f"resuming from journal: {len(journal.records)} examples committed, continue from idx {test_start_idx}", 'green'))
+        with open(result_file_path, "w", encoding="utf-8") as fw:
+            for record in journal.records:
+                fw.write(record["output"]+'\n')
+        fw = open(result_file_path, "a", encoding="utf-8")
+    else:
+        fw = open(result_file_path, write_mode, encoding="utf-8")
     # score_fw = open(rouge_file_path, write_mode, encoding="utf-8")
     # gold_file_path = result_file_path.replace(".txt", ".gold")
     # gold_fw = open(gold_file_path, write_mode, encoding="utf-8")
     # logprob_file_path = result_file_path.replace(".txt", ".logprob")
     # logprob_fw = open(logprob_file_path, write_mode, encoding="utf-8")
 
-metric = load_metric("rouge")
-total_rouge = {}
+rouge_meter = StreamingRouge(use_stemmer=True)
 avg_rouge = {}
 total_gen = 0
 
+def get_gold(idx):
+    return target_list[idx] if text_list is not None else raw_datasets[idx]['highlights']
 
+if args.eval_rouge and args.write and journal.last_idx is not None:
+    # re-score the resumed examples so the final average and confidence interval cover the whole range
+    for record in journal.records:
+        rouge_meter.add(record["output"], get_gold(record["idx"]))
 
-for idx in tqdm(range(test_start_idx, total_test_examples)):
+
+
+for idx in tqdm(range(test_start_idx, test_end_idx)):
 # for idx in [2]: # DEBUG  
     total_gen += 1 
+    example_start_time = time.time()
+    PROFILER.start_example(idx)
+    output_item = None # the selected GenerationItem, if any, for the journal scores
+    if args.per_example_seed:
+        set_seed(get_example_seed(args.run_num, idx))
     if text_list is not None:
         text = text_list[idx]
         gold = target_list[idx]
@@ -781,6 +899,10 @@ for idx in tqdm(range(test_start_idx, total_test_examples)):
 
 
     input_ids = tokenizer(text,max_length=args.max_source_length,padding=False,truncation=True,return_tensors="pt").input_ids.to(device)
+    if output_vocab is not None: # SentBS: restricted output projection, the mined vocabulary plus this source
+        model.set_output_vocab(torch.cat([output_vocab, input_ids[0]]))
+    if args.draft_model_path:
+        model.drafter.set_source(input_ids, model.output_vocab_ids)
     
     output = None
 
@@ -848,7 +970,8 @@ for idx in tqdm(range(test_start_idx, total_test_examples)):
                     print("logsum {} | num tokens {} | avg log {} | class prob {} | label {} | {}".format(gen_item.logsum,gen_item.num_tokens_generated,gen_item.get_avg_log(), gen_item.classification_score, curr_label, gen_item.text))
                 print("\n\n")
 
-        output_text = sort_filter_gen_history(completions, 1)[0].text
+        output_item = sort_filter_gen_history(completions, 1)[0]
+        output_text = output_item.text
         # output_text = sort_filter_gen_history_with_classification_rank(gen_history, 1)[0].text
 
     elif gen_mode == "greedy_search": # normal greedy search, for baseline
@@ -863,6 +986,7 @@ for idx in tqdm(range(test_start_idx, total_test_examples)):
                 input_ids=input_ids, 
                 max_length=MAX_TARGET_LENGTH, 
                 num_beams=BS_NUM_BEAMS,
+                cross_attn_broadcast=not args.no_cross_attn_broadcast,
                 # gen_mode="beam_search_span", # TODO: for debug purpose only
                 # output_scores=True,
                 # return_dict_in_generate=True, 
@@ -905,7 +1029,8 @@ for idx in tqdm(range(test_start_idx, total_test_examples)):
                     for i, gen_item in enumerate(gen_history):
                         print("logsum {} | num tokens {} | avg log {} | class prob {} | rank {} | {}".format(gen_item.logsum,gen_item.num_tokens_generated,gen_item.get_avg_log(), gen_item.classification_score, gen_item.classification_rank, gen_item.text))
                     print("\n\n")
-        output_text = sort_filter_gen_history(gen_history, 1)[0].text
+        output_item = sort_filter_gen_history(gen_history, 1)[0]
+        output_text = output_item.text
     elif gen_mode == "sample":
         gen_history = [] # clean and redo generation
         target_labels = text.split(" ==> ")[0].split(" | ")
@@ -938,7 +1063,8 @@ for idx in tqdm(range(test_start_idx, total_test_examples)):
                 for i, gen_item in enumerate(gen_history):
                     print("logsum {} | num tokens {} | avg log {} | class prob {} | rank {} | {}".format(gen_item.logsum,gen_item.num_tokens_generated,gen_item.get_avg_log(), gen_item.classification_score, gen_item.classification_rank, gen_item.text))
                 print("\n\n")
-        output_text = sort_filter_gen_history(gen_history, 1)[0].text
+        output_item = sort_filter_gen_history(gen_history, 1)[0]
+        output_text = output_item.text
     elif gen_mode == "beam_search_span":
         beamsearch_stopped = False # used to track if no need for beamsearch
         finished_generations = []
@@ -996,32 +1122,54 @@ for idx in tqdm(range(test_start_idx, total_test_examples)):
             finished_generations = gen_history
 
         output = sort_filter_gen_history_with_length_penalty(finished_generations, 1)[0]
+        output_item = output
         output_text = tokenizer.decode(output.token_ids, skip_special_tokens=True)
         logsum = output.logsum 
         # seq_score = outputs.seq_score
 
-    if args.write:
-        fw.write(output_text+'\n')
-        # gold_fw.write(gold+'\n')
-        # logprob_fw.write(str(logsum)+' '+str(seq_score)+'\n')
-    
     if args.debug:
         print(output_text.encode('utf-8'))
 
     if args.eval_rouge:
         # get current rouge
-        result = metric.compute(predictions=[output_text], references=[gold], use_stemmer=True)
-        result = {key: value.mid.fmeasure * 100 for key, value in result.items()}
+        with PROFILER.timed("rouge"):
+            result = rouge_meter.add(output_text, gold)
 
         # get average rouge
-        for key in result.keys():
-            if key in avg_rouge:
-                total_rouge[key] += result[key]
-            else:
-                total_rouge[key] = result[key]
-        avg_rouge = {key: value/total_gen for key,value in total_rouge.items()}
+        avg_rouge = rouge_meter.average()
 
         if args.debug:
             print(result)
             print("avg rouge:", avg_rouge)
-    
\ No newline at end of file
+
+    if args.write:
+        # commit to the journal first: on resume the result file is rebuilt from the journal
+        journal.append(idx, output_text, labels=[x.strip() for x in text.split(" ==> ")[0].split(" | ")], elapsed=time.time()-example_start_time, scores=get_journal_scores(output_item, result if args.eval_rouge else None))
+        fw.write(output_text+'\n')
+        fw.flush()
+        # gold_fw.write(gold+'\n')
+        # logprob_fw.write(str(logsum)+' '+str(seq_score)+'\n')
+
+    PROFILER.end_example()
+
+if args.write:
+    journal.close()
+    fw.close()
+
+if args.eval_rouge and len(rouge_meter) > 0:
+    rouge_summary = rouge_meter.summary()
+    print("final average rouge:", rouge_summary["average"])
+    print("bootstrap rouge (low/mid/high):", rouge_summary["bootstrap"])
+    if args.write:
+        with open(rouge_file_path, "w", encoding="utf-8") as rouge_fw:
+            json.dump(rouge_summary, rouge_fw, indent=2)
+        print("rouge written to:", rouge_file_path)
+
+if args.draft_model_path:
+    print("speculative decoding:", model.drafter.stats())
+
+if args.profile:
+    print("profile summary:", PROFILER.summary())
+    if args.write:
+        PROFILER.dump(profile_file_path)
+        print("profile written to:", profile_file_path)
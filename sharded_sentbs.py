@@ -0,0 +1,171 @@
+"""
+Run beam_search_sent.py / segctrl_sentbs.py over N shards of the test set in parallel and merge the
+shard outputs back, in example order, into the usual result file.
+
+Example:
+    python sharded_sentbs.py --num_shards 8 --threads_per_shard 8 --script beam_search_sent.py \
+        --gen_size 8 --beam_size 4 --top_p 0.9 --res_dir results/sampling --generation_model_path results/sentctrl_reproduced \
+        --test_file data/original_clean/test_rate_concat_sent-ctrl.csv --gen_mode sample --write --eval_rouge \
+        --load_classifier --classification_model_path <path_to_classification_model>
+
+All flags not listed in `parse_arguments` are passed through to every worker unchanged.
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+from termcolor import colored
+
+from results_journal import get_journal_file_path
+
+
+def parse_arguments(parser):
+    parser.add_argument('--script', type=str, default="beam_search_sent.py", choices=['beam_search_sent.py', 'segctrl_sentbs.py'], help="the decoding script run by each worker")
+    parser.add_argument('--num_shards', type=int, default=4, help="number of worker processes, each holding its own model copy (shared with --bundle_path --mmap_weights on CPU)")
+    parser.add_argument('--threads_per_shard', type=int, default=0, help="torch.set_num_threads budget per worker, 0 splits the visible cores evenly")
+    parser.add_argument('--devices', type=str, default="", help="comma separated CUDA device ids assigned to workers round-robin, empty to inherit CUDA_VISIBLE_DEVICES")
+    parser.add_argument('--keep_shards', action="store_true", default=False, help="Whether to keep the per-shard result and log files after merging")
+
+    args, passthrough = parser.parse_known_args()
+    for k in args.__dict__:
+        print(k + ": " + str(args.__dict__[k]))
+    return args, passthrough
+
+
+def parse_worker_arguments(passthrough):
+    # the subset of worker flags the driver needs, with the same defaults as the decoding scripts
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--test_file', type=str, default="")
+    parser.add_argument('--dataset_path', type=str, default="")
+    parser.add_argument('--res_dir', type=str, default="")
+    parser.add_argument('--res_file_name', type=str, default="auto")
+    parser.add_argument('--dataset_name', type=str, default="mred")
+    parser.add_argument('--write_mode', type=str, default="w")
+    parser.add_argument('--test_start_idx', type=int, default=0)
+    parser.add_argument('--test_end_idx', type=int, default=-1)
+    parser.add_argument('--top_p', type=float, default=0.9)
+    parser.add_argument('--run_num', type=int, default=0)
+    parser.add_argument('--gen_size', type=int, default=8)
+    parser.add_argument('--beam_size', type=int, default=4)
+    worker_args, _ = parser.parse_known_args(passthrough)
+    return worker_args
+
+
+def get_result_file_path(worker_args):
+    # NOTE: keep in sync with the result file naming in beam_search_sent.py / segctrl_sentbs.py
+    if worker_args.res_file_name == "auto":
+        return os.path.join(worker_args.res_dir, worker_args.dataset_name+"-gen_size_"+str(worker_args.gen_size)+"-beam_size_"+str(worker_args.beam_size)+"-top_p_"+str(worker_args.top_p)+"-"+str(worker_args.run_num)+".txt")
+    return os.path.join(worker_args.res_dir, worker_args.res_file_name)
+
+
+def count_test_examples(worker_args):
+    if worker_args.test_file[-3:] == "csv":
+        import pandas as pd
+        return len(pd.read_csv(worker_args.test_file))
+    from datasets import load_from_disk
+    return len(load_from_disk(worker_args.dataset_path))
+
+
+def get_shard_ranges(start_idx, end_idx, num_shards):
+    """
+    split [start_idx, end_idx) into at most num_shards contiguous ranges whose sizes differ by at most one
+    """
+    total = end_idx - start_idx
+    num_shards = max(1, min(num_shards, total))
+    base, extra = divmod(total, num_shards)
+    ranges = []
+    curr = start_idx
+    for shard_idx in range(num_shards):
+        size = base + (1 if shard_idx < extra else 0)
+        ranges.append((curr, curr + size))
+        curr += size
+    return ranges
+
+
+def merge_shards(shard_files, shard_ranges, result_file_path, write_mode="w"):
+    """
+    concatenate shard outputs in example order; returns False if any shard is missing examples
+    """
+    complete = True
+    with open(result_file_path, write_mode, encoding="utf-8") as fw:
+        for shard_file, (start, end) in zip(shard_files, shard_ranges):
+            with open(shard_file, "r", encoding="utf-8") as fr:
+                lines = fr.readlines()
+            if len(lines) != end - start:
+                print(colored(f"shard {shard_file} has {len(lines)} lines but covers {end - start} examples [{start}, {end})", 'red'))
+                complete = False
+            fw.writelines(lines)
+    return complete
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    args, passthrough = parse_arguments(parser)
+    worker_args = parse_worker_arguments(passthrough)
+
+    if "--write" not in passthrough:
+        passthrough = passthrough + ["--write"]
+    if not os.path.exists(worker_args.res_dir):
+        os.mkdir(worker_args.res_dir)
+
+    result_file_path = get_result_file_path(worker_args)
+    if os.path.exists(result_file_path) and worker_args.write_mode == "w":
+        print(colored(f"please rename result file path to avoid it being over-written: {result_file_path}", 'red'))
+        exit()
+
+    total_test_examples = count_test_examples(worker_args)
+    end_idx = total_test_examples if worker_args.test_end_idx < 0 else min(worker_args.test_end_idx, total_test_examples)
+    shard_ranges = get_shard_ranges(worker_args.test_start_idx, end_idx, args.num_shards)
+    threads_per_shard = args.threads_per_shard if args.threads_per_shard > 0 else max(1, (os.cpu_count() or 1) // len(shard_ranges))
+    devices = [x.strip() for x in args.devices.split(",") if x.strip()]
+    print("total test examples in test file:", total_test_examples)
+    print("shards:", shard_ranges, "| threads per shard:", threads_per_shard)
+
+    result_name = os.path.basename(result_file_path)[:-len(".txt")] if result_file_path.endswith(".txt") else os.path.basename(result_file_path)
+    shard_files, log_files, workers = [], [], []
+    start_time = time.time()
+    for shard_idx, (start, end) in enumerate(shard_ranges):
+        shard_name = f"{result_name}.shard_{shard_idx}_of_{len(shard_ranges)}.txt"
+        shard_files.append(os.path.join(worker_args.res_dir, shard_name))
+        log_files.append(shard_files[-1].replace(".txt", ".log"))
+        # later flags override earlier ones in argparse, so the shard settings are appended at the end
+        cmd = [sys.executable, args.script] + passthrough + [
+            "--res_file_name", shard_name,
+            "--write_mode", "w",
+            "--test_start_idx", str(start),
+            "--test_end_idx", str(end),
+            "--num_threads", str(threads_per_shard),
+            "--per_example_seed",
+        ]
+        env = dict(os.environ)
+        env["OMP_NUM_THREADS"] = str(threads_per_shard)
+        env["MKL_NUM_THREADS"] = str(threads_per_shard)
+        env["TOKENIZERS_PARALLELISM"] = "false"
+        if devices:
+            env["CUDA_VISIBLE_DEVICES"] = devices[shard_idx % len(devices)]
+        log_fw = open(log_files[-1], "w", encoding="utf-8")
+        workers.append((subprocess.Popen(cmd, stdout=log_fw, stderr=subprocess.STDOUT, env=env), log_fw))
+        print(f"shard {shard_idx}: examples [{start}, {end}) -> {shard_files[-1]} (log: {log_files[-1]})")
+
+    failed = []
+    for shard_idx, (worker, log_fw) in enumerate(workers):
+        return_code = worker.wait()
+        log_fw.close()
+        if return_code != 0:
+            failed.append(shard_idx)
+            print(colored(f"shard {shard_idx} exited with code {return_code}, see {log_files[shard_idx]}", 'red'))
+    print("all shards finished in {:.1f}s".format(time.time() - start_time))
+
+    if failed:
+        print(colored(f"not merging because shards {failed} failed; shard files are kept for inspection", 'red'))
+        exit(1)
+
+    if merge_shards(shard_files, shard_ranges, result_file_path, worker_args.write_mode):
+        print("merged result_file_path:", result_file_path)
+        if not args.keep_shards:
+            for path in shard_files + log_files + [get_journal_file_path(x) for x in shard_files]:
+                if os.path.exists(path):
+                    os.remove(path)
+    else:
+        print(colored(f"merged with missing examples into {result_file_path}; shard files are kept for inspection", 'red'))
@@ -0,0 +1,192 @@
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional
+
+import torch
+from torch import nn
+
+from kv_cache import StaticKVCache, truncate_past_key_values
+from profiler import PROFILER
+
+
+class SpeculativeDrafter:
+    """
+    Small draft model (e.g. a distilled BART fine-tuned with the generator's tokenizer) for speculative decoding in
+    beam_search_sent_utils: each round it proposes num_draft_tokens tokens per lane, which the generator verifies in
+    a single forward. `sample` accepts a prefix of them with the usual rejection rule so the sampled sentences keep
+    the generator's distribution; `beam_search` / `beam_sample` keep the generator logits of the drafted paths for
+    as long as the beam selection follows them. Attach it as `model.drafter`.
+    The draft model encodes each source once (`set_source`); its decoder cache lives across the rounds of one
+    decoding call and is rolled back to the tokens the generator accepted.
+    """
+    def __init__(self, model: nn.Module, num_draft_tokens: int = 4):
+        self.model = model
+        self.num_draft_tokens = num_draft_tokens
+        self.encoder_outputs = None
+        self.attention_mask = None
+        self.past = None
+        self.cached_len = 0
+        self.num_rounds = 0
+        self.num_proposed = 0
+        self.num_accepted = 0
+        self.num_tokens = 0
+
+    @torch.no_grad()
+    def set_source(self, input_ids: torch.LongTensor, output_vocab_ids: Optional[torch.LongTensor] = None):
+        """
+        encode the source input_ids [1, src_len] of the next decoding calls; with output_vocab_ids, the draft model
+        is restricted to the same output vocabulary as the generator (see set_output_vocab)
+        """
+        self.attention_mask = torch.ones_like(input_ids)
+        self.encoder_outputs = self.model.get_encoder()(input_ids=input_ids, attention_mask=self.attention_mask, return_dict=True)
+        self.model.set_output_vocab(output_vocab_ids)
+        self.reset()
+
+    def reset(self):
+        self.past = None
+        self.cached_len = 0
+
+    @torch.no_grad()
+    def next_logits(self, input_ids: torch.LongTensor) -> torch.Tensor:
+        """
+        draft logits [num_lanes, vocab_size] of the token after input_ids [num_lanes, cur_len]; the lanes share the one
+        encoded source in cross-attention
+        """
+        if self.encoder_outputs is None:
+            raise ValueError("call set_source before decoding with a SpeculativeDrafter")
+        outputs = self.model(
+            encoder_outputs=self.encoder_outputs,
+            attention_mask=self.attention_mask,
+            decoder_input_ids=input_ids[:, self.cached_len:],
+            decoder_attention_mask=input_ids != self.model.config.pad_token_id,
+            past_key_values=self.past,
+            use_cache=True,
+            return_dict=True,
+        )
+        self.past = outputs.past_key_values
+        self.cached_len = input_ids.size(1)
+        return outputs.logits[:, -1, :].float()
+
+    def reorder(self, lane_idx: torch.LongTensor):
+        # follow the beams, as the generator cache does
+        if self.past is not None:
+            self.past = self.model._reorder_cache(self.past, lane_idx)
+
+    def truncate(self, length: int):
+        # keep the cached positions the generator accepted
+        if self.past is not None and length < self.cached_len:
+            self.past = truncate_past_key_values(self.past, length)
+            self.cached_len = length
+
+    def record_round(self, num_proposed: int, num_accepted: int, num_tokens: int):
+        self.num_rounds += 1
+        self.num_proposed += num_proposed
+        self.num_accepted += num_accepted
+        self.num_tokens += num_tokens
+        PROFILER.count("draft_tokens_proposed", num_proposed)
+        PROFILER.count("draft_tokens_accepted", num_accepted)
+        PROFILER.count("verify_steps")
+
+    def stats(self) -> Dict:
+        """
+        acceptance_rate: fraction of proposed draft positions accepted for all lanes (beams) of their round
+        tokens_per_forward: tokens committed per generator forward (1 without speculation)
+        """
+        return {
+            "rounds": self.num_rounds,
+            "proposed": self.num_proposed,
+            "accepted": self.num_accepted,
+            "acceptance_rate": round(self.num_accepted / max(1, self.num_proposed), 4),
+            "tokens_per_forward": round(self.num_tokens / max(1, self.num_rounds), 4),
+        }
+
+
+@dataclass
+class BeamDrafts:
+    """
+    one speculative round of a beam search loop: the tokens the drafter proposed per lane [num_lanes, num_draft], the
+    generator logits after every draft prefix [num_lanes, num_draft + 1, vocab_size], and for every current beam the
+    lane whose drafted path it is on, depth steps into the round
+    """
+    tokens: torch.LongTensor
+    logits: torch.Tensor
+    lanes: torch.LongTensor
+    depth: int = 0
+
+    def next_token_logits(self) -> torch.Tensor:
+        return self.logits[self.lanes, self.depth, :]
+
+
+def verify_beam_drafts(
+    model: nn.Module,
+    drafter: SpeculativeDrafter,
+    input_ids: torch.LongTensor,
+    logits_processor: Callable,
+    stopping_criteria,
+    model_kwargs: Dict[str, Any],
+    draft_forced_pad: Optional[Callable[[int, torch.LongTensor], torch.BoolTensor]] = None,
+) -> BeamDrafts:
+    """
+    start a speculative round of beam search / beam sampling: the drafter extends every beam greedily by up to
+    num_draft_tokens tokens (draft_forced_pad(draft_idx, draft_ids): lanes whose next draft token is forced to pad),
+    and the generator scores all beams and their drafted paths in one forward, whose cache is left in model_kwargs.
+    The beam steps of the round take their logits from it instead of a forward each; after every step,
+    advance_beam_drafts ends the round once a selected beam leaves the drafted paths. Every step is thus the step of
+    the plain loop, on generator logits of the same prefixes, whether the drafts are good or not; they only decide
+    how many steps one generator forward serves.
+    """
+    num_lanes, cur_len = input_ids.shape
+    num_draft = drafter.num_draft_tokens
+    if stopping_criteria.max_length is not None:
+        num_draft = min(num_draft, stopping_criteria.max_length - cur_len - 1)
+    if isinstance(model_kwargs.get("past"), StaticKVCache):
+        num_draft = min(num_draft, model_kwargs["past"].max_length - cur_len)
+    num_draft = max(num_draft, 0)
+
+    draft_ids = input_ids
+    with PROFILER.timed("draft"):
+        for draft_idx in range(num_draft):
+            draft_scores = logits_processor(draft_ids, nn.functional.log_softmax(drafter.next_logits(draft_ids), dim=-1))
+            draft_tokens = draft_scores.argmax(dim=-1)
+            if draft_forced_pad is not None:
+                draft_tokens = draft_tokens.masked_fill(draft_forced_pad(draft_idx, draft_ids), model.config.pad_token_id)
+            draft_ids = torch.cat([draft_ids, draft_tokens[:, None]], dim=-1)
+
+    # one generator forward over the uncached tokens (all but the last of input_ids are cached) and the drafts
+    cached_len = cur_len - 1 if model_kwargs.get("past") is not None else 0
+    model_inputs = model.prepare_inputs_for_generation(draft_ids, **model_kwargs)
+    model_inputs["decoder_input_ids"] = draft_ids[:, cached_len:]
+    with PROFILER.timed("decoder_step"):
+        outputs = model(**model_inputs, return_dict=True)
+    model_kwargs.update(model._update_model_kwargs_for_generation(
+        outputs, model_kwargs, is_encoder_decoder=model.config.is_encoder_decoder
+    ))
+    lanes = torch.arange(num_lanes, device=input_ids.device)
+    return BeamDrafts(draft_ids[:, cur_len:], outputs.logits[:, -(num_draft + 1):, :], lanes)
+
+
+def advance_beam_drafts(
+    model: nn.Module,
+    drafter: SpeculativeDrafter,
+    drafts: BeamDrafts,
+    beam_idx: torch.LongTensor,
+    beam_next_tokens: torch.LongTensor,
+    cur_len: int,
+    model_kwargs: Dict[str, Any],
+) -> Optional[BeamDrafts]:
+    """
+    follow the beam step selecting beam_idx / beam_next_tokens, taken on input_ids of length cur_len. The round goes
+    on while every selected beam took the drafted token of its lane; otherwise it ends (None is returned), and the
+    generator and drafter caches are reordered to the lanes of the new beams and truncated to cur_len, the positions
+    before their new token, which are all on the drafted paths
+    """
+    drafts.lanes = drafts.lanes[beam_idx]
+    on_draft = drafts.depth < drafts.tokens.size(1) and torch.equal(beam_next_tokens, drafts.tokens[drafts.lanes, drafts.depth])
+    drafts.depth += 1
+    if on_draft:
+        return drafts
+    drafter.record_round(drafts.tokens.size(1), drafts.depth - 1, drafts.depth)
+    if model_kwargs["past"] is not None:
+        model_kwargs["past"] = truncate_past_key_values(model._reorder_cache(model_kwargs["past"], drafts.lanes), cur_len)
+    drafter.reorder(drafts.lanes)
+    drafter.truncate(cur_len)
+    return None
@@ -14,12 +14,15 @@ class EndSentenceCriteria(StoppingCriteria):
         num_sents: stop generation after specified number of sentences is generated   # deprecate
         
     """
-    def __init__(self, tokenizer):
+    def __init__(self, tokenizer, decoding_vocab=None):
         self.tokenizer = tokenizer
+        self.decoding_vocab = decoding_vocab # optional DecodingVocab, skips decoding when the last token can not end a sentence
         # self.generated_sents = 0
 
     def __call__(self, input_ids: torch.LongTensor, score: torch.FloatTensor, **kwargs) -> bool:
         assert input_ids.size(0) == 1 # EndSentenceCriteria only works for batch size 1
+        if self.decoding_vocab is not None and not self.decoding_vocab.may_end_sentence(input_ids[0, -1].item()):
+            return False
         text = self.tokenizer.decode(input_ids[0])
         if is_sent_complete(text):
             return True
@@ -0,0 +1,148 @@
+import queue
+import threading
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from transformers import PreTrainedTokenizerBase
+
+from rouge.rouge import StreamingRouge
+
+
+class StreamingSummarizationMetrics:
+    """
+    The ROUGE / gen_len metrics of run_summarization's compute_metrics, computed batch by batch during evaluation.
+    `add_batch` hands the generated ids and labels of one batch to a background thread, which decodes and scores them
+    while the next batch is generated, then drops them; so host memory does not grow with the validation set.
+    At most max_pending_batches batches wait to be scored, after which `add_batch` blocks.
+    """
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizerBase,
+        postprocess_text: Optional[Callable[[List[str], List[str]], Tuple[List[str], List[str]]]] = None,
+        ignore_pad_token_for_loss: bool = True,
+        max_pending_batches: int = 8,
+    ):
+        self.tokenizer = tokenizer
+        self.postprocess_text = postprocess_text
+        self.ignore_pad_token_for_loss = ignore_pad_token_for_loss
+        self.rouge = StreamingRouge(use_stemmer=True) # the rouge types of load_metric("./rouge")
+        self.total_gen_len = 0
+        self.error = None
+        self.pending = queue.Queue(maxsize=max_pending_batches)
+        self.worker = threading.Thread(target=self._work, daemon=True)
+        self.worker.start()
+
+    def __len__(self):
+        return len(self.rouge)
+
+    def add_batch(self, preds: np.ndarray, labels: np.ndarray):
+        if self.error is not None:
+            raise self.error
+        self.pending.put((preds, labels))
+
+    def _work(self):
+        while True:
+            batch = self.pending.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                continue # keep draining so add_batch never blocks forever
+            try:
+                self._score_batch(*batch)
+            except Exception as e:
+                self.error = e
+
+    def _score_batch(self, preds: np.ndarray, labels: np.ndarray):
+        pad_token_id = self.tokenizer.pad_token_id
+        # -100 pads predictions gathered across processes, and labels ignored by the loss
+        preds = np.where(preds != -100, preds, pad_token_id)
+        if self.ignore_pad_token_for_loss:
+            labels = np.where(labels != -100, labels, pad_token_id)
+        decoded_preds = self.tokenizer.batch_decode(preds, skip_special_tokens=True)
+        decoded_labels = self.tokenizer.batch_decode(labels, skip_special_tokens=True)
+        if self.postprocess_text is not None:
+            decoded_preds, decoded_labels = self.postprocess_text(decoded_preds, decoded_labels)
+        for pred, label in zip(decoded_preds, decoded_labels):
+            self.rouge.add(pred, label)
+        self.total_gen_len += int(np.count_nonzero(preds != pad_token_id))
+
+    def compute(self):
+        """
+        wait for the pending batches and return the metrics, in the format of run_summarization's compute_metrics
+        """
+        self.pending.put(None)
+        self.worker.join()
+        if self.error is not None:
+            raise self.error
+        if len(self.rouge) == 0:
+            return {}
+        result = {key: value.mid.fmeasure * 100 for key, value in self.rouge.aggregate().items()}
+        result["gen_len"] = self.total_gen_len / len(self.rouge)
+        result = {k: round(v, 4) for k, v in result.items()}
+        # add sum of all rouge metrics
+        rouges = [v for k,v in result.items() if "rouge" in k ]
+        result['rougeSum'] = sum(rouges)
+        return result
+
+
+class TeacherForcedPromptAccuracy:
+    """
+    Generation-free structure proxy from the teacher-forced forward of the eval loss: how well the model predicts
+    the label prompts "<label-sep>label<sent-sep>" in the gold targets, given the gold prefix.
+    `add_batch` takes the argmax ids of the logits ([batch, tgt_len], aligned with labels) and the labels.
+    Reports
+        prompt_acc: fraction of label prompts (i.e. sentences) whose tokens are all predicted correctly
+        prompt_token_acc: accuracy over the label prompt tokens
+        token_acc: accuracy over all target tokens
+    prompt_acc / prompt_token_acc are left out if the targets have no label prompts (e.g. the tokenizer has no
+    <label-sep> / <sent-sep> tokens, label_sep_id / sent_sep_id None); with require_prompts (checkpoints selected on a
+    prompt metric), that raises a ValueError instead.
+    """
+    teacher_forced = True # MyTrainer passes the argmax of the logits instead of generated ids
+
+    def __init__(self, label_sep_id: Optional[int], sent_sep_id: Optional[int], pad_token_id: Optional[int] = None, require_prompts: bool = False):
+        if require_prompts and (label_sep_id is None or sent_sep_id is None):
+            raise ValueError("prompt_acc needs <label-sep> / <sent-sep> tokens in the tokenizer, select checkpoints on eval_token_acc or eval_loss instead")
+        self.label_sep_id = label_sep_id
+        self.require_prompts = require_prompts
+        self.sent_sep_id = sent_sep_id
+        self.pad_token_id = pad_token_id
+        self.num_prompts = 0
+        self.num_correct_prompts = 0
+        self.num_prompt_tokens = 0
+        self.num_correct_prompt_tokens = 0
+        self.num_tokens = 0
+        self.num_correct_tokens = 0
+
+    def add_batch(self, preds: np.ndarray, labels: np.ndarray):
+        valid = labels != -100
+        if self.pad_token_id is not None:
+            valid &= labels != self.pad_token_id
+        correct = (preds == labels) & valid
+        self.num_tokens += int(valid.sum())
+        self.num_correct_tokens += int(correct.sum())
+
+        # a prompt runs from <label-sep> to the next <sent-sep>, both included
+        is_close = labels == self.sent_sep_id
+        prompt_idx = np.cumsum(labels == self.label_sep_id, axis=1) # 1-based index of the latest prompt opened
+        in_prompt = (prompt_idx > np.cumsum(is_close, axis=1) - is_close) & valid
+        self.num_prompt_tokens += int(in_prompt.sum())
+        self.num_correct_prompt_tokens += int((correct & in_prompt).sum())
+        for row_prompt_idx, row_in_prompt, row_correct in zip(prompt_idx, in_prompt, correct):
+            row_prompt_idx, row_correct = row_prompt_idx[row_in_prompt], row_correct[row_in_prompt]
+            if len(row_prompt_idx) == 0:
+                continue
+            num_row_prompts = len(np.unique(row_prompt_idx))
+            self.num_prompts += num_row_prompts
+            self.num_correct_prompts += num_row_prompts - len(np.unique(row_prompt_idx[~row_correct]))
+
+    def compute(self):
+        result = {"token_acc": round(self.num_correct_tokens / max(1, self.num_tokens) * 100, 4)}
+        if self.num_prompts == 0:
+            if self.require_prompts:
+                raise ValueError("TeacherForcedPromptAccuracy: no label prompts in the eval targets, prompt_acc can not select checkpoints")
+            print("TeacherForcedPromptAccuracy: no label prompts in the targets, only token_acc is reported")
+            return result
+        result["prompt_acc"] = round(self.num_correct_prompts / self.num_prompts * 100, 4)
+        result["prompt_token_acc"] = round(self.num_correct_prompt_tokens / self.num_prompt_tokens * 100, 4)
+        return result
@@ -0,0 +1,113 @@
+"""
+remove_prompts_fast / batch_remove_prompts against remove_prompts on MReD style generations, including the
+overlapping, back-to-back and malformed label prompts on which remove_prompts mis-slices.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import random
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import remove_prompts, remove_prompts_fast, batch_remove_prompts
+
+
+RM_TYPES = ["extra_tokens", "special_sep", "label_arrow"]
+LABELS = ["abstract", "strength", "weakness", "rating_summary", "ac_disagreement", "rebuttal_process", "suggestion", "decision", "misc"]
+SENTENCES = [
+    "This paper proposes a new method for learning disentangled representations.",
+    "The reviewers agree that the idea is novel and the experiments are thorough.",
+    "However, R2 is concerned about the limited comparison with prior work.",
+    "The authors' rebuttal addressed most of the concerns.",
+    "I therefore recommend acceptance as a poster.",
+    "A|B testing (see Sec. 3) and x <= y are discussed ==> in the appendix.",
+]
+
+
+def format_prompt(label, rm_type):
+    if rm_type == "extra_tokens":
+        return "<label-sep>" + label + "<sent-sep>"
+    if rm_type == "special_sep":
+        return "¥ " + label + " þ"
+    return "| " + label + " ==>"
+
+
+def generation(rng, rm_type, num_sents):
+    return " ".join(format_prompt(rng.choice(LABELS), rm_type) + " " + rng.choice(SENTENCES[:5]) for _ in range(num_sents))
+
+
+MALFORMED = {
+    "extra_tokens": [
+        "<label-sep>abstract<sent-sep><label-sep>strength<sent-sep> The paper is clear.", # back-to-back
+        "<label-sep><label-sep>abstract<sent-sep>weakness<sent-sep> Two labels in one prompt.", # nested
+        "<label-sep>abstract<label-sep>abstract<sent-sep><sent-sep> Unclosed prompt.",
+        "<label-sep>misc<sent-sep> The same prompt <label-sep>misc<sent-sep> twice <label-sep>misc<sent-sep>.",
+        "<label-sep>abstract<sent-sep>",
+        "",
+    ],
+    "special_sep": [
+        "¥ abstract þ¥ strength þ The paper is clear.", # back-to-back
+        "¥ abstract ¥ strength þ Nested prompt.",
+        "¥ ¥ abstract þ þ Doubled separators.",
+        "¥ misc þ x ¥ misc þ y ¥ misc þ",
+        "¥ abstract þ",
+        "¥abstract þ Missing space.",
+    ],
+    "label_arrow": [
+        "| abstract ==>| strength ==> The paper is clear.", # back-to-back
+        "| abstract ==> | strength ==> Adjacent prompts.",
+        "| | abstract ==> Doubled bar.",
+        "| abstract | strength ==> Unclosed prompt.",
+        "| abstract =| abstract ==> Overlapping prompt.",
+        "| misc ==> x | misc ==> y | misc ==>",
+        "A|B | abstract ==> Bar in the text.",
+        "| abstract ==>",
+    ],
+}
+
+
+@pytest.mark.parametrize("rm_type", RM_TYPES)
+def test_matches_remove_prompts_on_generations(rm_type):
+    rng = random.Random(0)
+    for _ in range(500):
+        text = generation(rng, rm_type, rng.randint(1, 12))
+        assert remove_prompts_fast(text, rm_type=rm_type) == remove_prompts(text, rm_type=rm_type), text
+
+
+@pytest.mark.parametrize("rm_type", RM_TYPES)
+def test_matches_remove_prompts_on_malformed_prompts(rm_type):
+    for text in MALFORMED[rm_type] + SENTENCES:
+        assert remove_prompts_fast(text, rm_type=rm_type) == remove_prompts(text, rm_type=rm_type), text
+
+
+@pytest.mark.parametrize("rm_type", RM_TYPES + ["extra_token", "special_sep_extra_tokens"])
+def test_matches_remove_prompts_on_random_fragments(rm_type):
+    # random concatenations of prompt pieces, which make overlapping and back-to-back prompts frequent
+    rng = random.Random(1)
+    fragments = ["| ", "|", " ==>", "=", ">", "¥ ", "¥", " þ", "þ", "<label-sep>", "<sent-sep>", "<", "abstract", "misc", " ", "the paper", ".", "\n"]
+    for _ in range(5000):
+        text = "".join(rng.choice(fragments) for _ in range(rng.randint(0, 20)))
+        assert remove_prompts_fast(text, rm_type=rm_type) == remove_prompts(text, rm_type=rm_type), text
+
+
+@pytest.mark.parametrize("rm_type", RM_TYPES)
+def test_batch_remove_prompts(rm_type):
+    rng = random.Random(2)
+    texts = [generation(rng, rm_type, rng.randint(1, 8)) for _ in range(50)] + MALFORMED[rm_type]
+    assert batch_remove_prompts(texts, rm_type=rm_type) == [remove_prompts(text, rm_type=rm_type) for text in texts]
+
+
+def test_removes_well_formed_prompts():
+    assert remove_prompts_fast("<label-sep>abstract<sent-sep> The paper is clear.") == "  The paper is clear."
+    assert remove_prompts_fast("| abstract ==> The paper is clear. | decision ==> Accept.", rm_type="label_arrow") == "The paper is clear. Accept."
+
+
+def test_does_not_print(capsys):
+    batch_remove_prompts(["<label-sep>abstract<sent-sep>", "| abstract ==>| strength ==>"], rm_type="extra_tokens")
+    batch_remove_prompts(["| abstract ==>", "| abstract ==>| strength ==>"], rm_type="label_arrow")
+    assert capsys.readouterr().out == ""
@@ -0,0 +1,88 @@
+import os
+import json
+import shutil
+import hashlib
+from typing import Callable, Dict, List, Optional
+
+from datasets import Dataset, load_from_disk
+from transformers import PreTrainedTokenizerBase
+
+
+# bump when the preprocessing of run_summarization changes in a way the cache key does not capture
+TOKENIZED_CACHE_VERSION = 1
+
+
+def get_file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as fr:
+        for chunk in iter(lambda: fr.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_tokenizer_fingerprint(tokenizer: PreTrainedTokenizerBase) -> str:
+    """
+    hash of everything that changes token ids: the serialized fast tokenizer (vocab, merges, added tokens,
+    normalizer, pre/post-processing) or, for slow tokenizers, the vocab and the special tokens
+    """
+    sha = hashlib.sha256(type(tokenizer).__name__.encode("utf-8"))
+    if getattr(tokenizer, "is_fast", False):
+        sha.update(tokenizer.backend_tokenizer.to_str().encode("utf-8"))
+    else:
+        sha.update(json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode("utf-8"))
+    sha.update(json.dumps(tokenizer.special_tokens_map_extended, sort_keys=True, default=str).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def get_cache_key(data_file: str, tokenizer: PreTrainedTokenizerBase, settings: Dict) -> str:
+    key = {
+        "version": TOKENIZED_CACHE_VERSION,
+        "data_file": get_file_hash(data_file),
+        "tokenizer": get_tokenizer_fingerprint(tokenizer),
+        "settings": settings,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+
+def load_or_tokenize(
+    dataset: Dataset,
+    data_file: str,
+    tokenizer: PreTrainedTokenizerBase,
+    preprocess_function: Callable,
+    settings: Dict,
+    cache_dir: Optional[str] = None,
+    num_proc: Optional[int] = None,
+    remove_columns: Optional[List[str]] = None,
+    overwrite_cache: bool = False,
+) -> Dataset:
+    """
+    Tokenize dataset with preprocess_function, or load the result of an earlier run with the same data file content,
+    tokenizer and settings (max lengths, prefix, padding, ...; everything preprocess_function depends on).
+    Entries are Arrow datasets written with save_to_disk under cache_dir (default: .tokenized_cache next to
+    data_file), so they are memory-mapped on load instead of read into memory.
+    Entries are written without any locking: in distributed training, call it under
+    `training_args.main_process_first()` and let only the main process overwrite_cache.
+    """
+    cache_dir = cache_dir if cache_dir else os.path.join(os.path.dirname(os.path.abspath(data_file)), ".tokenized_cache")
+    cache_path = os.path.join(cache_dir, os.path.splitext(os.path.basename(data_file))[0] + "-" + get_cache_key(data_file, tokenizer, settings))
+
+    if os.path.exists(cache_path) and not overwrite_cache:
+        print("loading tokenized dataset from cache:", cache_path)
+        return load_from_disk(cache_path)
+
+    tokenized = dataset.map(
+        preprocess_function,
+        batched=True,
+        num_proc=num_proc,
+        remove_columns=remove_columns,
+        load_from_cache_file=False,
+    )
+    # write to a temporary directory first, so an interrupted run never leaves a partial cache entry behind
+    tmp_path = cache_path + ".tmp-" + str(os.getpid())
+    os.makedirs(cache_dir, exist_ok=True)
+    tokenized.save_to_disk(tmp_path)
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.replace(tmp_path, cache_path)
+    print("saved tokenized dataset to cache:", cache_path)
+    return load_from_disk(cache_path)
@@ -1,4 +1,5 @@
 import warnings
+import functools
 from dataclasses import dataclass
 from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
 
@@ -52,6 +53,7 @@ import numpy as np
 import re
 import pandas as pd
 from torch import nn
+from decoding_vocab import DecodingVocab, get_decoding_vocab
 # from torch.utils.data import DataLoader, Dataset
 
 def postprocess_text(preds, golds):
@@ -74,10 +76,14 @@ def compute_metrics(preds, golds):
     return result
 
 def get_prompts_from_input_text(text, pre_prompt, post_prompt):
+    return list(_get_prompts_from_input_text(text, pre_prompt, post_prompt))
+
+@functools.lru_cache(maxsize=4096)
+def _get_prompts_from_input_text(text, pre_prompt, post_prompt):
+    # SentBS: cached, the same source is split again for every decoding step / sentence
     prompt_string = text[:text.index(post_prompt)]
     prompts = prompt_string.strip().split(pre_prompt)
-    prompts = [prompt.strip() for prompt in prompts if prompt.strip()!=""]
-    return prompts
+    return tuple(prompt.strip() for prompt in prompts if prompt.strip()!="")
 
 def remove_prompts(input_str, rm_type="extra_tokens"):
     """
@@ -92,6 +98,14 @@ def remove_prompts(input_str, rm_type="extra_tokens"):
     else: # pattern "| label1 ==>" needs to be removed
         prompts = re.findall(r'\|\s[^\s]+\s=*>?',input_str)
 
+    input_str = _cut_prompts(input_str, prompts, rm_type)
+
+    if input_str.strip() == "": # DEBUG
+        print("got empty!")
+
+    return input_str
+
+def _cut_prompts(input_str, prompts, rm_type):
     for prompt in prompts:
         start = input_str.find(prompt)
         end = start + len(prompt)
@@ -99,11 +113,53 @@ def remove_prompts(input_str, rm_type="extra_tokens"):
             input_str = input_str[:start]+' '+input_str[end:]
         else:
             input_str = input_str[:start]+input_str[end+1:]
+    return input_str
 
-    if input_str.strip() == "": # DEBUG
-        print("got empty!")
+# SentBS: compiled patterns of remove_prompts, keyed the same way as its rm_type, with the first character of every match
+_PROMPT_PATTERNS = {
+    "special_sep": (re.compile(r'\¥\s[^\s]+\s\þ?'), '¥'),
+    "extra_tokens": (re.compile(r'<label-sep>[a-z_A-Z]+<sent-sep>'), '<'),
+    "label_arrow": (re.compile(r'\|\s[^\s]+\s=*>?'), '|'),
+}
 
-    return input_str
+def remove_prompts_fast(input_str, rm_type="extra_tokens"):
+    """
+        remove_prompts with one compiled regex scan, returning exactly what remove_prompts returns.
+        remove_prompts removes the prompts one by one at the first str.find of their text in the partly cleaned string,
+        which is not the matched prompt when
+        - the character dropped after a prompt (all rm_types but extra_token) is the start of the next prompt, e.g. back-to-back "| a ==>| b ==>"
+        - joining the text around removed prompts forms an earlier copy of a later prompt, e.g. overlapping or malformed prompts
+        Both need back-to-back prompts or the first character of a prompt ('|', '¥' or '<') in the text kept before a
+        later prompt; such inputs are cut prompt by prompt as in remove_prompts, all others in one pass.
+        Unlike remove_prompts, it does not print empty results.
+    """
+    if "special_sep" in rm_type:
+        pattern, lead = _PROMPT_PATTERNS["special_sep"]
+    elif "extra_tokens" in rm_type:
+        pattern, lead = _PROMPT_PATTERNS["extra_tokens"]
+    else: # pattern "| label1 ==>" needs to be removed
+        pattern, lead = _PROMPT_PATTERNS["label_arrow"]
+    replace_with_space = "extra_token" in rm_type
+
+    pieces, prev_end = [], 0
+    for match in pattern.finditer(input_str):
+        start, end = match.span()
+        if start < prev_end or lead in input_str[prev_end:start]:
+            return _cut_prompts(input_str, pattern.findall(input_str), rm_type)
+        pieces.append(input_str[prev_end:start])
+        if replace_with_space:
+            pieces.append(' ')
+            prev_end = end
+        else:
+            prev_end = end + 1
+    pieces.append(input_str[prev_end:])
+    return "".join(pieces)
+
+def batch_remove_prompts(input_strs, rm_type="extra_tokens"):
+    """
+        remove_prompts_fast over a list of generations
+    """
+    return [remove_prompts_fast(input_str, rm_type=rm_type) for input_str in input_strs]
 
 def get_logits_processor(
         config,
@@ -169,6 +225,108 @@ def get_logits_processor(
         processors.append(InfNanRemoveLogitsProcessor())
     return processors
 
+class PromptInsertionState:
+    """
+    Per-beam bookkeeping for inserting label prompts in beam_search_sent.
+    Every step only looks at the newest token, so the cost per beam does not grow with the sequence length.
+    All tensors have one row per beam and are permuted with `beam_idx` together with the past key values.
+    Positions are columns of `input_ids`, -1 if not seen yet.
+    Only "committed" tokens are tracked, i.e. all but the newest token, which may still be replaced by a prompt token.
+    batch_prompt_ids holds the remaining prompts of each example; beams of example b are rows b*num_beams:(b+1)*num_beams.
+    """
+    def __init__(self, input_ids: torch.LongTensor, batch_prompt_ids: List[List[Tuple[List[int], str]]], num_beams: int, sent_terminator_id: int, label_terminator_id: int):
+        batch_beam_size = input_ids.size(0)
+        device = input_ids.device
+        self.beam_prompt_ids = [batch_prompt_ids[i // num_beams] for i in range(batch_beam_size)] # beams never move across examples
+        self.sent_terminator_id = sent_terminator_id # <label-sep>, starts a label prompt
+        self.label_terminator_id = label_terminator_id # <sent-sep>, ends a label prompt
+        self.capacity = max(len(x) for x in batch_prompt_ids) + 2 # the prompt in the decoder prefix, one per entry of prompt_ids, and one misgenerated
+        self.num_sent_terminators = torch.zeros(batch_beam_size, dtype=torch.long, device=device)
+        self.sent_terminator_pos = torch.full((batch_beam_size, self.capacity), -1, dtype=torch.long, device=device)
+        self.recent_sent_terminator_pos = torch.full((batch_beam_size, 2), -1, dtype=torch.long, device=device) # [second last, last]
+        self.last_label_terminator_pos = torch.full((batch_beam_size,), -1, dtype=torch.long, device=device)
+        for pos in range(input_ids.size(1)):
+            self.commit(input_ids[:, pos], pos)
+
+    def reorder(self, beam_idx: torch.LongTensor):
+        self.num_sent_terminators = self.num_sent_terminators.index_select(0, beam_idx)
+        self.sent_terminator_pos = self.sent_terminator_pos.index_select(0, beam_idx)
+        self.recent_sent_terminator_pos = self.recent_sent_terminator_pos.index_select(0, beam_idx)
+        self.last_label_terminator_pos = self.last_label_terminator_pos.index_select(0, beam_idx)
+
+    def commit(self, tokens: torch.LongTensor, pos: int):
+        """
+        record the final token ids at column pos of every beam
+        """
+        is_sent_terminator = tokens == self.sent_terminator_id
+        if is_sent_terminator.any():
+            rows = is_sent_terminator.nonzero(as_tuple=True)[0]
+            slots = self.num_sent_terminators[rows]
+            fits = slots < self.capacity
+            self.sent_terminator_pos[rows[fits], slots[fits]] = pos
+            self.recent_sent_terminator_pos[rows, 0] = self.recent_sent_terminator_pos[rows, 1]
+            self.recent_sent_terminator_pos[rows, 1] = pos
+            self.num_sent_terminators[rows] += 1
+        self.last_label_terminator_pos = torch.where(tokens == self.label_terminator_id, torch.full_like(self.last_label_terminator_pos, pos), self.last_label_terminator_pos)
+
+    def get_forced_tokens(self, cur_len: int):
+        """
+        returns a list with one (forced_token, warning) per beam, where forced_token is the prompt token that must
+        replace the newest token (or None), and warning a message to print if the sentence is not complete either
+        """
+        num_sent_terminators = self.num_sent_terminators.tolist()
+        sent_terminator_pos = self.sent_terminator_pos.tolist()
+        recent_sent_terminator_pos = self.recent_sent_terminator_pos.tolist()
+        last_label_terminator_pos = self.last_label_terminator_pos.tolist()
+
+        def count_gt_one(window): # more than one <label-sep> among the committed tokens input_ids[i][-window:-1]
+            return recent_sent_terminator_pos[i][0] >= max(0, cur_len - window)
+
+        results = []
+        for i in range(len(num_sent_terminators)):
+            prompt_ids = self.beam_prompt_ids[i]
+            curr_prompt_pos = num_sent_terminators[i] - 2 # we don't handle anything if <label-sep> is just added or generated
+            if curr_prompt_pos < 0 or len(prompt_ids) == 0:
+                results.append((None, None))
+                continue
+            if curr_prompt_pos > len(prompt_ids):
+                results.append((None, None)) # generated more <label-sep> than needed, nothing we can do
+                continue
+            elif curr_prompt_pos == len(prompt_ids): # see if misgenerated consequtive ones
+                if count_gt_one(len(prompt_ids[-1][0])):
+                    curr_prompt_pos -= 1
+                    curr_prompt_id, _ = prompt_ids[-1]
+                else:
+                    results.append((None, None)) # nothing we can do, but we can cut the generation later
+                    continue
+            else:
+                curr_prompt_id, _ = prompt_ids[curr_prompt_pos]
+                # avoid: a new <label-sep> is generated before previous label prompt is completed
+                traceback_length = len(curr_prompt_id) + len(prompt_ids[curr_prompt_pos-1][0]) if curr_prompt_pos > 0 else len(curr_prompt_id)
+                # NOTE: previous prompt hasn't finished and we are one prompt ahead
+                if count_gt_one(traceback_length):
+                    if curr_prompt_pos > 0:
+                        curr_prompt_pos -= 1
+                        curr_prompt_id, _ = prompt_ids[curr_prompt_pos]
+                    else:
+                        results.append((None, "strange condition, no prev prompt but we are having two <label-sep> at the end: "))
+                        continue # don't do anything yet
+
+            curr_prompt_start_idx = sent_terminator_pos[i][curr_prompt_pos+1] # +1 for adding to the first prompt
+            ## NOTE: no <sent-sep> after the prompt start prevents appending curr_prompt directly aft prev_prompt when no sentence has been generated
+            ## the newest token is not checked in case system mistakenly generates a <sent-sep>, eg. <label-sep>rebuttal<sent-sep>, leading to not completing <label-sep>rebuttal_process<sent-sep>
+            if last_label_terminator_pos[i] >= curr_prompt_start_idx:
+                results.append((None, None))
+                continue
+            # NOTE: ignore the sent_terminator_id at [-1] position
+            pos = cur_len - curr_prompt_start_idx - 1
+            if pos >= len(curr_prompt_id):
+                results.append((None, f"error, pos exceed current prompt: {pos} {curr_prompt_id}"))
+                continue
+            results.append((curr_prompt_id[pos], None))
+        return results
+
+
 def beam_search_sent(
     model: PreTrainedModel,
     tokenizer: PreTrainedTokenizerFast,
@@ -183,6 +341,7 @@ def beam_search_sent(
     output_hidden_states: Optional[bool] = None,
     output_scores: Optional[bool] = None,
     return_dict_in_generate: Optional[bool] = None,
+    decoding_vocab: Optional[DecodingVocab] = None,
     **model_kwargs,
 ) -> Union[BeamSearchOutput, torch.LongTensor]:
     if len(stopping_criteria) == 0:
@@ -222,6 +381,16 @@ def beam_search_sent(
     beam_scores[:, 1:] = -1e9
     beam_scores = beam_scores.view((batch_size * num_beams,))
 
+    decoding_vocab = decoding_vocab if decoding_vocab is not None else get_decoding_vocab(tokenizer)
+    if decoding_vocab.label_sep_id is None or decoding_vocab.sent_sep_id is None:
+        raise ValueError("beam_search_sent inserts <label-sep>label<sent-sep> prompts, but the tokenizer has no <label-sep> / <sent-sep> token; use the tokenizer of a generation model trained with both added as tokens")
+    sent_terminator_id = decoding_vocab.label_sep_id
+    label_terminator_id = decoding_vocab.sent_sep_id
+    # prompt_ids is either shared by all examples, or (for batched decoding) a list with the prompt_ids of each example
+    batch_prompt_ids = prompt_ids if len(prompt_ids) > 0 and isinstance(prompt_ids[0], list) else [prompt_ids] * batch_size
+    assert len(batch_prompt_ids) == batch_size, f"got prompt_ids for {len(batch_prompt_ids)} examples, but batch size is {batch_size}"
+    prompt_state = PromptInsertionState(input_ids, batch_prompt_ids, num_beams, sent_terminator_id, label_terminator_id)
+
     while True:
         model_inputs = model.prepare_inputs_for_generation(input_ids, **model_kwargs)
 
@@ -266,82 +435,27 @@ def beam_search_sent(
         
         # SCH DEBUG: 
         # print("input id:\n",input_ids)
-        sent_terminator_id = tokenizer.convert_tokens_to_ids("<label-sep>")
-        label_terminator_id = tokenizer.convert_tokens_to_ids("<sent-sep>")
-        for i in range(len(input_ids)):
-            curr_gen = tokenizer.decode(input_ids[i][-50:-1], skip_special_tokens=False, clean_up_tokenization_spaces=True).strip()
-            # NOTE: use -50: to speed up, and -1 because we need to set last token to <label-sep> if prev sentence ended already
-            # print("see if need to cut:", input_ids[i][:-1])
-            if is_sent_complete(curr_gen):
-                input_ids[i][-1] = sent_terminator_id
-                continue # done processing
-
-            input_list = input_ids[i].tolist()
-            curr_prompt_pos = input_list[:-1].count(sent_terminator_id) - 2 # we don't handle anything if <label-sep> is just added or generated
-            if curr_prompt_pos < 0:
-                continue # no need processing
-
-            # if curr_prompt_pos > len(prompt_ids):
-            #     print("error: generated too many labels:", curr_prompt_pos, len(prompt_ids), curr_gen)
-            #     print([y for x,y in prompt_ids])
-            #     # print("ids:", input_list)
-            #     continue
-            if len(prompt_ids) == 0:
+        prompt_state.reorder(beam_idx)
+        last_tokens = input_ids[:, -1].tolist()
+        prev_tokens = input_ids[:, -2].tolist()
+        for i, (forced_token, warning) in enumerate(prompt_state.get_forced_tokens(input_ids.size(1))):
+            if forced_token is not None:
+                # a label prompt is being inserted, the text ends inside the prompt so no sentence can be complete
+                last_tokens[i] = forced_token
                 continue
-            if curr_prompt_pos > len(prompt_ids):
-                # print("generated more <label-sep> than needed")
-                continue # nothing we can do
-            elif curr_prompt_pos == len(prompt_ids): # see if misgenerated consequtive ones
-                if input_list[-len(prompt_ids[-1][0]):-1].count(sent_terminator_id)> 1: 
-                    curr_prompt_pos -= 1
-                    curr_prompt_id, curr_prompt = prompt_ids[-1]
-                    curr_prompt_len = len(curr_prompt_id)
-                    # print("misgenerated <label-sep> ignored")
-                else:
-                    continue # nothing we can do, but we can cut the generation later 
-            else:    
-                curr_prompt_id, curr_prompt = prompt_ids[curr_prompt_pos]
-                # avoid: a new <label-sep> is generated before previous label prompt is completed
-                
-                prev_prompt_len = None
-                if curr_prompt_pos > 0:
-                    prev_prompt_id, _ = prompt_ids[curr_prompt_pos-1]
-                    prev_prompt_len = len(prev_prompt_id)
-                    
-                curr_prompt_len = len(curr_prompt_id)
-                traceback_length = curr_prompt_len + prev_prompt_len if prev_prompt_len else curr_prompt_len 
-                # NOTE: previous prompt hasn't finished and we are one prompt ahead
-                if input_list[-traceback_length:-1].count(sent_terminator_id)> 1 :
-                    if curr_prompt_pos > 0:
-                        curr_prompt_id, curr_prompt = prompt_ids[curr_prompt_pos-1]
-                        curr_prompt_len = len(curr_prompt_id)
-                        curr_prompt_pos -= 1
-                        # print("need to cleanup missgenerated <label-sep>:", curr_gen)
-                        # print("traceback length:", traceback_length)
-                        # print("current ids:", input_list)
-                    else:
-                        print("strange condition, no prev prompt but we are having two <label-sep> at the end: ", input_list)
-                        continue # don't do anything yet
-            
-            curr_prompt_start_idx = [i for i, n in enumerate(input_list[:-1]) if n == sent_terminator_id][curr_prompt_pos+1] # +1 for adding to the first prompt
-
-            if not label_terminator_id in input_list[curr_prompt_start_idx:-1]:
-                ## NOTE: not label_terminator_id prevents appending curr_prompt directly aft prev_prompt when no sentence has been generated
-                ## should not check the last id in case system mistakenly generates a label_terminator_id, eg. <label-sep>rebuttal<sent-sep>, leading to not completing <label-sep>rebuttal_process<sent-sep>
-                # print("need to add new prompt to: ", input_list)
-                # print("curr prompt ids:", curr_prompt_id)
-                # print("cutting pos:", curr_prompt_start_idx)
-                # print("curr prompt:", curr_prompt)
-
-                # pos = input_list[::-1].index(sent_terminator_id)
-                # NOTE: ignore the sent_terminator_id at [-1] position
-                pos = len(input_list)-curr_prompt_start_idx-1
-                # print("pos:", pos)
-                if pos >= len(curr_prompt_id):
-                    print("error, pos exceed current prompt:", pos, curr_prompt_id, input_list)
-                    continue
-                input_ids[i][-1] =  curr_prompt_id[pos]
-                # print("processed prompt:", input_ids[i])
+            # the previous sentence can only have ended if its last token may end a sentence
+            if decoding_vocab.may_end_sentence(prev_tokens[i]):
+                curr_gen = tokenizer.decode(input_ids[i][-50:-1], skip_special_tokens=False, clean_up_tokenization_spaces=True).strip()
+                # NOTE: use -50: to speed up, and -1 because we need to set last token to <label-sep> if prev sentence ended already
+                sent_complete = is_sent_complete(curr_gen)
+            else:
+                sent_complete = False
+            if sent_complete:
+                last_tokens[i] = sent_terminator_id
+            elif warning is not None:
+                print(warning, input_ids[i].tolist())
+        input_ids[:, -1] = torch.tensor(last_tokens, device=input_ids.device)
+        prompt_state.commit(input_ids[:, -1], input_ids.size(1) - 1)
 
         model_kwargs = model._update_model_kwargs_for_generation(
             outputs, model_kwargs, is_encoder_decoder=model.config.is_encoder_decoder
@@ -366,16 +480,23 @@ def beam_search_sent(
     )
 
     # DEBUG
-    sequence_list = sequence_outputs["sequences"].tolist()[0]
-    used_len = sequence_list.count(sent_terminator_id)-1
-    if used_len < len(prompt_ids):
-        unused = [x[-1] for x in prompt_ids[used_len:]]
-        print("not using full label sequence, unsued labels are:", unused)
-    if used_len > len(prompt_ids):
-        # need to cut
-        cutting_pos = [i for i, n in enumerate(sequence_list) if n == sent_terminator_id][len(prompt_ids)+1]
-        print("force removing ", str(len(sequence_list)-cutting_pos), " tokens")
-        sequence_outputs["sequences"] = sequence_outputs["sequences"][:,:cutting_pos] 
+    num_return_sequences = sequence_outputs["sequences"].size(0) // batch_size
+    keep_len = 0
+    for seq_idx, sequence_list in enumerate(sequence_outputs["sequences"].tolist()):
+        prompt_ids = batch_prompt_ids[seq_idx // num_return_sequences]
+        used_len = sequence_list.count(sent_terminator_id)-1
+        if used_len < len(prompt_ids):
+            unused = [x[-1] for x in prompt_ids[used_len:]]
+            print("not using full label sequence, unsued labels are:", unused)
+        if used_len > len(prompt_ids):
+            # need to cut
+            cutting_pos = [i for i, n in enumerate(sequence_list) if n == sent_terminator_id][len(prompt_ids)+1]
+            print("force removing ", str(len(sequence_list)-cutting_pos), " tokens")
+            sequence_outputs["sequences"][seq_idx, cutting_pos:] = pad_token_id
+            keep_len = max(keep_len, cutting_pos)
+        else:
+            keep_len = max(keep_len, len(sequence_list))
+    sequence_outputs["sequences"] = sequence_outputs["sequences"][:, :keep_len]
 
     if return_dict_in_generate:
         if not output_scores:
@@ -552,9 +673,12 @@ def prepare_inputs_for_generation(
     head_mask=None,
     use_cache=None,
     encoder_outputs=None,
+    cross_attn_key_values=None,
+    decoder_static_cache_length=None,
     **kwargs
 ):
     # cut decoder_input_ids if past is used
+    # SCH: prompt_length is the number of uncached positions before the last one, which are fed (prefilled) together with it
     if past is not None:
         if prompt_length == -1:
             decoder_input_ids = decoder_input_ids[:, -1:]
@@ -569,6 +693,8 @@ def prepare_inputs_for_generation(
         "attention_mask": attention_mask,
         "head_mask": head_mask,
         "use_cache": use_cache,  # change this to avoid caching (presumably for debugging)
+        "cross_attn_key_values": cross_attn_key_values, # SentBS: precomputed per source, only used when past is None
+        "decoder_static_cache_length": decoder_static_cache_length, # SentBS: preallocated cache, see kv_cache.StaticKVCache
     }
 
 
@@ -712,8 +838,15 @@ def greedy_search_sent(
     output_hidden_states: Optional[bool] = None,
     output_scores: Optional[bool] = None,
     return_dict_in_generate: Optional[bool] = None,
+    prompt_logprobs: Optional[List[torch.Tensor]] = None,
+    decoding_vocab: Optional[DecodingVocab] = None,
     **model_kwargs,
 ) -> Union[GreedySearchOutput, torch.LongTensor]:
+    """
+    greedy search that inserts the label prompts in prompt_ids whenever a sentence is completed (or eos is generated)
+    if prompt_logprobs is a list, the model log-probs of every inserted prompt are appended to it, one tensor per prompt
+    """
+    decoding_vocab = decoding_vocab if decoding_vocab is not None else get_decoding_vocab(tokenizer)
 
     output_scores = output_scores if output_scores is not None else model.config.output_scores
     output_attentions = output_attentions if output_attentions is not None else model.config.output_attentions
@@ -741,12 +874,15 @@ def greedy_search_sent(
     unfinished_sequences = input_ids.new(input_ids.shape[0]).fill_(1)
     cur_len = input_ids.shape[-1]
 
-    model_inputs = prepare_inputs_for_generation(input_ids, **model_kwargs)
+    # SentBS: number of decoder positions already in the past key values. Every forward feeds all positions after it,
+    # so a forced prompt is prefilled into the cache in one step, together with the token generated before it
+    cached_len = 0
+    pending_prompt = None # (prompt token ids, log-prob of the first prompt token if already known) awaiting its log-probs
 
     prompt_pos = input_ids.size(1) # for preventing truncation of super short sentences
     while True:
         # prepare model inputs
-        # model_inputs = prepare_inputs_for_generation(input_ids, **model_kwargs)
+        model_inputs = prepare_inputs_for_generation(input_ids, input_ids.size(1) - cached_len - 1, **model_kwargs)
         # forward pass to get next token
         outputs = model(
             **model_inputs,
@@ -754,22 +890,17 @@ def greedy_search_sent(
             output_attentions=model.config.output_attentions,
             output_hidden_states=model.config.output_hidden_states,
         )
+        cached_len = input_ids.size(1)
         next_token_logits = outputs.logits[:, -1, :]
 
-        # Store scores, attentions and hidden_states when required
-        if return_dict_in_generate:
-            if output_scores:
-                scores += (next_token_logits,)
-            if output_attentions:
-                decoder_attentions += (
-                    (outputs.decoder_attentions,)
-                )
-                cross_attentions += (outputs.cross_attentions,)
-
-            if output_hidden_states:
-                decoder_hidden_states += (
-                    (outputs.decoder_hidden_states,)
-                )
+        if pending_prompt is not None:
+            # logits at the positions before the prompt tokens score them
+            prompt_tensor, first_logprob = pending_prompt
+            num_scored = prompt_tensor.size(0) - (1 if first_logprob is not None else 0)
+            logprobs = F.log_softmax(outputs.logits[0, outputs.logits.size(1)-num_scored-1:-1, :], dim=-1)
+            logprobs = logprobs.gather(-1, prompt_tensor[prompt_tensor.size(0)-num_scored:, None]).squeeze(-1)
+            prompt_logprobs.append(logprobs if first_logprob is None else torch.cat((first_logprob, logprobs)))
+            pending_prompt = None
 
         # pre-process distribution
         next_tokens_scores = logits_processor(input_ids, next_token_logits)
@@ -788,42 +919,44 @@ def greedy_search_sent(
 
         # update generated ids, model inputs, and length for next step
         input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
-        
-        curr_gen = tokenizer.batch_decode(input_ids, skip_special_tokens=False, clean_up_tokenization_spaces=True)[0].strip()
+        assert input_ids.dim() == 2 and input_ids.size(0) == 1
 
-        prompt_length = -1 # SCH: if not -1, used to notify inputs_preparation not to truncate input_ids
+        input_list = input_ids[0].tolist() # one host copy per step, for decoding and the eos check
+        last_token = input_list[-1]
+        eos_replaced = False
 
         # NOTE SCH: TODO use better ways to determine if a new sentence is completed
-        cut_sent = is_sent_complete(curr_gen)
-        # if cut_sent is True:
-            # print("ending sent:", tokenizer.batch_decode(input_ids, skip_special_tokens=False, clean_up_tokenization_spaces=True)[0].strip().encode("utf-8"))
+        if decoding_vocab.may_end_sentence(last_token):
+            curr_gen = tokenizer.decode(input_list, skip_special_tokens=False, clean_up_tokenization_spaces=True).strip()
+            cut_sent = is_sent_complete(curr_gen)
+        else:
+            cut_sent = False
         if input_ids.size(1) - prompt_pos > 0 and cut_sent is True: 
             if len(prompt_ids) > 0:
-                # print("adding:", prompt_ids[0][-1])
-                prompt_length = len(prompt_ids[0][-1])
-                prompt_tensor = torch.tensor([prompt_ids[0][0]], device=input_ids.device).long()
-                input_ids = torch.cat((input_ids, prompt_tensor), dim=1)
-                assert input_ids.dim() == 2 and input_ids.size(0) == 1
-                # print("currently:", tokenizer.batch_decode(input_ids, skip_special_tokens=False, clean_up_tokenization_spaces=True)[0].strip().encode("utf-8"))
+                prompt_tensor = torch.tensor(prompt_ids[0][0], device=input_ids.device).long()
+                input_ids = torch.cat((input_ids, prompt_tensor[None, :]), dim=1)
+                last_token = prompt_ids[0][0][-1]
+                if prompt_logprobs is not None:
+                    pending_prompt = (prompt_tensor, None)
                 prompt_pos = input_ids.size(1)
                 prompt_ids = prompt_ids[1:]
 
         # prevent termination if prompt remaining
-        if int(input_ids[:, -1].item()) == eos_token_id and len(prompt_ids)>0:
-            # print("rmove </s> and adding:", prompt_ids[0][-1])
-            prompt_length = len(prompt_ids[0][-1])
-            prompt_tensor = torch.tensor([prompt_ids[0][0]], device=input_ids.device).long()
-            input_ids = torch.cat((input_ids[:, :-1], prompt_tensor), dim=1)
-            assert input_ids.dim() == 2 and input_ids.size(0) == 1
+        if last_token == eos_token_id and len(prompt_ids)>0:
+            # the uncached </s> is dropped, the prompt takes its place
+            prompt_tensor = torch.tensor(prompt_ids[0][0], device=input_ids.device).long()
+            input_ids = torch.cat((input_ids[:, :-1], prompt_tensor[None, :]), dim=1)
+            if prompt_logprobs is not None:
+                # the first prompt token is scored by the logits of this step
+                pending_prompt = (prompt_tensor, F.log_softmax(next_token_logits[0], dim=-1)[prompt_tensor[:1]])
             prompt_pos = input_ids.size(1)
             prompt_ids = prompt_ids[1:]
-        
-        model_inputs = prepare_inputs_for_generation(input_ids, prompt_length, **model_kwargs) # NOTE: SCH: pass in prompt_length to let decoder_input_id not to ignore the prompt
+            eos_replaced = True
 
         cur_len = cur_len + 1
 
         # if eos_token was found in one sentence, set sentence to finished
-        if eos_token_id is not None:
+        if eos_token_id is not None and not eos_replaced:
             unfinished_sequences = unfinished_sequences.mul((next_tokens != eos_token_id).long())
 
         # stop when each sentence is finished, or if we exceed the maximum length